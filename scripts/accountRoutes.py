@@ -4,6 +4,8 @@ import flask
 import re
 from sqlite3 import IntegrityError
 
+from scripts.passwordHasher import hasherBusy
+
 diya = flask.Blueprint("diyaAccounts", __name__, template_folder="templates")
 
 
@@ -17,7 +19,10 @@ def login():
         return flask.render_template("account/login.html",
             error="Invalid email or password."), 422
 
-    user = db.checkUser(email, password)
+    try:
+        user = db.checkUser(email, password)
+    except hasherBusy:
+        return busyResponse("account/login.html", email)
 
     if user[0] == False:
         return flask.render_template("account/login.html",
@@ -61,6 +66,8 @@ def register():
     except IntegrityError:
         return flask.render_template("account/register.html",
             email=email, error="Email already in use."), 409
+    except hasherBusy:
+        return busyResponse("account/register.html", email)
 
     flask.session["email"] = email
 
@@ -100,10 +107,44 @@ def deleteAccount():
         return flask.redirect("/account/login")
 
     db.deleteUser(flask.session["user"]["id"])
+    sessions.revokeUser(flask.session["user"]["id"])
     flask.session.clear()
     return "OK", 200
 
 
+@diya.route("/admin/stats/passwords", methods=["GET"])
+def passwordStats():
+    """Get password hashing latency and queue depth for monitoring."""
+    user = flask.session.get("user")
+    if user == None:
+        return flask.abort(401, "You do not have permission to view stats.")
+    elif not user["admin"]:
+        return flask.abort(403, "You do not have permission to view stats.")
+
+    return db.hasher.stats()
+
+
+@diya.route("/admin/stats/queries", methods=["GET"])
+def queryStats():
+    """Get the SQL statements that took the most time and recent slow ones
+    with their query plans, when the server traces SQL."""
+    user = flask.session.get("user")
+    if user == None:
+        return flask.abort(401, "You do not have permission to view stats.")
+    elif not user["admin"]:
+        return flask.abort(403, "You do not have permission to view stats.")
+    elif db.tracer is None:
+        return flask.abort(404, "SQL tracing is off, start the server with --slow-sql.")
+
+    return db.tracer.stats(flask.request.args.get("limit", 50, int))
+
+
+def busyResponse(template, email):
+    """Tell the user to try again when passwords can't be hashed right now."""
+    return flask.render_template(template, email=email,
+        error="Too many people are signing in, please try again."), 503, {"Retry-After": "1"}
+
+
 @diya.route("/account/toggleAdmin", methods=["GET"])
 def toggleAdmin():
     """Temporary route to toggle admin status for debugging."""
@@ -118,6 +159,9 @@ def toggleAdmin():
     con.commit()
     con.close()
 
+    # Sessions keep the user's access level, so log them out everywhere
+    sessions.revokeUser(flask.session["user"]["id"])
+
     if accessLevel >= 2:
         return "Account is now an admin"
     else:
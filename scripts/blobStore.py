@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+import hashlib
+import os
+import re
+import tempfile
+import time
+
+# The number of bytes read at a time when copying files
+chunkSize = 1024 * 1024
+
+
+class blobStore:
+    def __init__(self, directory):
+        """Set up a content addressed file store.
+
+        Files are named by the SHA-256 of their content and kept in
+        subdirectories from the first four characters of it, e.g.
+        ab/cd/abcd....epub, so no directory gets too big. Files derived from
+        a blob, like its cover, share its hash with a different extension.
+
+        Args:
+            directory (str): The directory to store the files in."""
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def isHash(hash):
+        """Check that a string is a SHA-256 hex digest.
+
+        Args:
+            hash (str): The string to check.
+        Returns:
+            bool: Whether it is a valid hash."""
+        return bool(re.fullmatch(r"[0-9a-f]{64}", hash))
+
+    def path(self, hash, extension):
+        """Get the path of a file in the store.
+
+        Args:
+            hash (str): The hash of the file.
+            extension (str): The extension of the file, e.g. ".epub".
+        Returns:
+            str: The path of the file.
+        Raises:
+            ValueError: If the hash isn't valid."""
+        if not self.isHash(hash):
+            raise ValueError("Invalid hash.")
+        return os.path.join(self.directory, hash[:2], hash[2:4], hash + extension)
+
+    def write(self, file):
+        """Copy a file to a temporary file in the store while hashing it.
+
+        The temporary file should be passed to add or removed.
+
+        Args:
+            file (file): A binary file like object to read from.
+        Returns:
+            str: The path of the temporary file.
+            str: The hash of the file."""
+        hash = hashlib.sha256()
+        tempFile = tempfile.NamedTemporaryFile(dir=self.directory, suffix=".part", delete=False)
+        try:
+            with tempFile:
+                for chunk in iter(lambda: file.read(chunkSize), b""):
+                    hash.update(chunk)
+                    tempFile.write(chunk)
+        except BaseException:
+            os.remove(tempFile.name)
+            raise
+        return tempFile.name, hash.hexdigest()
+
+    def add(self, tempPath, hash, extension):
+        """Move a file into the store, if the store already has the file the
+        temporary file is removed instead.
+
+        Args:
+            tempPath (str): The path of the file to move.
+            hash (str): The hash of the blob the file is for.
+            extension (str): The extension of the file, e.g. ".epub".
+        Returns:
+            bool: Whether the file was new to the store."""
+        path = self.path(hash, extension)
+        if os.path.exists(path):
+            os.remove(tempPath)
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tempPath, path)
+        return True
+
+    def remove(self, hash):
+        """Remove a blob and every file derived from it.
+
+        Args:
+            hash (str): The hash of the blob."""
+        directory = os.path.dirname(self.path(hash, ""))
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return
+        for name in names:
+            if name.startswith(hash):
+                try:
+                    os.remove(os.path.join(directory, name))
+                except FileNotFoundError:
+                    pass
+
+    def oldFiles(self, seconds):
+        """Find the files in the store that weren't modified for a while.
+
+        Args:
+            seconds (float): How long ago they were last modified.
+        Yields:
+            str: The hash of the file, None for a temporary file.
+            str: The path of the file."""
+        cutoff = time.time() - seconds
+        for directory, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    if os.path.getmtime(path) > cutoff:
+                        continue
+                except FileNotFoundError:
+                    continue
+                hash = name.split(".", 1)[0]
+                yield (hash if self.isHash(hash) else None), path
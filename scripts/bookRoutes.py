@@ -1,7 +1,13 @@
 #!/usr/bin/env python3
 
+import base64
 import flask
+import json
 import os
+import time
+
+from scripts.catalogSync import exportLines, importLines
+from scripts.coverCache import coverWidths
 
 diya = flask.Blueprint("diyaBooks", __name__, template_folder="templates")
 
@@ -16,8 +22,12 @@ def viewBook(bookID):
         book = db.getBookMetadata(bookID)
     except ValueError:
         raise flask.abort(404, "The book you were looking for was not found.")
+
+    coverPending = bool(book["fileURL"]) and db.coverPending(bookID)
+    if coverPending:
+        book["coverURL"] = db.placeholderCoverURL
         
-    return flask.render_template("books/view.html", book=book, user=flask.session["user"], language=getLanguageOrNone(book["language"]))
+    return flask.render_template("books/view.html", book=book, user=flask.session["user"], language=getLanguageOrNone(book["language"]), coverPending=coverPending)
 
 
 @diya.route("/books/read/<int:bookID>", methods=["GET"])
@@ -33,7 +43,9 @@ def readBook(bookID):
     except ValueError:
         raise flask.abort(404, "The book you were looking for was not found.")
 
-    return flask.render_template("books/read.html", book=book)
+    bookHash = book["fileURL"].split("/")[-1][:-len(".epub")]
+    return flask.render_template("books/read.html", book=book,
+        epubURL=flask.url_for("diyaBooks.viewEpubEntry", bookHash=bookHash, entry=""))
 
 
 @diya.route("/books/file/<string:bookHash>.epub", methods=["GET"])
@@ -41,16 +53,127 @@ def viewBookFile(bookHash):
     """Serve a book file."""
     if flask.session.get("user") == None:
         return flask.abort(401, "You must be signed in to access a book.")
-    return flask.send_file(os.path.join(db.directory, bookHash + ".epub"))
+    try:
+        return sendImmutable(db.blobs.path(bookHash, ".epub"), bookHash, private=True)
+    except (ValueError, FileNotFoundError):
+        return flask.abort(404, "The book you were looking for was not found.")
+
+
+@diya.route("/api/books/epub/<string:bookHash>", methods=["GET"])
+def viewEpubManifest(bookHash):
+    """Get the metadata, manifest and spine of a book file as JSON."""
+    if flask.session.get("user") == None:
+        return flask.abort(401, "You must be signed in to access a book.")
+    try:
+        manifest = db.epubs.manifest(bookHash)
+    except (ValueError, FileNotFoundError):
+        return flask.abort(404, "The book you were looking for was not found.")
+
+    response = flask.jsonify(manifest)
+    return makeImmutable(response, bookHash + "-manifest", private=True)
+
+
+@diya.route("/books/epub/<string:bookHash>/", defaults={"entry": ""}, methods=["GET"])
+@diya.route("/books/epub/<string:bookHash>/<path:entry>", methods=["GET"])
+def viewEpubEntry(bookHash, entry):
+    """Serve a single file from inside a book file, so the reader only
+    downloads the chapters it shows."""
+    if flask.session.get("user") == None:
+        return flask.abort(401, "You must be signed in to access a book.")
+    try:
+        info, mimetype = db.epubs.entry(bookHash, entry)
+    except (ValueError, FileNotFoundError, KeyError):
+        return flask.abort(404, "The file you were looking for was not found.")
+
+    etag = f"{bookHash}-{info.CRC:08x}"
+    if flask.request.if_none_match.contains(etag):
+        response = flask.Response(status=304)
+    else:
+        response = flask.Response(db.epubs.read(bookHash, info), mimetype=mimetype)
+        response.content_length = info.file_size
+    return makeImmutable(response, etag, private=True)
 
 
 @diya.route("/books/cover/<string:bookHash>.jpg", methods=["GET"])
 def viewBookImage(bookHash):
-    """Serve a book cover if it exists or send the placeholder image."""
+    """Serve a book cover if it exists or redirect to the placeholder image.
+
+    URL Parameters:
+        w: The width to resize the cover to, rounded up to one of coverWidths.
+        fmt: The format to send the cover in, e.g. webp, default jpg."""
+    width = flask.request.args.get("w", None, int)
+    extension = flask.request.args.get("fmt", None)
     try:
-        return flask.send_file(os.path.join(db.directory, bookHash + ".jpg"))
-    except FileNotFoundError:
-        return flask.send_file("static/img/cover.jpg")
+        if width is None and extension is None:
+            return sendImmutable(db.blobs.path(bookHash, ".jpg"), bookHash + ".jpg")
+
+        if (extension or "jpg") not in db.covers.formats():
+            return flask.abort(400, "Unsupported image format.")
+        path, mimetype = db.covers.get(bookHash, width or coverWidths[-1], extension or "jpg")
+        return sendImmutable(path, os.path.basename(path), mimetype=mimetype)
+    except (ValueError, FileNotFoundError):
+        # The cover may be made later so the redirect itself isn't cached
+        response = flask.redirect(db.placeholderCoverURL)
+        response.cache_control.no_cache = True
+        return response
+
+
+# Content addressed files never change, so they can be cached for a year
+immutableMaxAge = 365 * 24 * 60 * 60
+
+
+def sendImmutable(path, etag, private=False, **kwargs):
+    """Send a content addressed file with a strong ETag and long lived
+    caching, answering conditional and Range requests with 304 and 206.
+
+    Args:
+        path (str): The path of the file.
+        etag (str): The ETag, which should come from the file's hash.
+        private (bool): Stop shared caches storing it, for files that need
+            a user to be signed in. (optional)
+        **kwargs: Other arguments for flask.send_file.
+    Returns:
+        flask.Response: The response."""
+    response = flask.send_file(path, etag=etag, max_age=immutableMaxAge,
+        conditional=True, **kwargs)
+    return makeImmutable(response, etag, private)
+
+
+def makeImmutable(response, etag, private=False):
+    """Set the ETag and long lived caching headers of a response for
+    content that never changes.
+
+    Args:
+        response (flask.Response): The response.
+        etag (str): The ETag, which should come from the content's hash.
+        private (bool): Stop shared caches storing it. (optional)
+    Returns:
+        flask.Response: The response."""
+    response.set_etag(etag)
+    response.cache_control.max_age = immutableMaxAge
+    response.cache_control.immutable = True
+    if private:
+        response.cache_control.public = False
+        response.cache_control.private = True
+    else:
+        response.cache_control.public = True
+    return response
+
+
+@diya.app_template_global()
+def coverSrcset(coverURL, extension="jpg"):
+    """Make a srcset of the sizes of a cover for an img or source tag.
+
+    Args:
+        coverURL (str): The book's coverURL.
+        extension (str): The format of the covers, default jpg.
+    Returns:
+        str: The srcset, empty if the book doesn't have its own cover or
+            the format isn't supported."""
+    if not coverURL.startswith("/books/cover/") or extension not in db.covers.formats():
+        return ""
+    return ", ".join(f"{coverURL}?w={width}&fmt={extension} {width}w"
+        for width in coverWidths)
 
 
 @diya.route("/admin/books/add", methods=["GET", "POST"])
@@ -87,6 +210,61 @@ def editBook(bookID):
     return flask.redirect(flask.url_for("diyaBooks.viewBook", bookID=bookID))
 
 
+@diya.route("/admin/books/import", methods=["GET", "POST"])
+def importBooks():
+    """Import every EPUB in a directory on the server in the background,
+    or get the status of an import."""
+    user = flask.session.get("user")
+    if user == None:
+        return flask.abort(401, "You do not have permission to import books.")
+    elif not user["admin"]:
+        return flask.abort(403, "You do not have permission to import books.")
+
+    directory = flask.request.values.get("directory", "")
+    if not directory or not os.path.isdir(directory):
+        return flask.abort(422, "The directory does not exist.")
+    directory = os.path.abspath(directory)
+
+    if "POST" != flask.request.method:
+        return {"directory": directory, "status": db.jobStatus("bulkImport", directory)}
+
+    report = os.path.join(db.directory, "imports", time.strftime("%Y%m%d-%H%M%S") + ".csv")
+    jobID = db.queueJob("bulkImport", directory, {"directory": directory, "report": report}, maxAttempts=1)
+    jobs.notify()
+    return {
+        "jobID": jobID,
+        "directory": directory,
+        "status": db.jobStatus("bulkImport", directory),
+        "report": report
+    }, 202
+
+
+@diya.route("/api/books/export", methods=["GET"])
+def exportCatalog():
+    """Stream every book's metadata as JSON Lines."""
+    user = flask.session.get("user")
+    if user == None:
+        return flask.abort(401, "You do not have permission to export books.")
+    elif not user["admin"]:
+        return flask.abort(403, "You do not have permission to export books.")
+
+    return flask.Response(flask.stream_with_context(exportLines(db)),
+        mimetype="application/x-ndjson",
+        headers={"Content-Disposition": "attachment; filename=books.jsonl"})
+
+
+@diya.route("/api/books/import", methods=["POST"])
+def importCatalog():
+    """Add or replace books by ISBN from a JSON Lines request body."""
+    user = flask.session.get("user")
+    if user == None:
+        return flask.abort(401, "You do not have permission to import books.")
+    elif not user["admin"]:
+        return flask.abort(403, "You do not have permission to import books.")
+
+    return importLines(db, flask.request.stream)
+
+
 @diya.route("/admin/books/delete/<int:bookID>", methods=["DELETE"])
 def deleteBook(bookID):
     """Delete a book."""
@@ -110,19 +288,27 @@ def welcome():
         genre: The genre to limit the search to.
         language: The language to limit the search to.
         catalogue: The catalogue to limit the search to.
-        offset: The offset to start at, default 0."""
+        sort: How to order the results, one of sortOptions, default relevance.
+        cursor: The cursor of the "More results" link, to start from where
+            the previous page ended."""
     user = flask.session.get("user")
     if user == None:
         return flask.redirect(flask.url_for("diyaAccounts.loginPage", next=flask.request.url))
-    
-    query = flask.request.args.get("query", "")
-    genre = flask.request.args.get("genre", None) or None
-    language = flask.request.args.get("language", None) or None
-    catalogue = flask.request.args.get("catalogue", None) or None
-    
-    books = db.searchBooks(query, genre, language, catalogue, limit=1024)
 
-    return flask.render_template("books/search.html", books=books, user=user)
+    # The page is streamed, so the header is sent before the search runs
+    return flask.stream_template("books/search.html", results=getSearchPage(), user=user)
+
+
+@diya.route("/books/search/results", methods=["GET"])
+def searchResults():
+    """Return the next page of search results as HTML to add to the search
+    page, takes the same URL parameters as the search page."""
+    user = flask.session.get("user")
+    if user == None:
+        return flask.abort(401, "You need to log in to search for books.")
+
+    books, more = getSearchPage()()
+    return flask.render_template("parts/bookResults.html", books=books, more=more)
 
 
 @diya.route("/api/books/search", methods=["GET"])
@@ -134,8 +320,14 @@ def bookSearch():
         genre: The genre to limit the search to.
         language: The language to limit the search to.
         catalogue: The catalogue to limit the search to.
+        sort: How to order the results, one of sortOptions, default title.
+        cursor: The X-Next-Cursor header of the previous page, to continue
+            from where it ended.
         offset: The offset to start at, default 0.
-        limit: The maximum number of results to return, default 10, maximum 50."""
+        limit: The maximum number of results to return, default 10, maximum 50.
+
+    Response Headers:
+        X-Next-Cursor: The cursor for the next page, if there may be one."""
     user = flask.session.get("user")
     if user == None:
         return flask.redirect(flask.url_for("diyaAccounts.loginPage", next=flask.request.url))
@@ -144,6 +336,7 @@ def bookSearch():
     genre = flask.request.args.get("genre", None) or None
     language = flask.request.args.get("language", None) or None
     catalogue = flask.request.args.get("catalogue", None) or None
+    sort = getSortOrDefault("title")
 
     try:
         offset = int(flask.request.args.get("offset", 0))
@@ -151,10 +344,143 @@ def bookSearch():
     except ValueError: pass
     if limit > 50:
         limit = 50
+
+    after = None
+    if flask.request.args.get("cursor"):
+        try:
+            after = decodeCursor(flask.request.args["cursor"], sort)
+        except ValueError:
+            return flask.abort(400, "Invalid cursor.")
     
-    books = db.searchBooks(query, genre, language, catalogue, offset, limit)
+    books = db.searchBooks(query, genre, language, catalogue, offset, limit, sort, after)
+
+    response = flask.jsonify([
+        {key: value for key, value in book.items() if key != "sortKey"}
+        for book in books])
+    if books and len(books) == limit:
+        response.headers["X-Next-Cursor"] = encodeCursor(books[-1], sort)
+    return response
+
+
+@diya.route("/api/books/facets", methods=["GET"])
+def bookFacets():
+    """API for counting the books in a search by genre, language and catalogue.
+
+    URL Parameters:
+        query: The query to search for in the title, author, and description.
+        genre: The genre to limit the search to.
+        language: The language to limit the search to.
+        catalogue: The catalogue to limit the search to.
+        limit: The most values to return per facet, default 20, maximum 100."""
+    user = flask.session.get("user")
+    if user == None:
+        return flask.redirect(flask.url_for("diyaAccounts.loginPage", next=flask.request.url))
 
-    return books
+    query = flask.request.args.get("query", "")
+    genre = flask.request.args.get("genre", None) or None
+    language = flask.request.args.get("language", None) or None
+    catalogue = flask.request.args.get("catalogue", None) or None
+    try:
+        limit = min(int(flask.request.args.get("limit", 20)), 100)
+    except ValueError:
+        limit = 20
+
+    return db.bookFacets(query, genre, language, catalogue, limit)
+
+
+@diya.route("/api/books/suggest", methods=["GET"])
+def bookSuggestions():
+    """API for suggesting titles, authors and catalogues as a search is typed.
+
+    URL Parameters:
+        prefix: What has been typed so far.
+        limit: The most suggestions to return, default 8, maximum 20."""
+    user = flask.session.get("user")
+    if user == None:
+        return flask.redirect(flask.url_for("diyaAccounts.loginPage", next=flask.request.url))
+
+    prefix = flask.request.args.get("prefix", "")[:64]
+    try:
+        limit = min(int(flask.request.args.get("limit", 8)), 20)
+    except ValueError:
+        limit = 8
+
+    response = flask.jsonify(db.suggestions.search(prefix, limit))
+    response.headers["Cache-Control"] = "private, max-age=60"
+    return response
+
+
+# The number of results on each page of the search page
+searchPageSize = 24
+
+sortOptions = {
+    "relevance": "relevance",
+    "title": "bookName",
+    "author": "author",
+    "date": "IFNULL(publicationDate, '')"
+}
+
+
+def getSortOrDefault(default):
+    """Get the column to sort search results by from the request."""
+    return sortOptions.get(flask.request.args.get("sort"), sortOptions[default])
+
+
+def getSearchPage():
+    """Get a function that searches for a page of the search page's results
+    from the request's URL parameters.
+
+    Returns:
+        function: Returns the books on the page, and the URLs of the next
+            page and of its results to add to this page, or None if it was
+            the last page."""
+    args = flask.request.args
+    query = args.get("query", "")
+    genre = args.get("genre", None) or None
+    language = args.get("language", None) or None
+    catalogue = args.get("catalogue", None) or None
+    sort = getSortOrDefault("relevance")
+
+    after = None
+    if args.get("cursor"):
+        try:
+            after = decodeCursor(args["cursor"], sort)
+        except ValueError:
+            return flask.abort(400, "Invalid cursor.")
+
+    def search():
+        books = db.searchBooks(query, genre, language, catalogue,
+            limit=searchPageSize, sort=sort, after=after)
+        more = None
+        if len(books) == searchPageSize:
+            nextArgs = {**args, "cursor": encodeCursor(books[-1], sort)}
+            more = {
+                "page": flask.url_for("diyaBooks.welcome", **nextArgs),
+                "results": flask.url_for("diyaBooks.searchResults", **nextArgs)
+            }
+        return books, more
+    return search
+
+
+def encodeCursor(book, sort):
+    """Make an opaque cursor pointing after a book in a search."""
+    cursor = json.dumps([sort, book["sortKey"], book["bookID"]])
+    return base64.urlsafe_b64encode(cursor.encode()).decode().rstrip("=")
+
+
+def decodeCursor(cursor, sort):
+    """Get the sortKey and bookID from a cursor made by encodeCursor.
+
+    Raises:
+        ValueError: If the cursor is malformed or for a different sort."""
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        cursorSort, sortKey, bookID = cursor
+    except (TypeError, ValueError, UnicodeDecodeError):
+        raise ValueError("Invalid cursor.")
+    if cursorSort != sort or type(bookID) != int:
+        raise ValueError("Invalid cursor.")
+    return (sortKey, bookID)
 
 
 def getBookFieldsFromForm():
@@ -183,7 +509,11 @@ def addBookFile(bookID, files):
     if file.filename == "" or file.mimetype != "application/epub+zip":
         return
     
-    db.addFile(bookID, file.read())
+    try:
+        db.addFile(bookID, file.stream)
+    except ValueError:
+        flask.abort(422, "The file is not a valid EPUB.")
+    jobs.notify()
 
 
 def readLanguageCodes():
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+
+import csv
+import functools
+import html
+import multiprocessing
+import os
+import re
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ElementTree
+import zipfile
+
+from scripts.blobStore import blobStore
+from scripts.database import database
+from scripts.epubCache import epubCache
+
+
+def findIsbn(identifiers):
+    """Find an ISBN in a book's OPF identifiers.
+
+    Args:
+        identifiers (list of str): The dc:identifier values, e.g. "urn:isbn:978...".
+    Returns:
+        str: The ISBN as it was written, or None if there isn't one."""
+    for identifier in identifiers:
+        isbn = re.sub(r"^(urn:)?isbn:", "", identifier.strip(), flags=re.IGNORECASE)
+        digits = re.sub(r"[\s\-]", "", isbn)
+        if re.fullmatch(r"97[89]\d{10}|\d{9}[\dXx]", digits):
+            return isbn
+    return None
+
+
+def bookMetadata(manifest):
+    """Get addBookMetadata arguments from a parsed OPF.
+
+    Args:
+        manifest (dict): The manifest from epubCache.parseManifest.
+    Returns:
+        dict: The book's metadata.
+    Raises:
+        ValueError: If the title, creator or ISBN is missing."""
+    isbn = findIsbn(manifest["identifiers"])
+    if not manifest["title"] or not manifest["creator"]:
+        raise ValueError("No title or creator in OPF metadata.")
+    if not isbn:
+        raise ValueError("No ISBN in OPF metadata.")
+
+    description = manifest["description"]
+    if description:
+        description = html.unescape(re.sub(r"<[^>]+>", " ", description))
+        description = re.sub(r"\s+", " ", description).strip()
+    date = manifest["date"]
+    if date and not re.match(r"\d{4}(-\d\d){0,2}", date):
+        date = None
+    language = manifest["language"]
+
+    return {
+        "title": manifest["title"][:128],
+        "author": manifest["creator"][:64],
+        "isbn": isbn,
+        "publisher": manifest["publisher"][:64] if manifest["publisher"] else None,
+        "publicationDate": date[:10] if date else None,
+        "description": description or None,
+        "language": language.split("-")[0].lower()[:3] if language else None,
+        "catalogues": [subject[:64] for subject in manifest["subjects"]]
+    }
+
+
+def readEpub(path, blobDirectory):
+    """Copy an EPUB into the blob store's temporary files, read its metadata
+    and make its cover. Run in the worker processes.
+
+    Args:
+        path (str): The path of the EPUB.
+        blobDirectory (str): The blob store's directory.
+    Returns:
+        dict: The "path", and the "metadata", "file" and "cover" to pass to
+            database.addBooks, or the "error" if it couldn't be read."""
+    blobs = blobStore(blobDirectory)
+    tempPath = coverPath = None
+    try:
+        with open(path, "rb") as file:
+            tempPath, hash = blobs.write(file)
+        try:
+            with zipfile.ZipFile(tempPath) as epubFile:
+                metadata = bookMetadata(epubCache.parseManifest(epubFile))
+        except (zipfile.BadZipFile, KeyError, AttributeError, ElementTree.ParseError):
+            raise ValueError("Invalid EPUB file.")
+
+        if not os.path.exists(blobs.path(hash, ".jpg")):
+            fd, coverPath = tempfile.mkstemp(dir=blobDirectory, suffix=".part")
+            os.close(fd)
+            database.saveCover(tempPath, coverPath)
+            if not os.path.getsize(coverPath):
+                os.remove(coverPath)
+                coverPath = None
+        return {"path": path, "metadata": metadata, "file": (tempPath, hash), "cover": coverPath}
+    except Exception as error:
+        for temp in (tempPath, coverPath):
+            if temp and os.path.exists(temp):
+                os.remove(temp)
+        return {"path": path, "error": str(error) or type(error).__name__}
+
+
+class bulkImport:
+    def __init__(self, db, directory, report=None, processes=None, batchSize=250, progress=None):
+        """Set up an import of every EPUB in a directory.
+
+        Files are copied, hashed and have their covers made in a pool of
+        processes, then their metadata is added in batches. Imported files
+        are recorded, so running the import again skips them and only
+        retries the ones that failed or changed.
+
+        Args:
+            db (database): The database to add the books to.
+            directory (str): The directory of EPUBs, searched recursively.
+            report (str): The path to write a CSV of the files that
+                failed and why. (optional)
+            processes (int): The number of worker processes, default the
+                number of CPUs, 0 reads files in this process. (optional)
+            batchSize (int): The number of books to add per transaction,
+                default 250. (optional)
+            progress (function): Called after each batch is added, e.g. to
+                renew the lease of the job running the import. (optional)"""
+        self.db = db
+        self.directory = os.path.abspath(directory)
+        self.report = report
+        self.processes = os.cpu_count() if processes is None else processes
+        self.batchSize = batchSize
+        self.progress = progress
+
+    def files(self):
+        """Find the EPUBs to import.
+
+        Returns:
+            dict: The (size, modified time) of each EPUB by path.
+            int: The number of EPUBs skipped because they were imported."""
+        imported = self.db.importedFiles(self.directory)
+        files, skipped = {}, 0
+        for root, directories, names in os.walk(self.directory):
+            directories.sort()
+            for name in sorted(names):
+                if not name.lower().endswith(".epub"):
+                    continue
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                if imported.get(path) == (stat.st_size, stat.st_mtime):
+                    skipped += 1
+                else:
+                    files[path] = (stat.st_size, stat.st_mtime)
+        return files, skipped
+
+    def run(self):
+        """Import the books.
+
+        Returns:
+            dict: The number of books imported, skipped and failed, the
+                seconds taken and the errors by path."""
+        start = time.monotonic()
+        files, skipped = self.files()
+        read = functools.partial(readEpub, blobDirectory=self.db.blobs.directory)
+        errors = {}
+        batch = []
+
+        if self.processes > 0 and len(files) > 1:
+            pool = multiprocessing.get_context("spawn").Pool(min(self.processes, len(files)))
+            results = pool.imap_unordered(read, files, chunksize=4)
+        else:
+            pool = None
+            results = map(read, files)
+        try:
+            for result in results:
+                result["size"], result["modified"] = files[result["path"]]
+                batch.append(result)
+                if len(batch) >= self.batchSize:
+                    errors.update(self.save(batch))
+                    batch = []
+            if batch:
+                errors.update(self.save(batch))
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+
+        if self.report:
+            os.makedirs(os.path.dirname(os.path.abspath(self.report)), exist_ok=True)
+            with open(self.report, "w", newline="") as file:
+                writer = csv.writer(file)
+                writer.writerow(["path", "error"])
+                writer.writerows(sorted(errors.items()))
+
+        return {
+            "imported": len(files) - len(errors),
+            "skipped": skipped,
+            "failed": len(errors),
+            "seconds": round(time.monotonic() - start, 3),
+            "errors": errors
+        }
+
+    def save(self, batch):
+        """Add a batch of read EPUBs to the database and record them.
+
+        Args:
+            batch (list of dict): The results of readEpub with each file's
+                size and modified time.
+        Returns:
+            dict: The error of each file that wasn't imported by path."""
+        books = [result for result in batch if "error" not in result]
+        con, cur = self.db.connect()
+        try:
+            cur.execute("BEGIN IMMEDIATE")
+            bookErrors = self.db.addBooks([{**result["metadata"],
+                "file": result["file"], "cover": result["cover"]} for result in books], cur)
+            for result, error in zip(books, bookErrors):
+                result["isbn"] = result["metadata"]["isbn"]
+                result["error"] = error
+            self.db.recordImports(batch, cur)
+            con.commit()
+            self.db.suggestions.invalidate()
+        except BaseException:
+            con.rollback()
+            for result in books:
+                for tempPath in (result["file"][0], result["cover"]):
+                    if tempPath and os.path.exists(tempPath):
+                        os.remove(tempPath)
+            raise
+        finally:
+            con.close()
+        if self.progress:
+            self.progress()
+        return {result["path"]: result["error"] for result in batch if result["error"]}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or "--help" in sys.argv:
+        print("Usage: python -m scripts.bulkImport DIRECTORY [options]")
+        print("Options:")
+        print("  --data-dir DIR     Set the directory where data is stored")
+        print("  --processes N      Set the number of worker processes")
+        print("  --report FILE      Set where to write the CSV of errors")
+        exit(0)
+
+    options = {}
+    for arg, var, default in [
+        ("--data-dir",  "dataDir",   os.path.join(os.path.dirname(os.path.dirname(__file__)), "data")),
+        ("--processes", "processes", None),
+        ("--report",    "report",    "import-errors.csv")
+    ]:
+        options[var] = sys.argv[sys.argv.index(arg) + 1] if arg in sys.argv else default
+
+    db = database(options["dataDir"], "database.db", journalMode="WAL", synchronous="NORMAL")
+    db.executeScript("databaseStructure.sql")
+    db.migrate()
+    result = bulkImport(db, sys.argv[1], options["report"],
+        int(options["processes"]) if options["processes"] else None).run()
+    print(f"Imported {result['imported']} books in {result['seconds']} seconds, "
+        f"skipped {result['skipped']} and {result['failed']} failed")
+    if result["failed"]:
+        print(f"Errors written to {options['report']}")
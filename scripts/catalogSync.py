@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import sys
+
+from scripts.database import database
+
+# The most errors listed in an import's result, the rest are only counted
+maxErrors = 100
+
+
+def exportLines(db, batchSize=500):
+    """Export every book as JSON Lines, one book per line.
+
+    Args:
+        db (database): The database to export.
+        batchSize (int): The number of books to read per query, default 500. (optional)
+    Yields:
+        str: A line of JSON with its newline."""
+    for book in db.exportBooks(batchSize):
+        yield json.dumps(book, ensure_ascii=False) + "\n"
+
+
+def importLines(db, lines, batchSize=500):
+    """Import books from JSON Lines, adding them or replacing the books with
+    the same ISBN. Each batch is imported in its own short transaction.
+
+    Args:
+        db (database): The database to import into.
+        lines (iterable of str or bytes): The lines, e.g. an open file.
+        batchSize (int): The number of books per transaction, default 500. (optional)
+    Returns:
+        dict: The number of books "added", "updated" and "failed", and the
+            "errors" with the line number of the first failures."""
+    result = {"added": 0, "updated": 0, "failed": 0, "errors": []}
+
+    def fail(number, error):
+        result["failed"] += 1
+        if len(result["errors"]) < maxErrors:
+            result["errors"].append({"line": number, "error": error})
+
+    def save(books, numbers):
+        imported = db.importBooks(books)
+        result["added"] += imported["added"]
+        result["updated"] += imported["updated"]
+        for number, error in zip(numbers, imported["errors"]):
+            if error:
+                fail(number, error)
+
+    books, numbers = [], []
+    for number, line in enumerate(lines, 1):
+        try:
+            if isinstance(line, bytes):
+                line = line.decode("utf-8")
+            if not line.strip():
+                continue
+            book = json.loads(line)
+        except ValueError:
+            fail(number, "Invalid JSON.")
+            continue
+        if not isinstance(book, dict):
+            fail(number, "Invalid JSON.")
+            continue
+        books.append(book)
+        numbers.append(number)
+        if len(books) >= batchSize:
+            save(books, numbers)
+            books, numbers = [], []
+    if books:
+        save(books, numbers)
+    return result
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ("export", "import") or "--help" in sys.argv:
+        print("Usage: python -m scripts.catalogSync export|import [FILE] [options]")
+        print("Exports to or imports from FILE, or stdout/stdin if it isn't given.")
+        print("Options:")
+        print("  --data-dir DIR    Set the directory where data is stored")
+        exit(0)
+
+    args = sys.argv[2:]
+    dataDir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data")
+    if "--data-dir" in args:
+        index = args.index("--data-dir")
+        dataDir = args[index + 1]
+        del args[index:index + 2]
+
+    db = database(dataDir, "database.db", journalMode="WAL", synchronous="NORMAL", busyTimeout=5000)
+    db.executeScript("databaseStructure.sql")
+    db.migrate()
+
+    if sys.argv[1] == "export":
+        file = open(args[0], "w", encoding="utf-8") if args else sys.stdout
+        with file:
+            file.writelines(exportLines(db))
+    else:
+        file = open(args[0], "r", encoding="utf-8") if args else sys.stdin
+        with file:
+            result = importLines(db, file)
+        print(f"Added {result['added']} and updated {result['updated']} books, {result['failed']} failed")
+        for error in result["errors"]:
+            print(f"Line {error['line']}: {error['error']}")
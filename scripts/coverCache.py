@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+import collections
+import os
+import PIL.Image
+import tempfile
+import threading
+
+# The widths covers can be resized to, requests are rounded up to one of
+# these so there is a limited number of sizes to cache
+coverWidths = (80, 160, 240, 320, 400)
+
+# Output formats: extension -> (Pillow format, mimetype, save options)
+coverFormats = {
+    "jpg": ("JPEG", "image/jpeg", {"quality": 85, "optimize": True}),
+    "webp": ("WEBP", "image/webp", {"quality": 80, "method": 4}),
+    "avif": ("AVIF", "image/avif", {"quality": 60})
+}
+
+
+class coverCache:
+    def __init__(self, blobs, directory, maxBytes=256 * 1024 * 1024):
+        """Set up a disk cache of resized covers.
+
+        Covers are made from the full size cover in the blob store the first
+        time a size and format is asked for. When the cache is bigger than
+        maxBytes the least recently used covers are removed.
+
+        Worker processes share the directory, so each one looks at the
+        directory again after writing an eighth of maxBytes, counting the
+        covers the others made or removed, and the limit is for all of them.
+
+        Args:
+            blobs (blobStore): The blob store with the full size covers.
+            directory (str): The directory to cache covers in.
+            maxBytes (int): The most bytes to cache, default 256 MiB. (optional)"""
+        self.blobs = blobs
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+        for name in os.listdir(self.directory):
+            if name.endswith(".part"):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+        self.scan()
+
+    def scan(self):
+        """Rebuild the LRU order and size from the files in the directory and
+        their modified times. Call with the lock, or before the cache is used."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".part"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, name, stat.st_size))
+        self.files = collections.OrderedDict()
+        self.size = 0
+        for _, name, size in sorted(entries):
+            self.files[name] = size
+            self.size += size
+        self.written = 0
+
+    @staticmethod
+    def formats():
+        """Get the formats this Pillow install can save.
+
+        Returns:
+            list of str: The extensions of the supported formats."""
+        PIL.Image.init()
+        return [extension for extension, (pilFormat, _, _) in coverFormats.items()
+            if pilFormat in PIL.Image.SAVE]
+
+    @staticmethod
+    def roundWidth(width):
+        """Round a width up to the nearest width in coverWidths.
+
+        Args:
+            width (int): The requested width.
+        Returns:
+            int: The width to use."""
+        for coverWidth in coverWidths:
+            if width <= coverWidth:
+                return coverWidth
+        return coverWidths[-1]
+
+    def get(self, hash, width, extension):
+        """Get the path of a resized cover, making it if it isn't cached.
+
+        Args:
+            hash (str): The hash of the book's file.
+            width (int): The width wanted, rounded up with roundWidth.
+            extension (str): The format, a key of coverFormats.
+        Returns:
+            str: The path of the cover.
+            str: The mimetype of the cover.
+        Raises:
+            ValueError: If the hash or format isn't valid.
+            FileNotFoundError: If the book has no cover."""
+        if extension not in self.formats():
+            raise ValueError("Unsupported format.")
+        pilFormat, mimetype, options = coverFormats[extension]
+        width = self.roundWidth(width)
+        name = f"{hash}-{width}.{extension}"
+        path = os.path.join(self.directory, name)
+        sourcePath = self.blobs.path(hash, ".jpg")
+
+        with self.lock:
+            if name in self.files:
+                self.files.move_to_end(name)
+                try:
+                    os.utime(path)
+                    return path, mimetype
+                except FileNotFoundError:
+                    self.size -= self.files.pop(name)
+
+        with PIL.Image.open(sourcePath) as image:
+            height = round(image.height * width / image.width)
+            image = image.convert("RGB").resize((width, height), PIL.Image.LANCZOS)
+        fd, tempPath = tempfile.mkstemp(dir=self.directory, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                image.save(file, pilFormat, **options)
+            size = os.path.getsize(tempPath)
+            with self.lock:
+                os.replace(tempPath, path)
+                if name not in self.files:
+                    self.size += size
+                self.files[name] = size
+                self.files.move_to_end(name)
+                self.written += size
+                if self.written >= self.maxBytes // 8:
+                    self.scan()
+                self.evict()
+        finally:
+            if os.path.exists(tempPath):
+                os.remove(tempPath)
+        return path, mimetype
+
+    def evict(self):
+        """Remove the least recently used covers until the cache fits in
+        maxBytes, the most recent cover is always kept. Call with the lock."""
+        while self.size > self.maxBytes and len(self.files) > 1:
+            name, size = self.files.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+    def remove(self, hash):
+        """Remove every cached size of a cover.
+
+        Args:
+            hash (str): The hash of the book's file."""
+        with self.lock:
+            for name in [name for name in self.files if name.startswith(hash)]:
+                self.size -= self.files.pop(name)
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
@@ -1,35 +1,292 @@
 #!/usr/bin/env python3
 
-import bcrypt
-import hashlib
+import importlib.util
+import io
+import json
 import os
 import PIL.Image
+import queue
+import random
 import re
 import sqlite3
+import tempfile
+import threading
+import time
 import zipfile
 
+from scripts.blobStore import blobStore
+from scripts.coverCache import coverCache
+from scripts.epubCache import epubCache
+from scripts.lruCache import lruCache
+from scripts.passwordHasher import hasherBusy, passwordHasher
+from scripts.sqlTrace import sqlTracer
+from scripts.suggestIndex import suggestIndex
+
+# The columns read for a book, in the order bookSummary expects, with the
+# book's catalogues aggregated into a JSON array so one query gets it all
+bookColumns = """books.bookID, bookName, author, ISBN, publisher, publicationDate,
+    description, pageCount, language, genre, readingAge, fileHash,
+    (SELECT json_group_array(catalogueName) FROM (
+        SELECT catalogueName FROM bookCatalogueLink
+        INNER JOIN bookCatalogues ON bookCatalogueLink.catalogueID = bookCatalogues.catalogueID
+        WHERE bookCatalogueLink.bookID = books.bookID
+        ORDER BY bookCatalogueLinkID))"""
+
+
+class queryClock(threading.local):
+    """The seconds each thread has spent running SQL and the number of
+    statements it ran, so they can be reported for each request."""
+    seconds = 0.0
+    queries = 0
+
+    def reset(self):
+        """Start counting again from zero.
+
+        Returns:
+            float: The seconds counted before.
+            int: The statements counted before."""
+        seconds, queries = self.seconds, self.queries
+        self.seconds, self.queries = 0.0, 0
+        return seconds, queries
+
+
+queryTime = queryClock()
+
+
+class timedCursor(sqlite3.Cursor):
+    """A cursor that counts the time spent running and reading statements.
+
+    If its connection has a tracer, each statement is passed to it with the
+    seconds it took once all its rows were read, another statement was run
+    or the connection was closed."""
+    statement = None
+
+    def run(self, method, sql, parameters):
+        """Run and time a statement."""
+        tracer = self.connection.tracer
+        if self.statement is not None:
+            self.finishStatement()
+        start = time.perf_counter()
+        try:
+            return method(self, sql, parameters)
+        finally:
+            seconds = time.perf_counter() - start
+            queryTime.seconds += seconds
+            queryTime.queries += 1
+            if tracer is not None:
+                self.statement = [sql, parameters, seconds]
+                self.connection.tracedCursors.add(self)
+
+    def fetch(self, method, *args):
+        """Read and time rows, finishing the statement when there are no more."""
+        start = time.perf_counter()
+        rows = method(self, *args)
+        seconds = time.perf_counter() - start
+        queryTime.seconds += seconds
+        if self.statement is not None:
+            self.statement[2] += seconds
+            if not rows or method is sqlite3.Cursor.fetchall:
+                self.finishStatement()
+        return rows
+
+    def finishStatement(self):
+        """Pass the last statement to the connection's tracer."""
+        statement, self.statement = self.statement, None
+        if statement is not None and self.connection.tracer is not None:
+            self.connection.tracer.record(self.connection, *statement)
+
+    def execute(self, sql, parameters=()):
+        return self.run(sqlite3.Cursor.execute, sql, parameters)
+
+    def executemany(self, sql, parameters):
+        # The parameters may be a generator, so none are kept for tracing
+        self.run(sqlite3.Cursor.executemany, sql, parameters)
+        if self.statement is not None:
+            self.statement[1] = None
+        return self
+
+    def executescript(self, script):
+        start = time.perf_counter()
+        try:
+            return super().executescript(script)
+        finally:
+            queryTime.seconds += time.perf_counter() - start
+            queryTime.queries += 1
+
+    def fetchone(self):
+        return self.fetch(sqlite3.Cursor.fetchone)
+
+    def fetchmany(self, *args):
+        return self.fetch(sqlite3.Cursor.fetchmany, *args)
+
+    def fetchall(self):
+        return self.fetch(sqlite3.Cursor.fetchall)
+
+
+class pooledConnection(sqlite3.Connection):
+    """A connection that returns itself to its pool when closed."""
+    pool = None
+    tracer = None
+
+    def cursor(self, factory=timedCursor):
+        """Make a cursor, timed unless another factory is given."""
+        return super().cursor(factory)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            super().commit()
+            self.addedFiles.clear()
+        finally:
+            queryTime.seconds += time.perf_counter() - start
+
+    def rollback(self):
+        """Roll back, removing the files added to the blob store in the
+        transaction first, while no other transaction can use them."""
+        while self.addedFiles:
+            try:
+                os.remove(self.addedFiles.pop())
+            except FileNotFoundError:
+                pass
+        super().rollback()
+
+    def finishStatements(self):
+        """Pass statements whose rows weren't all read to the tracer."""
+        while self.tracedCursors:
+            self.tracedCursors.pop().finishStatement()
+
+    def close(self):
+        """Roll back anything uncommitted and hand the connection back to the
+        pool, or close it for real if the pool is full or not set."""
+        if self.tracer is not None:
+            self.finishStatements()
+        if self.in_transaction:
+            self.rollback()
+        if self.pool is None:
+            return super().close()
+        try:
+            self.pool.put_nowait(self)
+        except queue.Full:
+            super().close()
+
+    def release(self):
+        """Close the connection without returning it to the pool."""
+        if self.tracer is not None:
+            self.finishStatements()
+        if self.in_transaction:
+            self.rollback()
+        super().close()
+
 
 class database:
-    def __init__(self, directory, filename):
+    def __init__(self, directory, filename, poolSize=0, journalMode=None,
+            synchronous=None, cacheSize=None, mmapSize=None, busyTimeout=5000,
+            metadataCacheSize=1024, coverCacheBytes=256 * 1024 * 1024,
+            bcryptRounds=12, hashWorkers=0, maxPendingHashes=8,
+            slowQuerySeconds=None, slowQueryLog=None, checkChanges=False):
         """Set up database.
         
         Args:
             directory (str): The directory to store the database in.
-            filename (str): The name of the database file."""
+            filename (str): The name of the database file.
+            poolSize (int): The number of idle connections to keep open for
+                reuse, 0 opens a new connection every time. (optional)
+            journalMode (str): The journal mode, e.g. "WAL". (optional)
+            synchronous (str): The synchronous mode, e.g. "NORMAL". (optional)
+            cacheSize (int): The page cache size, negative for KiB. (optional)
+            mmapSize (int): The number of bytes to memory map. (optional)
+            busyTimeout (int): Milliseconds to wait for a lock, default 5000. (optional)
+            metadataCacheSize (int): The number of books to keep in the
+                getBookMetadata cache, default 1024. (optional)
+            coverCacheBytes (int): The most bytes of resized covers to keep,
+                in total for every process using dataDir, default 256 MiB. (optional)
+            bcryptRounds (int): The work factor for password hashes, default 12. (optional)
+            hashWorkers (int): Threads to hash passwords on, 0 hashes on the
+                calling thread. (optional)
+            maxPendingHashes (int): The most password hashes that can wait
+                for a hashWorkers thread, default 8. (optional)
+            slowQuerySeconds (float): Trace every statement, logging the
+                ones that take at least this long with their query plan,
+                default None to not trace. (optional)
+            slowQueryLog (str): A file to append slow statements to as JSON
+                Lines when tracing. (optional)
+            checkChanges (bool): Check if books were changed by another
+                process before using the metadata cache and suggestions,
+                for when other processes write to the database, default
+                False. (optional)"""
         self.directory = directory
         self.filename = os.path.join(self.directory, filename)
         os.makedirs(self.directory, exist_ok=True)
 
+        self.pool = queue.LifoQueue(poolSize) if poolSize > 0 else None
+        self.pragmas = [(pragma, value) for pragma, value in (
+            ("journal_mode", journalMode),
+            ("synchronous", synchronous),
+            ("cache_size", cacheSize),
+            ("mmap_size", mmapSize),
+            ("busy_timeout", busyTimeout)
+        ) if value is not None]
+        self.metadataCache = lruCache(metadataCacheSize)
+        self.blobs = blobStore(os.path.join(self.directory, "blobs"))
+        self.covers = coverCache(self.blobs, os.path.join(self.directory, "covers"), coverCacheBytes)
+        self.epubs = epubCache(self.blobs)
+        # Books without a cover show this, the server sets it to the fingerprinted URL
+        self.placeholderCoverURL = "/static/img/cover.jpg"
+        self.hasher = passwordHasher(bcryptRounds, hashWorkers, maxPendingHashes)
+        self.checkChanges = checkChanges
+        self.changeVersion = None
+        self.changeLock = threading.Lock()
+        self.suggestions = suggestIndex(self.suggestionBooks,
+            beforeSearch=self.syncCaches if checkChanges else None)
+        self.tracer = None
+        if slowQuerySeconds is not None:
+            self.tracer = sqlTracer(slowQuerySeconds, slowQueryLog)
+
     def connect(self):
         """Access the database.
+
+        If pooling is enabled an idle connection is reused when there is one,
+        calling close() on it returns it to the pool.
         
         Returns:
             con (sqlite3.Connection): The connection to the database.
             cur (sqlite3.Cursor): The cursor to the database."""
-        con = sqlite3.connect(self.filename)
+        con = None
+        if self.pool is not None:
+            try:
+                con = self.pool.get_nowait()
+            except queue.Empty:
+                pass
+        if con is None:
+            con = self.openConnection()
         cur = con.cursor()
         return con, cur
 
+    def openConnection(self):
+        """Open a new connection with the configured pragmas.
+
+        Returns:
+            sqlite3.Connection: The new connection."""
+        con = sqlite3.connect(self.filename, factory=pooledConnection,
+            check_same_thread=self.pool is None)
+        for pragma, value in self.pragmas:
+            con.execute(f"PRAGMA {pragma} = {value}")
+        con.pool = self.pool
+        con.tracer = self.tracer
+        con.tracedCursors = set()
+        con.addedFiles = []
+        return con
+
+    def closeConnections(self):
+        """Close all the idle connections in the pool."""
+        if self.pool is None:
+            return
+        while True:
+            try:
+                self.pool.get_nowait().release()
+            except queue.Empty:
+                break
+
     def executeScript(self, filename):
         """Execute a script file.
         
@@ -42,6 +299,57 @@ class database:
         con.commit()
         con.close()
 
+    def migrate(self, directory="migrations"):
+        """Bring the database up to date with the migration scripts.
+
+        Scripts are named "<version>-<description>.sql" and each one that is
+        newer than the database's user_version is run in its own transaction,
+        then the query planner statistics are refreshed. Migrations that need
+        more than SQL can be "<version>-<description>.py" files with a
+        migrate(db, cur) function, which must be safe to run again if they
+        are interrupted.
+
+        Args:
+            directory (str): The directory of migration scripts.
+        Returns:
+            int: The schema version of the database."""
+        directory = os.path.join(os.path.dirname(__file__), directory)
+        migrations = sorted((int(name.split("-")[0]), name)
+            for name in os.listdir(directory) if name.endswith((".sql", ".py")))
+
+        con, cur = self.connect()
+        version = startVersion = cur.execute("PRAGMA user_version").fetchone()[0]
+        try:
+            for migrationVersion, name in migrations:
+                if migrationVersion <= version:
+                    continue
+                path = os.path.join(directory, name)
+                if name.endswith(".py"):
+                    spec = importlib.util.spec_from_file_location(
+                        f"migration{migrationVersion}", path)
+                    module = importlib.util.module_from_spec(spec)
+                    spec.loader.exec_module(module)
+                    cur.execute("BEGIN")
+                    module.migrate(self, cur)
+                    cur.execute(f"PRAGMA user_version = {migrationVersion}")
+                    con.commit()
+                else:
+                    with open(path, "r") as f:
+                        script = f.read()
+                    cur.executescript("BEGIN;\n" + script +
+                        f"\nPRAGMA user_version = {migrationVersion};\nCOMMIT;")
+                version = migrationVersion
+            if version != startVersion:
+                cur.execute("ANALYZE")
+                con.commit()
+        except sqlite3.Error:
+            if con.in_transaction:
+                con.rollback()
+            raise
+        finally:
+            con.close()
+        return version
+
     def addUser(self, email, password):
         """Add a user to the database.
         
@@ -49,7 +357,7 @@ class database:
             email (str): The email of the user.
             password (str): The password of the user."""
         email = email.lower()
-        hashedPassword = bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt())
+        hashedPassword = self.hasher.hash(password)
         con, cur = self.connect()
         try:
             cur.execute(
@@ -61,8 +369,33 @@ class database:
             raise sqlite3.IntegrityError("Invalid argument.")
         con.close()
 
+    def addUsers(self, emails, password):
+        """Add many users with the same password in one transaction, which
+        is only hashed once, e.g. to generate test data.
+
+        Args:
+            emails (list of str): The emails of the users.
+            password (str): The password of every user.
+        Returns:
+            int: The number of users added, emails already used are skipped."""
+        hashedPassword = self.hasher.hash(password)
+        con, cur = self.connect()
+        try:
+            cur.execute("BEGIN IMMEDIATE")
+            before = con.total_changes
+            cur.executemany("INSERT OR IGNORE INTO users (email, passwordHash) VALUES (?, ?)",
+                ((email.lower(), hashedPassword) for email in emails))
+            added = con.total_changes - before
+            con.commit()
+        finally:
+            con.close()
+        return added
+
     def checkUser(self, email, password):
         """Check if a user exists in the database.
+
+        If the password is right but was hashed with a different work factor
+        it is hashed again with the current one.
         
         Args:
             email (str): The email of the user.
@@ -84,9 +417,32 @@ class database:
         except sqlite3.OperationalError:
             result = None
         con.close()
-        if result and bcrypt.checkpw(password.encode("utf-8"), result[1]):
-                return (True, result[2] >= 1, result[2] >= 2, result[0])
+        if result and self.hasher.check(password, result[1]):
+            if self.hasher.needsRehash(result[1]):
+                try:
+                    self.updatePasswordHash(result[0], result[1], self.hasher.hash(password))
+                except hasherBusy:
+                    pass
+            return (True, result[2] >= 1, result[2] >= 2, result[0])
         return (False,)
+
+    def updatePasswordHash(self, userID, oldHash, newHash):
+        """Replace a user's password hash, unless it was changed meanwhile.
+
+        Args:
+            userID (int): The ID of the user.
+            oldHash (bytes): The hash that is being replaced.
+            newHash (bytes): The new hash."""
+        con, cur = self.connect()
+        try:
+            cur.execute("""
+                UPDATE users SET passwordHash = ?
+                WHERE userID = ? AND passwordHash = ?""",
+                (newHash, userID, oldHash))
+            con.commit()
+        except sqlite3.OperationalError:
+            con.rollback()
+        con.close()
     
     def getUserByID(self, userID):
         """Get a user's details by their ID.
@@ -124,6 +480,7 @@ class database:
         con, cur = self.connect()
         try:
             cur.execute("DELETE FROM users WHERE userID = ?", (userID,))
+            cur.execute("DELETE FROM sessions WHERE userID = ?", (userID,))
             con.commit()
         except sqlite3.OperationalError:
             con.rollback()
@@ -154,6 +511,7 @@ class database:
                 raise ValueError("Required argument not provided.")
         con, cur = self.connect()
         try:
+            before = self.beginBookWrite(cur)
             cur.execute("""
                 INSERT INTO books (
                     bookName, author, ISBN, publisher, publicationDate,
@@ -171,21 +529,295 @@ class database:
                     ) VALUES ( ?,
                         (SELECT catalogueID FROM bookCatalogues WHERE catalogueName = ?)
                     )""", (bookID, catalogue))
+            after = self.changeCount(cur)
             con.commit()
         except sqlite3.OperationalError:
             con.rollback()
             con.close()
             raise ValueError("Invalid argument.")
         con.close()
+        self.suggestions.setBook(bookID, title, author, catalogues)
+        self.ownChanges(before, after)
         return bookID
     
+    def addBooks(self, books, cur=None):
+        """Add many books at once, with batched inserts in one transaction.
+
+        Books whose ISBN is already used, or that are missing a title,
+        author or ISBN, are skipped and their files removed.
+
+        Args:
+            books(list of dict): The addBookMetadata arguments of each book,
+                with "file" as (temporary path, hash) of its EPUB and "cover"
+                as the temporary path of its cover from blobStore. (optional)
+            cur(sqlite3.Cursor): A cursor with an open write transaction to
+                add the books in, otherwise one is made. (optional)
+        Returns:
+            list of str: The error for each book, None if it was added."""
+        con = before = after = None
+        if cur is None:
+            con, cur = self.connect()
+            before = self.beginBookWrite(cur)
+        errors = [None] * len(books)
+        added = []
+        try:
+            isbns = [book.get("isbn") for book in books]
+            existing = set()
+            for start in range(0, len(isbns), 500):
+                chunk = isbns[start:start + 500]
+                cur.execute(f"SELECT ISBN FROM books WHERE ISBN IN ({', '.join('?' * len(chunk))})", chunk)
+                existing.update(isbn for (isbn,) in cur.fetchall())
+
+            rows, links = [], []
+            for index, book in enumerate(books):
+                if not (book.get("title") and book.get("author") and book.get("isbn")):
+                    errors[index] = "Required argument not provided."
+                    continue
+                if book["isbn"] in existing:
+                    errors[index] = "ISBN already exists."
+                    continue
+                existing.add(book["isbn"])
+                added.append(book)
+                rows.append((book["title"], book["author"], book["isbn"],
+                    book.get("publisher"), book.get("publicationDate"),
+                    book.get("description"), book.get("pageCount"), book.get("language"),
+                    book.get("genre"), book.get("readingAge"),
+                    book["file"][1] if book.get("file") else None))
+                links.extend((book["isbn"], catalogue)
+                    for catalogue in dict.fromkeys(book.get("catalogues", [])))
+
+            cur.executemany("""
+                INSERT INTO books (
+                    bookName, author, ISBN, publisher, publicationDate, description,
+                    pageCount, language, genre, readingAge, fileHash
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", rows)
+            cur.executemany("INSERT OR IGNORE INTO bookCatalogues (catalogueName) VALUES (?)",
+                [(catalogue,) for catalogue in dict.fromkeys(catalogue for _, catalogue in links)])
+            cur.executemany("""
+                INSERT INTO bookCatalogueLink (bookID, catalogueID)
+                SELECT bookID, catalogueID FROM books, bookCatalogues
+                WHERE ISBN = ? AND catalogueName = ?""", links)
+
+            for book in added:
+                if book.get("file"):
+                    tempPath, hash = book["file"]
+                    self.addBlob(cur, tempPath, hash, ".epub")
+                    if book.get("cover"):
+                        self.addBlob(cur, book["cover"], hash, ".jpg")
+            if con:
+                after = self.changeCount(cur)
+                con.commit()
+        except sqlite3.Error:
+            if con:
+                con.rollback()
+            raise
+        else:
+            if added:
+                self.suggestions.invalidate()
+            self.ownChanges(before, after)
+        finally:
+            # Remove the files of books that weren't added
+            for book in books:
+                tempPaths = [book["file"][0] if book.get("file") else None, book.get("cover")]
+                for tempPath in tempPaths:
+                    if tempPath and os.path.exists(tempPath):
+                        os.remove(tempPath)
+            if con:
+                con.close()
+        return errors
+
+    def suggestionBooks(self):
+        """Get the text of every book for the suggestions index.
+
+        Returns:
+            list of tuple: The bookID, title, author and catalogues of each book."""
+        con, cur = self.connect()
+        cur.execute("""
+            SELECT books.bookID, bookName, author, (SELECT json_group_array(catalogueName)
+                FROM bookCatalogueLink INNER JOIN bookCatalogues
+                    ON bookCatalogueLink.catalogueID = bookCatalogues.catalogueID
+                WHERE bookCatalogueLink.bookID = books.bookID)
+            FROM books""")
+        books = [(bookID, title, author, json.loads(catalogues))
+            for bookID, title, author, catalogues in cur.fetchall()]
+        con.close()
+        return books
+
+    def exportBooks(self, batchSize=500):
+        """Read every book's metadata in bookID order, a batch at a time.
+
+        Each batch is read with its own short query, so the export never
+        holds the catalogue in memory or keeps a read transaction open.
+
+        Args:
+            batchSize(int): The number of books to read per query, default 500. (optional)
+        Yields:
+            dict: The addBookMetadata arguments of a book and its fileHash."""
+        lastBookID = 0
+        while True:
+            con, cur = self.connect()
+            cur.execute("SELECT " + bookColumns + """ FROM books
+                WHERE bookID > ? ORDER BY bookID LIMIT ?""", (lastBookID, batchSize))
+            results = cur.fetchall()
+            con.close()
+            for result in results:
+                yield {
+                    "title": result[1],
+                    "author": result[2],
+                    "isbn": result[3],
+                    "publisher": result[4],
+                    "publicationDate": result[5],
+                    "description": result[6],
+                    "pageCount": result[7],
+                    "language": result[8],
+                    "genre": result[9],
+                    "readingAge": result[10],
+                    "catalogues": json.loads(result[12]),
+                    "fileHash": result[11]
+                }
+            if len(results) < batchSize:
+                return
+            lastBookID = results[-1][0]
+
+    def importBooks(self, books):
+        """Add or replace books by ISBN in one transaction.
+
+        The book's metadata and catalogues are replaced with the ones given,
+        the last one is used if an ISBN is given more than once. Its fileHash
+        is only set if the file is in the blob store.
+
+        Args:
+            books(list of dict): The metadata of each book from exportBooks.
+        Returns:
+            dict: The number of books "added" and "updated", and "errors"
+                with the error for each book, None if it was imported."""
+        errors = [None] * len(books)
+        imports = {}
+        for index, book in enumerate(books):
+            if not all(isinstance(book.get(field), str) and book[field]
+                    for field in ("title", "author", "isbn")):
+                errors[index] = "Required argument not provided."
+                continue
+            catalogues = book.get("catalogues", [])
+            if not isinstance(catalogues, list) or not all(
+                    isinstance(catalogue, str) for catalogue in catalogues) or not all(
+                    isinstance(book.get(field), (str, int, float, type(None)))
+                    for field in ("publisher", "publicationDate", "description",
+                        "pageCount", "language", "genre", "readingAge")):
+                errors[index] = "Invalid argument."
+                continue
+            fileHash = book.get("fileHash")
+            if not (isinstance(fileHash, str) and self.blobs.isHash(fileHash)
+                    and os.path.exists(self.blobs.path(fileHash, ".epub"))):
+                fileHash = None
+            # Move a repeated ISBN to where it was last given
+            imports.pop(book["isbn"], None)
+            imports[book["isbn"]] = ((book["title"], book["author"], book["isbn"],
+                book.get("publisher"), book.get("publicationDate"),
+                book.get("description"), book.get("pageCount"), book.get("language"),
+                book.get("genre"), book.get("readingAge"), fileHash), catalogues)
+        isbns = list(imports)
+        rows = [row for row, _ in imports.values()]
+        links = [(isbn, catalogue) for isbn, (_, catalogues) in imports.items()
+            for catalogue in dict.fromkeys(catalogues)]
+
+        con, cur = self.connect()
+        try:
+            cur.execute("BEGIN IMMEDIATE")
+            # The books being replaced and the catalogues they are in now,
+            # which are removed below if no book is left in them
+            existing, unlinked = set(), set()
+            for start in range(0, len(isbns), 500):
+                chunk = isbns[start:start + 500]
+                cur.execute(f"""
+                    SELECT ISBN, catalogueID FROM books LEFT JOIN bookCatalogueLink USING (bookID)
+                    WHERE ISBN IN ({', '.join('?' * len(chunk))})""", chunk)
+                for isbn, catalogueID in cur.fetchall():
+                    existing.add(isbn)
+                    if catalogueID is not None:
+                        unlinked.add(catalogueID)
+
+            cur.executemany("""
+                INSERT INTO books (
+                    bookName, author, ISBN, publisher, publicationDate, description,
+                    pageCount, language, genre, readingAge, fileHash
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (ISBN) DO UPDATE SET
+                    bookName = excluded.bookName,
+                    author = excluded.author,
+                    publisher = excluded.publisher,
+                    publicationDate = excluded.publicationDate,
+                    description = excluded.description,
+                    pageCount = excluded.pageCount,
+                    language = excluded.language,
+                    genre = excluded.genre,
+                    readingAge = excluded.readingAge,
+                    fileHash = COALESCE(excluded.fileHash, fileHash)""", rows)
+            cur.executemany("""
+                DELETE FROM bookCatalogueLink
+                WHERE bookID = (SELECT bookID FROM books WHERE ISBN = ?)""",
+                [(isbn,) for isbn in existing])
+            cur.executemany("INSERT OR IGNORE INTO bookCatalogues (catalogueName) VALUES (?)",
+                [(catalogue,) for catalogue in dict.fromkeys(catalogue for _, catalogue in links)])
+            cur.executemany("""
+                INSERT INTO bookCatalogueLink (bookID, catalogueID)
+                SELECT bookID, catalogueID FROM books, bookCatalogues
+                WHERE ISBN = ? AND catalogueName = ?""", links)
+            cur.executemany("""
+                DELETE FROM bookCatalogues WHERE catalogueID = ?1
+                AND NOT EXISTS (SELECT 1 FROM bookCatalogueLink WHERE catalogueID = ?1)""",
+                [(catalogueID,) for catalogueID in unlinked])
+            con.commit()
+        except sqlite3.Error:
+            con.rollback()
+            raise
+        finally:
+            con.close()
+            self.metadataCache.clear()
+            self.suggestions.invalidate()
+
+        return {"added": len(isbns) - len(existing), "updated": len(existing), "errors": errors}
+
+    def importedFiles(self, directory):
+        """Get the files in a directory that were imported by bulkImport.
+
+        Args:
+            directory(str): The directory that was imported.
+        Returns:
+            dict: The (size, modified time) of each imported file by path."""
+        prefix = os.path.join(directory, "")
+        con, cur = self.connect()
+        cur.execute("""
+            SELECT path, size, modified FROM bookImports
+            WHERE path >= ? AND path < ? AND error IS NULL""",
+            (prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)))
+        result = {path: (size, modified) for path, size, modified in cur.fetchall()}
+        con.close()
+        return result
+
+    def recordImports(self, files, cur):
+        """Record the outcome of importing files so imports can resume.
+
+        Args:
+            files(list of dict): The "path", "size", "modified", "isbn" and
+                "error" of each file, error is None if it was imported.
+            cur(sqlite3.Cursor): A cursor with an open transaction."""
+        cur.executemany("""
+            INSERT OR REPLACE INTO bookImports (path, size, modified, bookID, error)
+            VALUES (?1, ?2, ?3, CASE WHEN ?5 IS NULL THEN
+                (SELECT bookID FROM books WHERE ISBN = ?4) END, ?5)""",
+            [(file["path"], file["size"], file["modified"], file.get("isbn"), file.get("error"))
+                for file in files])
+
     def updateBookMetadata(self, bookID, title=None, author=None, isbn=None,
                            publisher=None, publicationDate=None, description=None,
                            pageCount=None, language=None, genre=None,
                            readingAge=None, catalogues=[]):
         """Edit book metadata in the database."""
+        before = after = None
         con, cur = self.connect()
         try:
+            before = self.beginBookWrite(cur)
             cur.execute("""
                 UPDATE books SET
                     bookName = COALESCE(?, bookName),
@@ -211,85 +843,143 @@ class database:
                     ) VALUES ( ?,
                         (SELECT catalogueID FROM bookCatalogues WHERE catalogueName = ?)
                     )""", (bookID, catalogue))
+            book = cur.execute("SELECT bookName, author FROM books WHERE bookID = ?", (bookID,)).fetchone()
+            after = self.changeCount(cur)
             con.commit()
+            if book:
+                self.suggestions.setBook(bookID, book[0], book[1], catalogues)
         except sqlite3.OperationalError:
             con.rollback()
+            after = None
         con.close()
+        self.metadataCache.invalidate(bookID)
+        self.ownChanges(before, after)
     
     def getBookMetadata(self, bookID):
         """Get book metadata from the database.
 
+        Books are cached until they are changed with updateBookMetadata,
+        addFile or deleteBook, or by another process with checkChanges.
+
         Args:
             bookID(int): The ID of the book.
         Returns:
             dict: The book's metadata."""
+        if self.checkChanges:
+            self.syncCaches()
+        book = self.metadataCache.get(bookID)
+        if book is None:
+            version = self.metadataCache.version
+            book = self.getBooksMetadata([bookID]).get(bookID)
+            if book is None:
+                raise ValueError("404: Book does not exist.")
+            self.metadataCache.set(bookID, book, version)
+        return dict(book, catalogues=list(book["catalogues"]))
+
+    def syncCaches(self):
+        """Clear the metadata cache and rebuild the suggestions if the books
+        were changed since this was last called, by any process.
+
+        Triggers count every change to books and their catalogues in the
+        changeCounters table, so this is one primary key lookup."""
         con, cur = self.connect()
         try:
-            cur.execute("""
-                SELECT bookName, author, ISBN, publisher, publicationDate,
-                    description, pageCount, language, genre, readingAge, fileHash
-                FROM books WHERE bookID = ?""", (bookID,))
-            result = cur.fetchone()
-            if result:
-                cur.execute("""
-                    SELECT catalogueName
-                    FROM bookCatalogues
-                    INNER JOIN bookCatalogueLink ON bookCatalogues.catalogueID = bookCatalogueLink.catalogueID
-                    WHERE bookID = ?""", (bookID,))
-                catalogues = [catalogue[0] for catalogue in cur.fetchall()]
+            version = cur.execute("SELECT version FROM changeCounters WHERE name = 'books'").fetchone()
         except sqlite3.OperationalError:
-            result = None
+            version = None
         con.close()
-        if result:
-            book = {
-                "bookID": bookID,
-                "title": result[0],
-                "author": result[1],
-                "isbn": result[2],
-                "publisher": result[3],
-                "publicationDate": result[4],
-                "description": result[5],
-                "pageCount": result[6],
-                "language": result[7],
-                "genre": result[8],
-                "readingAge": result[9],
-                "catalogues": catalogues,
-                "fileURL": None,
-                "coverURL": "/static/img/cover.jpg"
-            }
+        if version is None:
+            return
+        with self.changeLock:
+            if version[0] == self.changeVersion:
+                return
+            self.changeVersion = version[0]
+        self.metadataCache.clear()
+        self.suggestions.invalidate()
+
+    def beginBookWrite(self, cur):
+        """Start a write transaction that changes books.
+
+        Args:
+            cur(sqlite3.Cursor): The cursor to start it on.
+        Returns:
+            int: The change counter before the write with checkChanges, otherwise None."""
+        cur.execute("BEGIN IMMEDIATE")
+        return self.changeCount(cur)
+
+    def changeCount(self, cur):
+        """Get the number of changes to books, in the cursor's transaction.
 
-            if result[10]:
-                book["fileURL"] = "/books/file/" + result[10] + ".epub"
-                book["coverURL"] = "/books/cover/" + result[10] + ".jpg"
+        Returns:
+            int: The change counter with checkChanges, otherwise None."""
+        if not self.checkChanges:
+            return None
+        result = cur.execute("SELECT version FROM changeCounters WHERE name = 'books'").fetchone()
+        return result[0] if result else None
+
+    def ownChanges(self, before, after):
+        """Note that only this process changed books between two counts,
+        after it updated its caches, so syncCaches doesn't clear them. If
+        another process changed books first they are still cleared.
+
+        Args:
+            before(int): The change counter when the write started.
+            after(int): The change counter when the write committed."""
+        if before is None or after is None:
+            return
+        with self.changeLock:
+            if self.changeVersion == before:
+                self.changeVersion = after
+
+    def getBooksMetadata(self, bookIDs):
+        """Get the metadata for several books in one query, bypassing the cache.
 
-            return book
-        raise ValueError("404: Book does not exist.")
+        Args:
+            bookIDs(list of int): The IDs of the books.
+        Returns:
+            dict: The metadata of the books that exist, by bookID."""
+        bookIDs = list(bookIDs)
+        con, cur = self.connect()
+        try:
+            cur.execute("SELECT " + bookColumns + " FROM books WHERE bookID IN (" +
+                ", ".join("?" * len(bookIDs)) + ")", bookIDs)
+            results = cur.fetchall()
+        except sqlite3.OperationalError:
+            results = []
+        con.close()
+
+        books = {}
+        for result in results:
+            book = self.bookSummary(result)
+            book["fileURL"] = "/books/file/" + result[11] + ".epub" if result[11] else None
+            books[book["bookID"]] = book
+        return books
     
     def deleteBook(self, bookID):
-        """Delete book metadata from the database.
+        """Delete book metadata from the database, its file is removed once
+        no other book uses it.
 
         Args:
             bookID(int): The ID of the book."""
+        before = after = None
         con, cur = self.connect()
         try:
-            cur.execute("SELECT fileHash FROM books WHERE bookID = ?", (bookID,))
-            fileHash = cur.fetchone()[0]
-            if fileHash:
-                try:
-                    os.remove(os.path.join(self.directory, fileHash + ".epub"))
-                    os.remove(os.path.join(self.directory, fileHash + ".jpg"))
-                except FileNotFoundError:
-                    pass
-            
+            before = self.beginBookWrite(cur)
             cur.execute("DELETE FROM books WHERE bookID = ?", (bookID,))
             cur.execute("DELETE FROM bookCatalogueLink WHERE bookID = ?", (bookID,))
             cur.execute("DELETE FROM bookCatalogues WHERE catalogueID NOT IN (SELECT catalogueID FROM bookCatalogueLink)")
+            after = self.changeCount(cur)
             con.commit()
             con.close()
         except sqlite3.OperationalError:
+            after = None
             con.close()
+        self.metadataCache.invalidate(bookID)
+        self.suggestions.removeBook(bookID)
+        self.ownChanges(before, after)
+        self.collectGarbage()
 
-    def searchBooks(self, query="", genre=None, language=None, catalogue=None, offset=0, limit=10, sort="bookName"):
+    def searchBooks(self, query="", genre=None, language=None, catalogue=None, offset=0, limit=10, sort="bookName", after=None):
         """Search for books in the database.
 
         Args:
@@ -299,65 +989,592 @@ class database:
             catalogue(str): The catalogue to limit the search to. (optional)
             offset(int): The offset to start at, default 0. (optional)
             limit(int): The maximum number of results to return, default 10. (optional)
+            sort(str): The column to sort by, or "relevance" to rank matches
+                to the query with bm25, default "bookName". (optional)
+            after(tuple): The sortKey and bookID of the last book on the
+                previous page, results start after it. (optional)
         Returns:
-            list of dict: The books that match the search."""
+            list of dict: The books that match the search, each with the
+                sortKey it was ordered by."""
+        matchQuery = self.ftsQuery(query)
+        if sort == "relevance" and not matchQuery:
+            sort = "bookName"
+
         con, cur = self.connect()
-        sql = """
-            SELECT DISTINCT books.bookID, bookName, author, ISBN, publisher, publicationDate,
-                description, pageCount, language, genre, readingAge, fileHash
-            FROM books  LEFT JOIN bookCatalogueLink ON books.bookID = bookCatalogueLink.bookID
-                        LEFT JOIN bookCatalogues ON bookCatalogueLink.catalogueID = bookCatalogues.catalogueID
-            WHERE   (bookName LIKE ? OR author LIKE ? OR description LIKE ?) """
-        values = ("%" + query + "%", "%" + query + "%", "%" + query + "%")
+        filterSQL, values = self.searchFilter(matchQuery, genre, language, catalogue)
+        sql = "SELECT " + bookColumns + ", " + sort + " AS sortKey FROM books " + filterSQL
 
-        if genre is not None:
-            sql += " AND genre LIKE ? "
-            values += (genre,)
-        if language is not None:
-            sql += " AND language LIKE ? "
-            values += (language,)
-        if catalogue is not None:
-            sql += " AND bookCatalogues.catalogueName LIKE ? "
-            values += (catalogue,)
+        if after is not None:
+            sql += " AND (" + sort + ", books.bookID) > (?, ?) "
+            values += tuple(after)
 
-        sql += " ORDER BY " + sort + " LIMIT ? OFFSET ?"
+        sql += " ORDER BY sortKey, books.bookID LIMIT ? OFFSET ?"
         values += (limit, offset)
         try:
             cur.execute(sql, values)
         
             results = []
             for result in cur.fetchall():
-                results.append({
-                    "bookID": result[0],
-                    "title": result[1],
-                    "author": result[2],
-                    "isbn": result[3],
-                    "publisher": result[4],
-                    "publicationDate": result[5],
-                    "description": result[6],
-                    "pageCount": result[7],
-                    "language": result[8],
-                    "genre": result[9],
-                    "readingAge": result[10],
-                    "coverURL": "/static/img/cover.jpg" if not result[11] else "/books/cover/" + result[11] + ".jpg"
-                })
+                results.append(dict(self.bookSummary(result), sortKey=result[13]))
             con.close()
             return results
         except sqlite3.OperationalError:
             con.close()
+
+    @staticmethod
+    def searchFilter(matchQuery="", genre=None, language=None, catalogue=None):
+        """Build the joins and WHERE clause that pick the books in a search.
+
+        Args:
+            matchQuery(str): The FTS5 match expression from ftsQuery. (optional)
+            genre(str): The genre to limit the search to. (optional)
+            language(str): The language to limit the search to. (optional)
+            catalogue(str): The catalogue to limit the search to. (optional)
+        Returns:
+            str: The SQL to follow "FROM books", with a relevance column if
+                there is a matchQuery.
+            tuple: The values for the SQL."""
+        values = ()
+        if matchQuery:
+            sql = """ INNER JOIN (
+                    SELECT rowid AS matchID, bm25(booksSearch, 10.0, 5.0, 1.0) AS relevance
+                    FROM booksSearch WHERE booksSearch MATCH ?
+                ) AS matches ON books.bookID = matches.matchID
+                WHERE 1 """
+            values += (matchQuery,)
+        else:
+            sql = " WHERE 1 "
+
+        if genre is not None:
+            sql += " AND genre = ? COLLATE NOCASE "
+            values += (genre,)
+        if language is not None:
+            sql += " AND language = ? COLLATE NOCASE "
+            values += (language,)
+        if catalogue is not None:
+            sql += """ AND books.bookID IN (
+                SELECT bookID FROM bookCatalogueLink
+                INNER JOIN bookCatalogues ON bookCatalogueLink.catalogueID = bookCatalogues.catalogueID
+                WHERE catalogueName = ? COLLATE NOCASE) """
+            values += (catalogue,)
+        return sql, values
+
+    def bookFacets(self, query="", genre=None, language=None, catalogue=None, limit=20):
+        """Count the books in a search with each genre, language and catalogue.
+
+        Without a query or filters the counts are read from the bookFacets
+        table, which triggers keep up to date, otherwise they are counted
+        from the books in the search.
+
+        Args:
+            query(str): The query to search for. (optional)
+            genre(str): The genre to limit the search to. (optional)
+            language(str): The language to limit the search to. (optional)
+            catalogue(str): The catalogue to limit the search to. (optional)
+            limit(int): The most values to return per facet, default 20. (optional)
+        Returns:
+            dict: For "genre", "language" and "catalogue", a list of the
+                values with the most books, as dicts with "value" and "count"."""
+        matchQuery = self.ftsQuery(query)
+        con, cur = self.connect()
+        if not matchQuery and genre is None and language is None and catalogue is None:
+            sql = """
+                SELECT facet, value, count FROM (
+                    SELECT facet, value, count, ROW_NUMBER() OVER (
+                        PARTITION BY facet ORDER BY count DESC, value) AS rank
+                    FROM bookFacets WHERE count > 0)
+                WHERE rank <= ?"""
+            values = (limit,)
+        else:
+            filterSQL, values = self.searchFilter(matchQuery, genre, language, catalogue)
+            sql = """
+                WITH matches AS (SELECT books.bookID, genre, language FROM books """ + filterSQL + """),
+                counts AS (
+                    SELECT 'genre' AS facet, MIN(genre) AS value, COUNT(*) AS count FROM matches
+                    WHERE genre IS NOT NULL GROUP BY genre COLLATE NOCASE
+                    UNION ALL
+                    SELECT 'language', MIN(language), COUNT(*) FROM matches
+                    WHERE language IS NOT NULL GROUP BY language COLLATE NOCASE
+                    UNION ALL
+                    SELECT 'catalogue', MIN(catalogueName), COUNT(*) FROM matches
+                    INNER JOIN bookCatalogueLink ON bookCatalogueLink.bookID = matches.bookID
+                    INNER JOIN bookCatalogues ON bookCatalogueLink.catalogueID = bookCatalogues.catalogueID
+                    GROUP BY catalogueName COLLATE NOCASE)
+                SELECT facet, value, count FROM (
+                    SELECT facet, value, count, ROW_NUMBER() OVER (
+                        PARTITION BY facet ORDER BY count DESC, value) AS rank
+                    FROM counts)
+                WHERE rank <= ?"""
+            values += (limit,)
+        try:
+            cur.execute(sql, values)
+            results = cur.fetchall()
+        except sqlite3.OperationalError:
+            results = []
+        con.close()
+
+        facets = {"genre": [], "language": [], "catalogue": []}
+        for facet, value, count in sorted(results, key=lambda result: (-result[2], result[1])):
+            facets[facet].append({"value": value, "count": count})
+        return facets
+
+    def randomBooks(self, count=4):
+        """Pick random books without sorting the whole table.
+
+        Random bookIDs between the lowest and highest are looked up through
+        the primary key, a missing ID from a deleted book moves on to the
+        next book after it.
+
+        Args:
+            count(int): The number of books to pick, default 4. (optional)
+        Returns:
+            list of dict: The books, in the same format as searchBooks."""
+        con, cur = self.connect()
+        try:
+            # Read the bounds and the books in one transaction, so a book
+            # deleted in between can't leave nothing after a random ID
+            cur.execute("BEGIN")
+            cur.execute("SELECT MIN(bookID), MAX(bookID) FROM books")
+            lowest, highest = cur.fetchone()
+            if lowest is None:
+                results = []
+            elif highest - lowest < count * 4:
+                cur.execute("SELECT " + bookColumns + """ FROM books
+                    WHERE bookID BETWEEN ? AND ? ORDER BY RANDOM() LIMIT ?""",
+                    (lowest, highest, count))
+                results = cur.fetchall()
+            else:
+                found = {}
+                for _ in range(count * 4):
+                    cur.execute("SELECT " + bookColumns + """ FROM books
+                        WHERE bookID >= ? ORDER BY bookID LIMIT 1""",
+                        (random.randint(lowest, highest),))
+                    result = cur.fetchone()
+                    if result is None:
+                        continue
+                    found[result[0]] = result
+                    if len(found) == count:
+                        break
+                results = list(found.values())
+        except sqlite3.OperationalError:
+            results = []
+        if con.in_transaction:
+            con.rollback()
+        con.close()
+        return [self.bookSummary(result) for result in results]
+
+    def bookSummary(self, result):
+        """Make the dict for a book from a row of bookColumns.
+
+        Args:
+            result(tuple): The row.
+        Returns:
+            dict: The book's details."""
+        return {
+            "bookID": result[0],
+            "title": result[1],
+            "author": result[2],
+            "isbn": result[3],
+            "publisher": result[4],
+            "publicationDate": result[5],
+            "description": result[6],
+            "pageCount": result[7],
+            "language": result[8],
+            "genre": result[9],
+            "readingAge": result[10],
+            "catalogues": json.loads(result[12]),
+            "coverURL": self.placeholderCoverURL if not result[11] else "/books/cover/" + result[11] + ".jpg"
+        }
+
+    @staticmethod
+    def ftsQuery(query):
+        """Turn a search box query into an FTS5 match expression.
+
+        Every word is quoted so it can't be read as FTS5 syntax and is
+        matched as a prefix, all words have to match.
+
+        Args:
+            query(str): The query typed by the user.
+        Returns:
+            str: The match expression, empty if there are no words."""
+        return " ".join('"' + word.replace('"', '""') + '"*'
+            for word in re.findall(r"\w+", query or ""))
+
+    def backfillSearchIndex(self):
+        """Index books that were added before the search index existed.
+
+        Only rebuilds the index when the number of indexed books doesn't
+        match the books table, so it is cheap to call on every start up."""
+        con, cur = self.connect()
+        try:
+            cur.execute("SELECT COUNT(*) FROM booksSearch_docsize")
+            indexed = cur.fetchone()[0]
+            cur.execute("SELECT COUNT(*) FROM books")
+            if indexed != cur.fetchone()[0]:
+                cur.execute("INSERT INTO booksSearch (booksSearch) VALUES ('rebuild')")
+                con.commit()
+        except sqlite3.OperationalError:
+            con.rollback()
+        con.close()
     
     def addFile(self, bookID, file):
         """Save the file and update the database.
 
+        The file is copied in chunks into the blob store while it is hashed,
+        so memory use doesn't grow with the file's size and a failed upload
+        doesn't leave a partial file behind. A file that is already stored is
+        shared instead of saved again. The cover is made later by a
+        "deriveAssets" job.
+
+        Args:
+            bookID(int): The ID of the book.
+            file(file or bytes): The file to save, e.g. an upload's stream."""
+        if isinstance(file, bytes):
+            file = io.BytesIO(file)
+
+        tempPath, hash = self.blobs.write(file)
+        try:
+            if not zipfile.is_zipfile(tempPath):
+                raise ValueError("Invalid EPUB file.")
+            con, cur = self.connect()
+            try:
+                before = self.beginBookWrite(cur)
+                cur.execute("UPDATE books SET fileHash = ? WHERE bookID = ?", (hash, bookID))
+                if cur.rowcount == 0:
+                    raise ValueError("Book does not exist.")
+                self.addBlob(cur, tempPath, hash, ".epub")
+                if not os.path.exists(self.blobs.path(hash, ".jpg")):
+                    self.queueJob("deriveAssets", hash, {"hash": hash}, cur=cur)
+                after = self.changeCount(cur)
+                con.commit()
+            finally:
+                con.close()
+        finally:
+            if os.path.exists(tempPath):
+                os.remove(tempPath)
+            self.metadataCache.invalidate(bookID)
+        self.ownChanges(before, after)
+        self.collectGarbage()
+
+    def addBlob(self, cur, tempPath, hash, extension):
+        """Move a file into the blob store in a write transaction, it is
+        removed again if the transaction rolls back.
+
+        Args:
+            cur(sqlite3.Cursor): The cursor of the write transaction.
+            tempPath(str): The path of the file to move.
+            hash(str): The hash of the blob the file is for.
+            extension(str): The extension of the file, e.g. ".epub"."""
+        if self.blobs.add(tempPath, hash, extension):
+            cur.connection.addedFiles.append(self.blobs.path(hash, extension))
+
+    def deriveAssets(self, hash):
+        """Make the files derived from a stored EPUB, which is its cover.
+
+        Args:
+            hash(str): The hash of the EPUB."""
+        epubPath = self.blobs.path(hash, ".epub")
+        if os.path.exists(self.blobs.path(hash, ".jpg")) or not os.path.exists(epubPath):
+            return
+
+        fd, tempCoverPath = tempfile.mkstemp(dir=self.blobs.directory, suffix=".part")
+        os.close(fd)
+        try:
+            self.saveCover(epubPath, tempCoverPath)
+            con, cur = self.connect()
+            try:
+                cur.execute("BEGIN IMMEDIATE")
+                cur.execute("SELECT refCount FROM blobs WHERE fileHash = ?", (hash,))
+                result = cur.fetchone()
+                if result and result[0] > 0 and os.path.getsize(tempCoverPath):
+                    self.addBlob(cur, tempCoverPath, hash, ".jpg")
+                con.commit()
+            finally:
+                con.close()
+        finally:
+            if os.path.exists(tempCoverPath):
+                os.remove(tempCoverPath)
+
+    def queueJob(self, jobType, jobKey=None, payload={}, maxAttempts=3, cur=None):
+        """Add a job for the background workers to do.
+
+        Args:
+            jobType(str): The type of job, which picks its handler.
+            jobKey(str): What the job is for, to look up its status. (optional)
+            payload(dict): The arguments for the handler. (optional)
+            maxAttempts(int): How many times to try the job, default 3. (optional)
+            cur(sqlite3.Cursor): A cursor to queue the job in its open
+                transaction, so it is only queued if that commits. (optional)
+        Returns:
+            int: The ID of the job."""
+        con = None
+        if cur is None:
+            con, cur = self.connect()
+        try:
+            cur.execute("""
+                INSERT INTO jobs (jobType, jobKey, payload, maxAttempts)
+                VALUES (?, ?, ?, ?)""",
+                (jobType, jobKey, json.dumps(payload), maxAttempts))
+            jobID = cur.lastrowid
+            if con:
+                con.commit()
+        finally:
+            if con:
+                con.close()
+        return jobID
+
+    def claimJob(self, leaseSeconds=600):
+        """Take the next job that is ready to run.
+
+        The job stays claimed for leaseSeconds, if it isn't finished or failed
+        by then (e.g. the server stopped) it can be claimed again.
+
+        Args:
+            leaseSeconds(int): How long to claim the job for, default 600. (optional)
+        Returns:
+            dict: The job, or None if there isn't one."""
+        con, cur = self.connect()
+        try:
+            cur.execute("""
+                UPDATE jobs SET status = 'running', attempts = attempts + 1,
+                    runAfter = datetime('now', ?)
+                WHERE jobID = (
+                    SELECT jobID FROM jobs
+                    WHERE status IN ('queued', 'running') AND runAfter <= datetime('now')
+                    ORDER BY runAfter, jobID LIMIT 1)
+                RETURNING jobID, jobType, jobKey, payload, attempts, maxAttempts""",
+                (f"{int(leaseSeconds):+d} seconds",))
+            result = cur.fetchone()
+            con.commit()
+        except sqlite3.OperationalError:
+            result = None
+        con.close()
+        if result:
+            return {
+                "jobID": result[0],
+                "jobType": result[1],
+                "jobKey": result[2],
+                "payload": json.loads(result[3]),
+                "attempts": result[4],
+                "maxAttempts": result[5]
+            }
+        return None
+
+    def renewJob(self, jobID, leaseSeconds=600):
+        """Claim a running job for longer, so a long job isn't run again
+        while it is still making progress.
+
+        Args:
+            jobID(int): The ID of the job.
+            leaseSeconds(int): How long to claim the job for from now, default 600. (optional)"""
+        con, cur = self.connect()
+        try:
+            cur.execute("""
+                UPDATE jobs SET runAfter = datetime('now', ?)
+                WHERE jobID = ? AND status = 'running'""",
+                (f"{int(leaseSeconds):+d} seconds", jobID))
+            con.commit()
+        except sqlite3.OperationalError:
+            con.rollback()
+        con.close()
+
+    def finishJob(self, jobID):
+        """Remove a job that was done successfully.
+
+        Args:
+            jobID(int): The ID of the job."""
+        con, cur = self.connect()
+        try:
+            cur.execute("DELETE FROM jobs WHERE jobID = ?", (jobID,))
+            con.commit()
+        except sqlite3.OperationalError:
+            con.rollback()
+        con.close()
+
+    def failJob(self, jobID, error, retryDelay=30):
+        """Record that a job failed, it is retried later unless it has run out
+        of attempts.
+
+        Args:
+            jobID(int): The ID of the job.
+            error(str): What went wrong.
+            retryDelay(int): Seconds to wait before retrying, multiplied by
+                the number of attempts so far, default 30. (optional)"""
+        con, cur = self.connect()
+        try:
+            cur.execute("""
+                UPDATE jobs SET
+                    status = CASE WHEN attempts >= maxAttempts THEN 'failed' ELSE 'queued' END,
+                    runAfter = datetime('now', '+' || (? * attempts) || ' seconds'),
+                    lastError = ?
+                WHERE jobID = ?""", (int(retryDelay), str(error), jobID))
+            con.commit()
+        except sqlite3.OperationalError:
+            con.rollback()
+        con.close()
+
+    def jobStatus(self, jobType, jobKey):
+        """Get the status of the latest job of a type for a key.
+
+        Args:
+            jobType(str): The type of job.
+            jobKey(str): What the job is for.
+        Returns:
+            str: "queued", "running" or "failed", None if there isn't a job
+                left because it was done."""
+        con, cur = self.connect()
+        cur.execute("""
+            SELECT status FROM jobs WHERE jobType = ? AND jobKey = ?
+            ORDER BY jobID DESC LIMIT 1""", (jobType, jobKey))
+        result = cur.fetchone()
+        con.close()
+        return result[0] if result else None
+
+    def coverPending(self, bookID):
+        """Check if a book's cover is still waiting to be made.
+
         Args:
             bookID(int): The ID of the book.
-            file(bytes): The file to save."""
-        hash = hashlib.md5(file).hexdigest()
-        epubPath = os.path.join(self.directory, hash + ".epub")
-        with open(epubPath, "wb") as f:
-            f.write(file)
+        Returns:
+            bool: Whether its deriveAssets job is queued or running."""
+        con, cur = self.connect()
+        cur.execute("""
+            SELECT 1 FROM books INNER JOIN jobs
+                ON jobs.jobType = 'deriveAssets' AND jobs.jobKey = books.fileHash
+            WHERE bookID = ? AND status IN ('queued', 'running')""", (bookID,))
+        result = cur.fetchone()
+        con.close()
+        return result is not None
+
+    def getSession(self, sessionID):
+        """Get a session that hasn't expired.
+
+        Args:
+            sessionID(str): The ID from the session cookie.
+        Returns:
+            dict: The session's data, or None if there isn't one."""
+        con, cur = self.connect()
+        cur.execute("""
+            SELECT data FROM sessions
+            WHERE sessionID = ? AND expires > datetime('now')""", (sessionID,))
+        result = cur.fetchone()
+        con.close()
+        return json.loads(result[0]) if result else None
+
+    def saveSession(self, sessionID, data, userID=None, lifetime=86400):
+        """Add or replace a session, removing any that have expired.
+
+        Args:
+            sessionID(str): The ID from the session cookie.
+            data(dict): The session's data, it must be JSON serialisable.
+            userID(int): The user logged in to the session, so it can be
+                revoked with deleteUserSessions. (optional)
+            lifetime(int): Seconds until the session expires, default a day. (optional)"""
+        con, cur = self.connect()
+        try:
+            cur.execute("DELETE FROM sessions WHERE expires <= datetime('now')")
+            cur.execute("""
+                INSERT OR REPLACE INTO sessions (sessionID, userID, data, expires)
+                VALUES (?, ?, ?, datetime('now', ?))""",
+                (sessionID, userID, json.dumps(data), f"{int(lifetime):+d} seconds"))
+            con.commit()
+        except sqlite3.OperationalError:
+            con.rollback()
+        con.close()
+
+    def deleteSession(self, sessionID):
+        """Remove a session, e.g. when its user logs out.
+
+        Args:
+            sessionID(str): The ID from the session cookie."""
+        con, cur = self.connect()
+        cur.execute("DELETE FROM sessions WHERE sessionID = ?", (sessionID,))
+        con.commit()
+        con.close()
+
+    def deleteUserSessions(self, userID):
+        """Remove every session a user is logged in to.
+
+        Args:
+            userID(int): The ID of the user.
+        Returns:
+            list of str: The IDs of the removed sessions."""
+        con, cur = self.connect()
+        cur.execute("DELETE FROM sessions WHERE userID = ? RETURNING sessionID", (userID,))
+        sessionIDs = [sessionID for (sessionID,) in cur.fetchall()]
+        con.commit()
+        con.close()
+        return sessionIDs
+
+    def collectGarbage(self):
+        """Remove stored files that no book uses any more."""
+        con, cur = self.connect()
+        try:
+            cur.execute("BEGIN IMMEDIATE")
+            cur.execute("SELECT fileHash FROM blobs WHERE refCount <= 0")
+            for (hash,) in cur.fetchall():
+                if self.blobs.isHash(hash):
+                    self.blobs.remove(hash)
+                    self.covers.remove(hash)
+                    self.epubs.remove(hash)
+            cur.execute("DELETE FROM blobs WHERE refCount <= 0")
+            con.commit()
+        except sqlite3.OperationalError:
+            con.rollback()
+        con.close()
+
+    def sweepBlobs(self, minAge=3600):
+        """Remove stored files that no book uses and have no blobs row, e.g.
+        left by a process that stopped during a transaction, and old
+        temporary files. Files modified in the last minAge seconds are kept,
+        as their transaction may not have committed yet.
+
+        Args:
+            minAge(float): Seconds since a file was modified before it can
+                be removed, default 3600. (optional)
+        Returns:
+            int: The number of files removed."""
+        orphans, removed = {}, 0
+        for hash, path in self.blobs.oldFiles(minAge):
+            orphans.setdefault(hash, []).append(path)
 
-        with zipfile.ZipFile(epubPath) as epubFile:
+        con, cur = self.connect()
+        try:
+            cur.execute("BEGIN IMMEDIATE")
+            hashes = [hash for hash in orphans if hash is not None]
+            for start in range(0, len(hashes), 500):
+                chunk = hashes[start:start + 500]
+                cur.execute(f"""SELECT fileHash FROM blobs
+                    WHERE refCount > 0 AND fileHash IN ({', '.join('?' * len(chunk))})""", chunk)
+                for (hash,) in cur.fetchall():
+                    del orphans[hash]
+            for paths in orphans.values():
+                for path in paths:
+                    try:
+                        os.remove(path)
+                        removed += 1
+                    except FileNotFoundError:
+                        pass
+            con.commit()
+        finally:
+            con.close()
+        return removed
+
+    @staticmethod
+    def saveCover(epubPath, coverPath):
+        """Find the cover image in an EPUB and save it resized as a JPEG.
+
+        Args:
+            epubPath(str): The path of the EPUB file.
+            coverPath(str): The path to save the cover to.
+        Raises:
+            ValueError: If the file isn't a valid EPUB."""
+        try:
+            epubFile = zipfile.ZipFile(epubPath)
+        except zipfile.BadZipFile:
+            raise ValueError("Invalid EPUB file.")
+
+        with epubFile:
             cover = None
             for item in epubFile.infolist():
                 if re.match(r".*cover\.(png|jpg|jpeg)$", item.filename, re.IGNORECASE):
@@ -370,20 +1587,15 @@ class database:
                         break
             
             if cover:
-                PIL.Image.open(epubFile.open(cover)
-                    ).convert('RGB').resize((400, 600), PIL.Image.ANTIALIAS
-                    ).save(os.path.join(self.directory, hash + ".jpg"), "JPEG")
-                
-        con, cur = self.connect()
-        try:
-            cur.execute("UPDATE books SET fileHash = ? WHERE bookID = ?", (hash, bookID))
-        except sqlite3.IntegrityError:
-            os.remove(epubPath)
-            os.remove(os.path.join(self.directory, hash + ".jpg"))
-            raise ValueError("Book does not exist.")
-        finally:
-            con.commit()
-            con.close()
+                tempCoverPath = coverPath + ".part"
+                try:
+                    PIL.Image.open(epubFile.open(cover)
+                        ).convert('RGB').resize((400, 600), PIL.Image.ANTIALIAS
+                        ).save(tempCoverPath, "JPEG")
+                    os.replace(tempCoverPath, coverPath)
+                finally:
+                    if os.path.exists(tempCoverPath):
+                        os.remove(tempCoverPath)
 
 
 if __name__ == "__main__":
@@ -48,4 +48,30 @@ CREATE TABLE IF NOT EXISTS bookCatalogueLink (
     PRIMARY KEY (bookCatalogueLinkID AUTOINCREMENT),
     FOREIGN KEY (catalogueID) REFERENCES bookCatalogues(catalogueID),
     FOREIGN KEY (bookID) REFERENCES books(bookID)
-);
\ No newline at end of file
+);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS booksSearch USING fts5 (
+    bookName,
+    author,
+    description,
+    content = 'books',
+    content_rowid = 'bookID',
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+
+CREATE TRIGGER IF NOT EXISTS booksSearchInsert AFTER INSERT ON books BEGIN
+    INSERT INTO booksSearch (rowid, bookName, author, description)
+    VALUES (new.bookID, new.bookName, new.author, new.description);
+END;
+
+CREATE TRIGGER IF NOT EXISTS booksSearchDelete AFTER DELETE ON books BEGIN
+    INSERT INTO booksSearch (booksSearch, rowid, bookName, author, description)
+    VALUES ('delete', old.bookID, old.bookName, old.author, old.description);
+END;
+
+CREATE TRIGGER IF NOT EXISTS booksSearchUpdate AFTER UPDATE OF bookName, author, description ON books BEGIN
+    INSERT INTO booksSearch (booksSearch, rowid, bookName, author, description)
+    VALUES ('delete', old.bookID, old.bookName, old.author, old.description);
+    INSERT INTO booksSearch (rowid, bookName, author, description)
+    VALUES (new.bookID, new.bookName, new.author, new.description);
+END;
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+import mimetypes
+import mmap
+import posixpath
+import xml.etree.ElementTree as ElementTree
+import zipfile
+
+from scripts.lruCache import lruCache
+
+# XML namespaces used in EPUB container and package files
+namespaces = {
+    "container": "urn:oasis:names:tc:opendocument:xmlns:container",
+    "opf": "http://www.idpf.org/2007/opf",
+    "dc": "http://purl.org/dc/elements/1.1/"
+}
+
+
+class mappedFile(mmap.mmap):
+    """A read only memory map that zipfile can use as a file."""
+    def seekable(self):
+        return True
+
+
+class epubCache:
+    def __init__(self, blobs, maxBooks=64):
+        """Set up a cache of opened EPUB files so single entries can be read.
+
+        Each EPUB is memory mapped and its zip directory and package file are
+        parsed once, later reads of its entries reuse them.
+
+        Args:
+            blobs (blobStore): The blob store with the EPUB files.
+            maxBooks (int): The most EPUBs to keep open, default 64. (optional)"""
+        self.blobs = blobs
+        self.books = lruCache(maxBooks)
+
+    def open(self, hash):
+        """Get the opened EPUB for a hash.
+
+        Args:
+            hash (str): The hash of the EPUB.
+        Returns:
+            dict: The zipfile.ZipFile and its parsed manifest.
+        Raises:
+            ValueError: If the hash or EPUB is invalid.
+            FileNotFoundError: If there is no EPUB with the hash."""
+        book = self.books.get(hash)
+        if book is not None:
+            return book
+
+        version = self.books.version
+        with open(self.blobs.path(hash, ".epub"), "rb") as file:
+            mapped = mappedFile(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            epubFile = zipfile.ZipFile(mapped)
+            book = {"zip": epubFile, "manifest": self.parseManifest(epubFile)}
+        except (zipfile.BadZipFile, KeyError, AttributeError, ElementTree.ParseError):
+            mapped.close()
+            raise ValueError("Invalid EPUB file.")
+        self.books.set(hash, book, version)
+        return book
+
+    @staticmethod
+    def parseManifest(epubFile):
+        """Read the package file of an EPUB.
+
+        Args:
+            epubFile (zipfile.ZipFile): The EPUB.
+        Returns:
+            dict: The title, creator, language, publisher, date and
+                description, lists of the identifiers and subjects, the
+                manifest items by path with their media types, and the spine
+                as a list of paths in reading order."""
+        container = ElementTree.fromstring(epubFile.read("META-INF/container.xml"))
+        opfPath = container.find(".//container:rootfile", namespaces).get("full-path")
+        opf = ElementTree.fromstring(epubFile.read(opfPath))
+        opfDirectory = posixpath.dirname(opfPath)
+
+        items, paths = {}, {}
+        for item in opf.iterfind("opf:manifest/opf:item", namespaces):
+            path = posixpath.normpath(posixpath.join(opfDirectory, item.get("href", "")))
+            paths[item.get("id")] = path
+            items[path] = {
+                "id": item.get("id"),
+                "mediaType": item.get("media-type"),
+                "properties": item.get("properties")
+            }
+
+        metadata = {}
+        for field in ("title", "creator", "language", "publisher", "date", "description"):
+            element = opf.find(f"opf:metadata/dc:{field}", namespaces)
+            metadata[field] = element.text.strip() if element is not None and element.text else None
+        for field in ("identifier", "subject"):
+            metadata[field + "s"] = [element.text.strip()
+                for element in opf.iterfind(f"opf:metadata/dc:{field}", namespaces)
+                if element.text and element.text.strip()]
+
+        return {
+            **metadata,
+            "package": opfPath,
+            "items": items,
+            "spine": [paths[itemref.get("idref")]
+                for itemref in opf.iterfind("opf:spine/opf:itemref", namespaces)
+                if itemref.get("idref") in paths]
+        }
+
+    def manifest(self, hash):
+        """Get the parsed package file of an EPUB.
+
+        Args:
+            hash (str): The hash of the EPUB.
+        Returns:
+            dict: The manifest, see parseManifest."""
+        return self.open(hash)["manifest"]
+
+    def entry(self, hash, path):
+        """Find an entry in an EPUB.
+
+        Args:
+            hash (str): The hash of the EPUB.
+            path (str): The path of the entry in the EPUB.
+        Returns:
+            zipfile.ZipInfo: The entry's details.
+            str: The entry's mimetype.
+        Raises:
+            KeyError: If there is no such entry."""
+        book = self.open(hash)
+        info = book["zip"].getinfo(path)
+        item = book["manifest"]["items"].get(path)
+        mimetype = ((item and item["mediaType"]) or mimetypes.guess_type(path)[0]
+            or "application/octet-stream")
+        return info, mimetype
+
+    def read(self, hash, info, chunkSize=64 * 1024):
+        """Read an entry in an EPUB in chunks.
+
+        Args:
+            hash (str): The hash of the EPUB.
+            info (zipfile.ZipInfo): The entry from entry.
+            chunkSize (int): The most bytes in each chunk. (optional)
+        Yields:
+            bytes: The entry's decompressed content."""
+        with self.open(hash)["zip"].open(info) as file:
+            for chunk in iter(lambda: file.read(chunkSize), b""):
+                yield chunk
+
+    def remove(self, hash):
+        """Forget an EPUB, e.g. because it was deleted.
+
+        Args:
+            hash (str): The hash of the EPUB."""
+        self.books.invalidate(hash)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+import logging
+import threading
+import traceback
+
+from scripts.bulkImport import bulkImport
+logger = logging.getLogger(__name__)
+
+
+class jobQueue:
+    def __init__(self, db, workers=2, pollInterval=1.0, retryDelay=30, leaseSeconds=600):
+        """Set up the background workers that run jobs from the jobs table.
+
+        Jobs are stored in the database, so they are kept across restarts and
+        can be run by any process using it.
+
+        Args:
+            db (database): The database to take jobs from.
+            workers (int): The number of worker threads, 0 runs jobs in the
+                calling thread when notify is called. (optional)
+            pollInterval (float): Seconds between checks for new jobs when
+                idle, default 1. (optional)
+            retryDelay (int): Seconds to wait before retrying a failed job,
+                multiplied by its attempts, default 30. (optional)
+            leaseSeconds (int): Seconds a job can run before it is assumed
+                lost and run again, default 600. (optional)"""
+        self.db = db
+        self.workers = workers
+        self.pollInterval = pollInterval
+        self.retryDelay = retryDelay
+        self.leaseSeconds = leaseSeconds
+        self.handlers = {
+            "deriveAssets": lambda payload: db.deriveAssets(payload["hash"]),
+            "bulkImport": lambda payload: bulkImport(db, progress=self.renewLease, **payload).run(),
+            "sweepBlobs": lambda payload: db.sweepBlobs()
+        }
+        self.threads = []
+        self.running = threading.local()
+        self.wake = threading.Event()
+        self.stopping = threading.Event()
+
+    def register(self, jobType, handler):
+        """Set the function that runs a type of job.
+
+        Args:
+            jobType (str): The type of job.
+            handler (function): Called with the job's payload dict."""
+        self.handlers[jobType] = handler
+
+    def start(self):
+        """Start the worker threads."""
+        self.stopping.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.work, name=f"jobWorker{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self, timeout=None):
+        """Stop the worker threads after their current jobs.
+
+        Args:
+            timeout (float): Seconds to wait for each thread. (optional)"""
+        self.stopping.set()
+        self.wake.set()
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+    def notify(self):
+        """Tell the workers a job was queued, or run it now if there are none."""
+        if self.workers <= 0:
+            self.runPending()
+        else:
+            self.wake.set()
+
+    def work(self):
+        """Run jobs until stopped, waiting when there are none."""
+        while not self.stopping.is_set():
+            try:
+                found = self.runNext()
+            except Exception:
+                # e.g. the database was locked, keep the worker running
+                logger.exception("Job worker %s failed to run a job", threading.current_thread().name)
+                found = False
+            if not found:
+                self.wake.wait(self.pollInterval)
+                self.wake.clear()
+
+    def renewLease(self):
+        """Claim the job running in this thread for another leaseSeconds,
+        for long jobs to call as they make progress."""
+        job = getattr(self.running, "job", None)
+        if job is not None:
+            self.db.renewJob(job["jobID"], self.leaseSeconds)
+
+    def runPending(self):
+        """Run jobs until there are none ready."""
+        while self.runNext():
+            pass
+
+    def runNext(self):
+        """Claim and run the next ready job.
+
+        Returns:
+            bool: Whether there was a job."""
+        job = self.db.claimJob(self.leaseSeconds)
+        if job is None:
+            return False
+
+        if job["attempts"] > job["maxAttempts"]:
+            self.db.failJob(job["jobID"], "Job was lost too many times.")
+        elif job["jobType"] not in self.handlers:
+            self.db.failJob(job["jobID"], "Unknown job type.", self.retryDelay)
+        else:
+            self.running.job = job
+            try:
+                self.handlers[job["jobType"]](job["payload"])
+            except Exception as error:
+                logger.warning("Job %s (%s) failed: %s", job["jobID"], job["jobType"], error)
+                self.db.failJob(job["jobID"], traceback.format_exc(), self.retryDelay)
+            else:
+                self.db.finishJob(job["jobID"])
+            finally:
+                self.running.job = None
+        return True
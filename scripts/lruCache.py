@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+import collections
+import threading
+
+
+class lruCache:
+    def __init__(self, maxSize=1024):
+        """Set up a thread safe least recently used cache.
+
+        Args:
+            maxSize (int): The most items to keep, 0 disables the cache."""
+        self.maxSize = maxSize
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.version = 0
+
+    def get(self, key, default=None):
+        """Get an item and mark it as recently used.
+
+        Args:
+            key: The key of the item.
+            default: What to return if the item isn't cached. (optional)
+        Returns:
+            The cached item or default."""
+        with self.lock:
+            try:
+                self.items.move_to_end(key)
+                return self.items[key]
+            except KeyError:
+                return default
+
+    def set(self, key, value, version=None):
+        """Cache an item, removing the least recently used if full.
+
+        Args:
+            key: The key of the item.
+            value: The item.
+            version (int): The cache version from before the item was read,
+                it isn't cached if anything was invalidated since. (optional)"""
+        if self.maxSize <= 0:
+            return
+        with self.lock:
+            if version is not None and version != self.version:
+                return
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxSize:
+                self.items.popitem(last=False)
+
+    def invalidate(self, key):
+        """Remove an item so that it is read again next time.
+
+        Args:
+            key: The key of the item."""
+        with self.lock:
+            self.version += 1
+            self.items.pop(key, None)
+
+    def clear(self):
+        """Remove every item."""
+        with self.lock:
+            self.version += 1
+            self.items.clear()
+
+    def __len__(self):
+        return len(self.items)
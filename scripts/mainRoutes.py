@@ -1,25 +1,70 @@
 #!/usr/bin/env python3
 
 import flask
+import mimetypes
 
 diya = flask.Blueprint("diyaMain", __name__, template_folder="templates")
 
 
 @diya.route("/static/<path:path>", endpoint="static", methods=["GET"])
 def static(path):
-    """Send files in the static folder."""
-    return flask.send_from_directory("static", path)
+    """Send files in the static folder.
+
+    Files asked for by their fingerprinted URL never change, so they are
+    cached for a year. A precompressed copy is sent if the browser accepts
+    its encoding."""
+    asset = assets.get(path)
+    if asset is None:
+        return flask.send_from_directory("static", path)
+
+    mimetype = mimetypes.guess_type(asset["path"])[0] or "application/octet-stream"
+    filePath, encoding = asset["path"], None
+    for acceptedEncoding in assets.encodings():
+        if (acceptedEncoding in asset["encodings"] and
+                flask.request.accept_encodings[acceptedEncoding]):
+            filePath, encoding = asset["encodings"][acceptedEncoding], acceptedEncoding
+            break
+
+    response = flask.send_file(filePath, mimetype=mimetype, conditional=True,
+        etag=asset["hash"] + ("-" + encoding if encoding else ""),
+        max_age=365 * 24 * 60 * 60 if asset["fingerprinted"] else None)
+    if asset["fingerprinted"]:
+        response.cache_control.immutable = True
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    if asset["encodings"]:
+        response.vary.add("Accept-Encoding")
+    return response
+
+
+@diya.app_template_global()
+def staticURL(path):
+    """Get the fingerprinted URL of a file in the static folder."""
+    return assets.url(path)
 
 
 @diya.route("/", methods=["GET"])
 def welcome():
     """Return the welcome page."""
     if "user" in flask.session:
-        return flask.render_template("index.html", user=flask.session["user"], books=db.searchBooks(limit=4, sort="RANDOM()"))
+        return flask.render_template("index.html", user=flask.session["user"], books=db.randomBooks(4))
     else:
         return flask.render_template("welcome.html")
 
 
+@diya.route("/admin/metrics", methods=["GET"])
+def viewMetrics():
+    """Get request latency, status counts, bytes sent, database time and
+    queue depths in the Prometheus text format."""
+    user = flask.session.get("user")
+    if user == None:
+        return flask.abort(401, "You do not have permission to view metrics.")
+    elif not user["admin"]:
+        return flask.abort(403, "You do not have permission to view metrics.")
+
+    return flask.Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 def errorPage(error):
     """Return the error page."""
     return flask.render_template("error.html", error=error), error.code
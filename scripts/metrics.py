@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+
+import bisect
+import collections
+import flask
+import threading
+import time
+
+from scripts.database import queryTime
+
+# The upper bounds in seconds of the buckets requests are counted in
+latencyBuckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# The upper bounds of the buckets the number of SQL statements per request
+# are counted in, so requests running a statement per row stand out
+queryBuckets = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# Other methods are counted together, so clients can't add label values
+knownMethods = {"GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"}
+
+
+class histogram:
+    def __init__(self, buckets):
+        """Set up a count of values in buckets, like a Prometheus histogram.
+
+        Args:
+            buckets (tuple of float): The sorted upper bounds of the buckets."""
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        """Count a value. Not thread safe, the caller holds a lock.
+
+        Args:
+            value (float): The value."""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        """Get the Prometheus samples of the histogram.
+
+        Args:
+            name (str): The name of the metric.
+            labels (str): The labels of the histogram, e.g. 'endpoint="x",'.
+        Returns:
+            list of str: The bucket, sum and count lines."""
+        lines, total = [], 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            total += count
+            lines.append(f'{name}_bucket{{{labels}le="{bound}"}} {total}')
+        lines.append(f"{name}_sum{{{labels.rstrip(',')}}} {self.sum}")
+        lines.append(f"{name}_count{{{labels.rstrip(',')}}} {total}")
+        return lines
+
+
+def labelValue(value):
+    """Escape a Prometheus label value."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class requestMetrics:
+    def __init__(self, app, buckets=latencyBuckets):
+        """Measure every request to an app: its latency, status, the bytes
+        sent and the time spent and statements run in the database, by endpoint.
+
+        The app's WSGI callable is wrapped so streamed responses are timed
+        until they finish. Everything is counted in this process under one
+        lock that is held for a few dict updates per request, so with
+        --workers each worker reports its own requests.
+
+        Args:
+            app (flask.Flask): The app to measure.
+            buckets (tuple of float): The upper bounds in seconds of the
+                latency buckets. (optional)"""
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.inFlight = 0
+        self.latency = {}
+        self.databaseTime = {}
+        self.queries = {}
+        self.statuses = collections.Counter()
+        self.bytesSent = collections.Counter()
+        self.collectors = []
+        self.started = time.time()
+
+        self.wsgiApp = app.wsgi_app
+        app.wsgi_app = self
+        app.before_request(self.tagEndpoint)
+
+    @staticmethod
+    def tagEndpoint():
+        """Note the endpoint handling the request, for when it finishes."""
+        flask.request.environ["diya.endpoint"] = flask.request.endpoint
+
+    def __call__(self, environ, startResponse):
+        start = time.perf_counter()
+        queryTime.reset()
+        with self.lock:
+            self.inFlight += 1
+
+        status = []
+        def recordStatus(statusLine, headers, excInfo=None):
+            status[:] = [statusLine.split(" ", 1)[0], headers]
+            return startResponse(statusLine, headers, excInfo)
+
+        try:
+            body = self.wsgiApp(environ, recordStatus)
+        except BaseException:
+            self.record(environ, "500", start, 0)
+            raise
+
+        # Files sent by the server's file wrapper aren't read here, so the
+        # Content-Length is counted instead and the time stops now
+        fileWrapper = environ.get("wsgi.file_wrapper")
+        if isinstance(fileWrapper, type) and isinstance(body, fileWrapper):
+            length = dict((key.lower(), value) for key, value in status[1]).get("content-length")
+            self.record(environ, status[0], start, int(length or 0))
+            return body
+        return measuredBody(body, lambda sent: self.record(environ,
+            status[0] if status else "500", start, sent))
+
+    def record(self, environ, status, start, sent):
+        """Count a finished request.
+
+        Args:
+            environ (dict): The request's WSGI environ.
+            status (str): The response's status code.
+            start (float): When the request started, from time.perf_counter.
+            sent (int): The bytes of the body sent."""
+        seconds = time.perf_counter() - start
+        databaseSeconds, queries = queryTime.reset()
+        endpoint = environ.get("diya.endpoint") or ""
+        method = environ.get("REQUEST_METHOD", "GET")
+        if method not in knownMethods:
+            method = "other"
+
+        with self.lock:
+            self.inFlight -= 1
+            latency = self.latency.get((endpoint, method))
+            if latency is None:
+                latency = self.latency[(endpoint, method)] = histogram(self.buckets)
+            latency.observe(seconds)
+            databaseTime = self.databaseTime.get(endpoint)
+            if databaseTime is None:
+                databaseTime = self.databaseTime[endpoint] = histogram(self.buckets)
+            databaseTime.observe(databaseSeconds)
+            queryCount = self.queries.get(endpoint)
+            if queryCount is None:
+                queryCount = self.queries[endpoint] = histogram(queryBuckets)
+            queryCount.observe(queries)
+            self.statuses[(endpoint, status)] += 1
+            self.bytesSent[endpoint] += sent
+
+    def addCollector(self, collector):
+        """Add more values to report, read each time the metrics are.
+
+        Args:
+            collector (function): Returns a list of (name, type, help,
+                value) for each value, type being "gauge" or "counter"."""
+        self.collectors.append(collector)
+
+    def render(self):
+        """Get every metric in the Prometheus text format.
+
+        Returns:
+            str: The metrics."""
+        with self.lock:
+            inFlight = self.inFlight
+            latency = {key: (value.counts[:], value.sum) for key, value in self.latency.items()}
+            databaseTime = {key: (value.counts[:], value.sum) for key, value in self.databaseTime.items()}
+            queries = {key: (value.counts[:], value.sum) for key, value in self.queries.items()}
+            statuses = dict(self.statuses)
+            bytesSent = dict(self.bytesSent)
+
+        def histograms(name, values, labelNames, buckets=self.buckets):
+            for key, (counts, total) in sorted(values.items()):
+                copy = histogram(buckets)
+                copy.counts, copy.sum = counts, total
+                labels = "".join(f'{label}="{labelValue(value)}",'
+                    for label, value in zip(labelNames, key))
+                lines.extend(copy.samples(name, labels))
+
+        lines = [
+            "# HELP diya_http_request_duration_seconds Time to handle requests, until the body was sent.",
+            "# TYPE diya_http_request_duration_seconds histogram"
+        ]
+        histograms("diya_http_request_duration_seconds", latency, ("endpoint", "method"))
+        lines += [
+            "# HELP diya_http_database_seconds Time requests spent running SQL.",
+            "# TYPE diya_http_database_seconds histogram"
+        ]
+        histograms("diya_http_database_seconds", {(key,): value for key, value in databaseTime.items()},
+            ("endpoint",))
+        lines += [
+            "# HELP diya_http_database_queries SQL statements run by requests.",
+            "# TYPE diya_http_database_queries histogram"
+        ]
+        histograms("diya_http_database_queries", {(key,): value for key, value in queries.items()},
+            ("endpoint",), queryBuckets)
+        lines += [
+            "# HELP diya_http_requests_total Finished requests by status.",
+            "# TYPE diya_http_requests_total counter"
+        ]
+        lines += [f'diya_http_requests_total{{endpoint="{labelValue(endpoint)}",status="{status}"}} {count}'
+            for (endpoint, status), count in sorted(statuses.items())]
+        lines += [
+            "# HELP diya_http_response_bytes_total Bytes of response bodies sent.",
+            "# TYPE diya_http_response_bytes_total counter"
+        ]
+        lines += [f'diya_http_response_bytes_total{{endpoint="{labelValue(endpoint)}"}} {sent}'
+            for endpoint, sent in sorted(bytesSent.items())]
+        lines += [
+            "# HELP diya_http_requests_in_flight Requests being handled.",
+            "# TYPE diya_http_requests_in_flight gauge",
+            f"diya_http_requests_in_flight {inFlight}",
+            "# HELP diya_process_start_time_seconds When this process started counting.",
+            "# TYPE diya_process_start_time_seconds gauge",
+            f"diya_process_start_time_seconds {self.started}"
+        ]
+        for collector in self.collectors:
+            for name, kind, help, value in collector():
+                lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}", f"{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+
+class measuredBody:
+    def __init__(self, body, onClose):
+        """Count the bytes of a response body as it is sent.
+
+        Args:
+            body (iterable of bytes): The body from the app.
+            onClose (function): Called with the bytes sent when all of
+                the body was sent or the server closed it."""
+        self.body = body
+        self.onClose = onClose
+        self.sent = 0
+
+    def __iter__(self):
+        for chunk in self.body:
+            self.sent += len(chunk)
+            yield chunk
+        self.finish()
+
+    def close(self):
+        try:
+            if hasattr(self.body, "close"):
+                self.body.close()
+        finally:
+            self.finish()
+
+    def finish(self):
+        """Report the bytes sent once, when the body is sent or closed."""
+        onClose, self.onClose = self.onClose, None
+        if onClose:
+            onClose(self.sent)
+
+
+def hasherMetrics(hasher):
+    """Make a collector for the password hasher's stats.
+
+    Args:
+        hasher (passwordHasher): The hasher.
+    Returns:
+        function: The collector for requestMetrics.addCollector."""
+    def collect():
+        stats = hasher.stats()
+        return [
+            ("diya_password_hashes_total", "counter", "Passwords hashed or checked.", stats["hashes"]),
+            ("diya_password_hash_seconds_total", "counter", "Time spent hashing passwords.",
+                stats["hashSeconds"]),
+            ("diya_password_hash_max_seconds", "gauge", "The slowest password hash.",
+                stats["maxHashSeconds"]),
+            ("diya_password_hashes_pending", "gauge", "Password hashes running or waiting.",
+                stats["pending"]),
+            ("diya_password_hashes_max_pending", "gauge", "The most password hashes that can wait.",
+                stats["maxPending"]),
+            ("diya_password_hashes_rejected_total", "counter",
+                "Logins turned away because too many hashes were waiting.", stats["rejected"])
+        ]
+    return collect
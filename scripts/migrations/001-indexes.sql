@@ -0,0 +1,6 @@
+CREATE INDEX IF NOT EXISTS bookCatalogueLinkBookID ON bookCatalogueLink (bookID);
+CREATE INDEX IF NOT EXISTS bookCatalogueLinkCatalogueID ON bookCatalogueLink (catalogueID);
+CREATE INDEX IF NOT EXISTS bookCataloguesName ON bookCatalogues (catalogueName COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS booksGenre ON books (genre COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS booksLanguage ON books (language COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS booksFileHash ON books (fileHash);
@@ -0,0 +1,28 @@
+CREATE TABLE IF NOT EXISTS blobs (
+    fileHash            VARCHAR(64) NOT NULL,
+    refCount            INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (fileHash)
+);
+
+INSERT OR IGNORE INTO blobs (fileHash, refCount)
+SELECT fileHash, COUNT(*) FROM books WHERE fileHash IS NOT NULL GROUP BY fileHash;
+
+CREATE INDEX IF NOT EXISTS blobsUnreferenced ON blobs (refCount) WHERE refCount <= 0;
+
+CREATE TRIGGER IF NOT EXISTS blobsBookInsert AFTER INSERT ON books
+WHEN new.fileHash IS NOT NULL BEGIN
+    INSERT INTO blobs (fileHash, refCount) VALUES (new.fileHash, 1)
+    ON CONFLICT (fileHash) DO UPDATE SET refCount = refCount + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS blobsBookUpdate AFTER UPDATE OF fileHash ON books
+WHEN old.fileHash IS NOT new.fileHash BEGIN
+    UPDATE blobs SET refCount = refCount - 1 WHERE fileHash = old.fileHash;
+    INSERT INTO blobs (fileHash, refCount) SELECT new.fileHash, 1 WHERE new.fileHash IS NOT NULL
+    ON CONFLICT (fileHash) DO UPDATE SET refCount = refCount + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS blobsBookDelete AFTER DELETE ON books
+WHEN old.fileHash IS NOT NULL BEGIN
+    UPDATE blobs SET refCount = refCount - 1 WHERE fileHash = old.fileHash;
+END;
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+
+import os
+
+
+def migrate(db, cur):
+    """Move flat <md5>.epub and <md5>.jpg files into the blob store.
+
+    Each book is committed as soon as its file is moved so an interrupted
+    migration carries on where it stopped when it is run again.
+
+    Args:
+        db (database): The database being migrated.
+        cur (sqlite3.Cursor): A cursor in the migration's transaction."""
+    cur.execute("""
+        SELECT DISTINCT fileHash FROM books
+        WHERE fileHash IS NOT NULL AND LENGTH(fileHash) = 32""")
+    for (oldHash,) in cur.fetchall():
+        epubPath = os.path.join(db.directory, oldHash + ".epub")
+        coverPath = os.path.join(db.directory, oldHash + ".jpg")
+        newHash = None
+        if os.path.exists(epubPath):
+            with open(epubPath, "rb") as file:
+                tempPath, newHash = db.blobs.write(file)
+            db.blobs.add(tempPath, newHash, ".epub")
+            if os.path.exists(coverPath):
+                with open(coverPath, "rb") as file:
+                    tempPath, _ = db.blobs.write(file)
+                db.blobs.add(tempPath, newHash, ".jpg")
+
+        cur.execute("UPDATE books SET fileHash = ? WHERE fileHash = ?", (newHash, oldHash))
+        cur.execute("DELETE FROM blobs WHERE fileHash = ?", (oldHash,))
+        cur.connection.commit()
+        for path in (epubPath, coverPath):
+            if os.path.exists(path):
+                os.remove(path)
@@ -0,0 +1,19 @@
+CREATE TABLE IF NOT EXISTS jobs (
+    jobID               INTEGER NOT NULL,
+    jobType             VARCHAR(32) NOT NULL,
+    jobKey              VARCHAR(64),
+    payload             TEXT NOT NULL DEFAULT '{}',
+    status              VARCHAR(8) NOT NULL DEFAULT 'queued',
+    attempts            INTEGER NOT NULL DEFAULT 0,
+    maxAttempts         INTEGER NOT NULL DEFAULT 3,
+    runAfter            DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    lastError           TEXT,
+    created             DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (jobID AUTOINCREMENT)
+);
+
+CREATE INDEX IF NOT EXISTS jobsReady ON jobs (runAfter) WHERE status IN ('queued', 'running');
+CREATE INDEX IF NOT EXISTS jobsKey ON jobs (jobType, jobKey);
+
+INSERT INTO jobs (jobType, jobKey, payload)
+SELECT 'deriveAssets', fileHash, json_object('hash', fileHash) FROM blobs;
@@ -0,0 +1,10 @@
+CREATE TABLE IF NOT EXISTS sessions (
+    sessionID           VARCHAR(64) NOT NULL,
+    userID              INTEGER,
+    data                TEXT NOT NULL DEFAULT '{}',
+    expires             DATETIME NOT NULL,
+    PRIMARY KEY (sessionID)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS sessionsUser ON sessions (userID) WHERE userID IS NOT NULL;
+CREATE INDEX IF NOT EXISTS sessionsExpires ON sessions (expires);
@@ -0,0 +1,9 @@
+CREATE TABLE IF NOT EXISTS bookImports (
+    path                TEXT NOT NULL,
+    size                INTEGER NOT NULL,
+    modified            REAL NOT NULL,
+    bookID              INTEGER,
+    error               TEXT,
+    imported            DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (path)
+) WITHOUT ROWID;
@@ -0,0 +1,63 @@
+CREATE TABLE IF NOT EXISTS bookFacets (
+    facet               VARCHAR(16) NOT NULL,
+    value               VARCHAR(64) NOT NULL COLLATE NOCASE,
+    count               INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (facet, value)
+) WITHOUT ROWID;
+
+DELETE FROM bookFacets;
+
+INSERT INTO bookFacets (facet, value, count)
+SELECT 'genre', MIN(genre), COUNT(*) FROM books
+WHERE genre IS NOT NULL GROUP BY genre COLLATE NOCASE;
+
+INSERT INTO bookFacets (facet, value, count)
+SELECT 'language', MIN(language), COUNT(*) FROM books
+WHERE language IS NOT NULL GROUP BY language COLLATE NOCASE;
+
+INSERT INTO bookFacets (facet, value, count)
+SELECT 'catalogue', MIN(catalogueName), COUNT(*) FROM bookCatalogueLink
+INNER JOIN bookCatalogues ON bookCatalogueLink.catalogueID = bookCatalogues.catalogueID
+GROUP BY catalogueName COLLATE NOCASE;
+
+CREATE TRIGGER IF NOT EXISTS bookFacetsInsert AFTER INSERT ON books BEGIN
+    INSERT INTO bookFacets (facet, value, count)
+    SELECT 'genre', new.genre, 1 WHERE new.genre IS NOT NULL
+    ON CONFLICT (facet, value) DO UPDATE SET count = count + 1;
+    INSERT INTO bookFacets (facet, value, count)
+    SELECT 'language', new.language, 1 WHERE new.language IS NOT NULL
+    ON CONFLICT (facet, value) DO UPDATE SET count = count + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS bookFacetsUpdate AFTER UPDATE OF genre, language ON books BEGIN
+    UPDATE bookFacets SET count = count - 1
+    WHERE (facet = 'genre' AND value = old.genre) OR (facet = 'language' AND value = old.language);
+    INSERT INTO bookFacets (facet, value, count)
+    SELECT 'genre', new.genre, 1 WHERE new.genre IS NOT NULL
+    ON CONFLICT (facet, value) DO UPDATE SET count = count + 1;
+    INSERT INTO bookFacets (facet, value, count)
+    SELECT 'language', new.language, 1 WHERE new.language IS NOT NULL
+    ON CONFLICT (facet, value) DO UPDATE SET count = count + 1;
+    DELETE FROM bookFacets WHERE count <= 0
+        AND ((facet = 'genre' AND value = old.genre) OR (facet = 'language' AND value = old.language));
+END;
+
+CREATE TRIGGER IF NOT EXISTS bookFacetsDelete AFTER DELETE ON books BEGIN
+    UPDATE bookFacets SET count = count - 1
+    WHERE (facet = 'genre' AND value = old.genre) OR (facet = 'language' AND value = old.language);
+    DELETE FROM bookFacets WHERE count <= 0
+        AND ((facet = 'genre' AND value = old.genre) OR (facet = 'language' AND value = old.language));
+END;
+
+CREATE TRIGGER IF NOT EXISTS bookFacetsLinkInsert AFTER INSERT ON bookCatalogueLink BEGIN
+    INSERT INTO bookFacets (facet, value, count)
+    SELECT 'catalogue', catalogueName, 1 FROM bookCatalogues WHERE catalogueID = new.catalogueID
+    ON CONFLICT (facet, value) DO UPDATE SET count = count + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS bookFacetsLinkDelete AFTER DELETE ON bookCatalogueLink BEGIN
+    UPDATE bookFacets SET count = count - 1 WHERE facet = 'catalogue'
+        AND value = (SELECT catalogueName FROM bookCatalogues WHERE catalogueID = old.catalogueID);
+    DELETE FROM bookFacets WHERE count <= 0 AND facet = 'catalogue'
+        AND value = (SELECT catalogueName FROM bookCatalogues WHERE catalogueID = old.catalogueID);
+END;
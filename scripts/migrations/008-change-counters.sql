@@ -0,0 +1,27 @@
+CREATE TABLE IF NOT EXISTS changeCounters (
+    name                VARCHAR(32) NOT NULL,
+    version             INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (name)
+) WITHOUT ROWID;
+
+INSERT OR IGNORE INTO changeCounters (name, version) VALUES ('books', 0);
+
+CREATE TRIGGER IF NOT EXISTS changeCountersBookInsert AFTER INSERT ON books BEGIN
+    UPDATE changeCounters SET version = version + 1 WHERE name = 'books';
+END;
+
+CREATE TRIGGER IF NOT EXISTS changeCountersBookUpdate AFTER UPDATE ON books BEGIN
+    UPDATE changeCounters SET version = version + 1 WHERE name = 'books';
+END;
+
+CREATE TRIGGER IF NOT EXISTS changeCountersBookDelete AFTER DELETE ON books BEGIN
+    UPDATE changeCounters SET version = version + 1 WHERE name = 'books';
+END;
+
+CREATE TRIGGER IF NOT EXISTS changeCountersLinkInsert AFTER INSERT ON bookCatalogueLink BEGIN
+    UPDATE changeCounters SET version = version + 1 WHERE name = 'books';
+END;
+
+CREATE TRIGGER IF NOT EXISTS changeCountersLinkDelete AFTER DELETE ON bookCatalogueLink BEGIN
+    UPDATE changeCounters SET version = version + 1 WHERE name = 'books';
+END;
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+import bcrypt
+import concurrent.futures
+import threading
+import time
+
+
+class hasherBusy(Exception):
+    """Raised when too many passwords are already waiting to be hashed."""
+
+
+class passwordHasher:
+    def __init__(self, rounds=12, workers=0, maxPending=8):
+        """Set up bcrypt hashing on its own threads.
+
+        Hashing is slow on purpose, running it on a small pool of threads with
+        a cap on how many requests can wait for it stops a burst of logins
+        from taking every server thread.
+
+        Args:
+            rounds (int): The bcrypt work factor for new hashes, default 12. (optional)
+            workers (int): The number of hashing threads, 0 hashes in the
+                calling thread without a cap. (optional)
+            maxPending (int): The most hashes running or waiting before
+                hasherBusy is raised, default 8. (optional)"""
+        self.rounds = rounds
+        self.maxPending = maxPending
+        self.executor = (concurrent.futures.ThreadPoolExecutor(
+            workers, thread_name_prefix="passwordHasher") if workers > 0 else None)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.hashes = 0
+        self.hashSeconds = 0.0
+        self.maxHashSeconds = 0.0
+        self.rejected = 0
+
+    def run(self, function, *args):
+        """Run a bcrypt function on the hashing threads and wait for it.
+
+        Raises:
+            hasherBusy: If maxPending hashes are already running or waiting."""
+        with self.lock:
+            if self.executor and self.pending >= self.maxPending:
+                self.rejected += 1
+                raise hasherBusy("Too many passwords are waiting to be hashed.")
+            self.pending += 1
+        try:
+            if self.executor:
+                return self.executor.submit(self.timed, function, *args).result()
+            return self.timed(function, *args)
+        finally:
+            with self.lock:
+                self.pending -= 1
+
+    def timed(self, function, *args):
+        """Run a function and record how long it took."""
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            seconds = time.perf_counter() - start
+            with self.lock:
+                self.hashes += 1
+                self.hashSeconds += seconds
+                self.maxHashSeconds = max(self.maxHashSeconds, seconds)
+
+    def hash(self, password):
+        """Hash a password with the current work factor.
+
+        Args:
+            password (str): The password.
+        Returns:
+            bytes: The bcrypt hash."""
+        return self.run(bcrypt.hashpw, password.encode("utf-8"), bcrypt.gensalt(self.rounds))
+
+    def check(self, password, hash):
+        """Check a password against a hash.
+
+        Args:
+            password (str): The password.
+            hash (bytes): The bcrypt hash.
+        Returns:
+            bool: Whether the password matches."""
+        return self.run(bcrypt.checkpw, password.encode("utf-8"), hash)
+
+    def needsRehash(self, hash):
+        """Check if a hash was made with a different work factor.
+
+        Args:
+            hash (bytes): The bcrypt hash.
+        Returns:
+            bool: Whether it should be hashed again with the current one."""
+        try:
+            return int(hash.split(b"$")[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+    def stats(self):
+        """Get numbers for monitoring hashing.
+
+        Returns:
+            dict: The rounds, hashes done, their mean and max seconds, hashes
+                running or waiting, and requests turned away."""
+        with self.lock:
+            return {
+                "rounds": self.rounds,
+                "hashes": self.hashes,
+                "meanHashSeconds": self.hashSeconds / self.hashes if self.hashes else 0.0,
+                "maxHashSeconds": self.maxHashSeconds,
+                "hashSeconds": self.hashSeconds,
+                "pending": self.pending,
+                "maxPending": self.maxPending,
+                "rejected": self.rejected
+            }
+
+    def shutdown(self):
+        """Stop the hashing threads."""
+        if self.executor:
+            self.executor.shutdown(wait=False)
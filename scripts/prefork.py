@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import logging
+import os
+import signal
+import time
+import traceback
+
+logger = logging.getLogger(__name__)
+
+
+def stopWorker(signum, frame):
+    """Stop a worker process by unwinding its server loop."""
+    raise SystemExit(0)
+
+
+class supervisor:
+    def __init__(self, target, workers, restartDelay=1.0, shutdownTimeout=10):
+        """Set up a pre-fork supervisor that keeps worker processes running.
+
+        Each worker is forked from this process, so anything made before
+        run is called (e.g. a listening socket) is shared by every worker.
+        Workers that exit are started again until the supervisor is stopped
+        with SIGINT or SIGTERM, which is passed on to every worker.
+
+        Args:
+            target (function): Run in each worker with its index, the worker
+                exits when it returns. SIGTERM raises SystemExit in it.
+            workers (int): The number of worker processes.
+            restartDelay (float): Seconds to wait before restarting a worker
+                that exited soon after it started, default 1. (optional)
+            shutdownTimeout (float): Seconds workers have to exit after being
+                stopped before they are killed, default 10. (optional)"""
+        self.target = target
+        self.workers = workers
+        self.restartDelay = restartDelay
+        self.shutdownTimeout = shutdownTimeout
+        self.children = {}
+        self.stopping = False
+
+    def spawn(self, index):
+        """Fork a worker process.
+
+        Args:
+            index (int): The worker's number, passed to target."""
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                signal.signal(signal.SIGTERM, stopWorker)
+                signal.signal(signal.SIGALRM, signal.SIG_DFL)
+                self.target(index)
+            except SystemExit as error:
+                code = error.code if isinstance(error.code, int) else 1
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        self.children[pid] = (index, time.monotonic())
+        logger.info("Started worker %s (pid %s)", index, pid)
+
+    def run(self):
+        """Start the workers and restart any that exit, until stopped."""
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGALRM, self.kill)
+        for index in range(self.workers):
+            self.spawn(index)
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            index, started = self.children.pop(pid)
+            if self.stopping:
+                continue
+
+            code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+            logger.warning("Worker %s (pid %s) exited with status %s, restarting",
+                index, pid, code)
+            if time.monotonic() - started < self.restartDelay:
+                time.sleep(self.restartDelay)
+            if not self.stopping:
+                self.spawn(index)
+        signal.alarm(0)
+
+    def stop(self, signum=None, frame=None):
+        """Ask every worker to finish its requests and exit, killing them
+        if they don't within shutdownTimeout."""
+        if self.stopping:
+            return
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        signal.alarm(max(1, int(self.shutdownTimeout)))
+
+    def kill(self, signum=None, frame=None):
+        """Kill workers that didn't stop in time."""
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
@@ -3,13 +3,21 @@
 import scripts.accountRoutes as accountRoutes
 import scripts.bookRoutes as bookRoutes
 import scripts.mainRoutes as mainRoutes
+from scripts.metrics import hasherMetrics, requestMetrics
 
 import werkzeug.exceptions as exceptions
 
 def setUpRoutes(app):
+    app.metrics = requestMetrics(app)
+    app.metrics.addCollector(hasherMetrics(app.db.hasher))
+
     for route in [accountRoutes, bookRoutes, mainRoutes]:
         app.register_blueprint(route.diya)
         route.db = app.db
+        route.jobs = app.jobs
+        route.assets = app.assets
+        route.sessions = app.sessions
+        route.metrics = app.metrics
     
     for errorCode in exceptions.default_exceptions:
         app.register_error_handler(errorCode, mainRoutes.errorPage)
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+import flask.sessions
+import json
+import re
+import secrets
+import threading
+import time
+import werkzeug.datastructures
+
+from scripts.lruCache import lruCache
+
+# Session IDs are 32 random bytes, base64 encoded
+validSessionID = re.compile(r"[A-Za-z0-9_\-]{43}")
+
+
+def sessionUser(data):
+    """Get the ID of the user logged in to a session.
+
+    Args:
+        data (dict): The session's data.
+    Returns:
+        int: The user's ID, or None if no one is logged in."""
+    user = data.get("user")
+    return user.get("id") if isinstance(user, dict) else None
+
+
+class serverSession(werkzeug.datastructures.CallbackDict, flask.sessions.SessionMixin):
+    def __init__(self, data=None, sessionID=None):
+        """A session whose data is kept on the server.
+
+        Args:
+            data (dict): The session's data. (optional)
+            sessionID (str): The ID from the cookie, None for a new session. (optional)"""
+        def onUpdate(self):
+            self.modified = True
+        super().__init__(data, onUpdate)
+        self.sessionID = sessionID
+        self.userID = sessionUser(self)
+        self.modified = False
+
+
+class memorySessionStore:
+    def __init__(self, maxSessions=10000, lifetime=86400):
+        """Set up a session store in this process's memory.
+
+        Sessions are lost when the server restarts and aren't shared with
+        other processes, so this is only for running a single process.
+
+        Args:
+            maxSessions (int): The most sessions to keep, the least recently
+                used are logged out first, default 10000. (optional)
+            lifetime (int): Seconds a session lasts after it was last
+                changed, default a day. (optional)"""
+        self.sessions = lruCache(maxSessions)
+        self.lifetime = lifetime
+        self.users = {}
+        self.lock = threading.Lock()
+
+    def get(self, sessionID):
+        """Get a session's data.
+
+        Args:
+            sessionID (str): The ID from the cookie.
+        Returns:
+            dict: The session's data, or None if it doesn't exist or expired."""
+        session = self.sessions.get(sessionID)
+        if session is None or session[1] <= time.time():
+            return None
+        return json.loads(session[0])
+
+    def save(self, sessionID, data, userID=None):
+        """Add or replace a session.
+
+        Args:
+            sessionID (str): The ID from the cookie.
+            data (dict): The session's data.
+            userID (int): The user logged in to the session. (optional)"""
+        self.sessions.set(sessionID, (json.dumps(data), time.time() + self.lifetime))
+        if userID is not None:
+            with self.lock:
+                # Forget sessions of this user that were evicted or expired
+                sessionIDs = {sessionID for sessionID in self.users.get(userID, ())
+                    if sessionID in self.sessions.items}
+                sessionIDs.add(sessionID)
+                self.users[userID] = sessionIDs
+
+    def delete(self, sessionID):
+        """Remove a session.
+
+        Args:
+            sessionID (str): The ID from the cookie."""
+        self.sessions.invalidate(sessionID)
+
+    def revokeUser(self, userID):
+        """Log a user out of every session.
+
+        Args:
+            userID (int): The ID of the user."""
+        with self.lock:
+            sessionIDs = self.users.pop(userID, ())
+        for sessionID in sessionIDs:
+            self.sessions.invalidate(sessionID)
+
+
+class sqliteSessionStore:
+    def __init__(self, db, lifetime=86400, cacheSeconds=5, maxCached=4096):
+        """Set up a session store in the sessions table, shared by every
+        process using the database.
+
+        Sessions read from the database are cached in this process for
+        cacheSeconds, so revoking a session takes effect immediately in this
+        process and within cacheSeconds in others.
+
+        Args:
+            db (database): The database to keep sessions in.
+            lifetime (int): Seconds a session lasts after it was last
+                changed, default a day. (optional)
+            cacheSeconds (float): Seconds to cache a session for, 0 reads
+                it from the database every request, default 5. (optional)
+            maxCached (int): The most sessions to cache, default 4096. (optional)"""
+        self.db = db
+        self.lifetime = lifetime
+        self.cacheSeconds = cacheSeconds
+        self.cache = lruCache(maxCached if cacheSeconds > 0 else 0)
+
+    def get(self, sessionID):
+        """Get a session's data.
+
+        Args:
+            sessionID (str): The ID from the cookie.
+        Returns:
+            dict: The session's data, or None if it doesn't exist or expired."""
+        cached = self.cache.get(sessionID)
+        if cached is not None and time.monotonic() - cached[1] < self.cacheSeconds:
+            return json.loads(cached[0])
+
+        version = self.cache.version
+        data = self.db.getSession(sessionID)
+        if data is not None:
+            self.cache.set(sessionID, (json.dumps(data), time.monotonic()), version)
+        return data
+
+    def save(self, sessionID, data, userID=None):
+        """Add or replace a session.
+
+        Args:
+            sessionID (str): The ID from the cookie.
+            data (dict): The session's data.
+            userID (int): The user logged in to the session. (optional)"""
+        self.db.saveSession(sessionID, data, userID, self.lifetime)
+        self.cache.invalidate(sessionID)
+
+    def delete(self, sessionID):
+        """Remove a session.
+
+        Args:
+            sessionID (str): The ID from the cookie."""
+        self.db.deleteSession(sessionID)
+        self.cache.invalidate(sessionID)
+
+    def revokeUser(self, userID):
+        """Log a user out of every session.
+
+        Args:
+            userID (int): The ID of the user."""
+        for sessionID in self.db.deleteUserSessions(userID):
+            self.cache.invalidate(sessionID)
+
+
+class sessionInterface(flask.sessions.SessionInterface):
+    def __init__(self, store):
+        """Keep Flask sessions in a session store, the cookie only holds a
+        random session ID.
+
+        A new ID is made whenever a different user logs in to a session, so
+        an ID set before logging in can't be reused after.
+
+        Args:
+            store (memorySessionStore or sqliteSessionStore): Where to keep sessions."""
+        self.store = store
+
+    def open_session(self, app, request):
+        sessionID = request.cookies.get(self.get_cookie_name(app))
+        if sessionID and validSessionID.fullmatch(sessionID):
+            data = self.store.get(sessionID)
+            if data is not None:
+                return serverSession(data, sessionID)
+        return serverSession()
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            if session.sessionID:
+                self.store.delete(session.sessionID)
+                response.delete_cookie(name, domain=domain, path=path,
+                    secure=self.get_cookie_secure(app),
+                    samesite=self.get_cookie_samesite(app),
+                    httponly=self.get_cookie_httponly(app))
+            return
+        if not session.modified:
+            return
+
+        userID = sessionUser(session)
+        if session.sessionID is None or userID != session.userID:
+            if session.sessionID:
+                self.store.delete(session.sessionID)
+            session.sessionID = secrets.token_urlsafe(32)
+            session.userID = userID
+        self.store.save(session.sessionID, dict(session), userID)
+
+        response.set_cookie(name, session.sessionID,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain, path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app))
+        response.vary.add("Cookie")
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+import collections
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Statements that EXPLAIN QUERY PLAN can describe
+explainable = re.compile(r"\s*(SELECT|WITH|INSERT|UPDATE|DELETE|REPLACE)\b", re.IGNORECASE)
+
+
+def fingerprint(sql):
+    """Get the shape of a statement, with its literals and lists of
+    parameters replaced, so statements that only differ in those are
+    counted together.
+
+    Args:
+        sql (str): The statement.
+    Returns:
+        str: The fingerprint, e.g. "SELECT * FROM books WHERE bookID IN (...)"."""
+    sql = re.sub(r"'(?:[^']|'')*'", "?", sql)
+    sql = re.sub(r"(?<![\w?])-?\d+(\.\d+)?\b", "?", sql)
+    sql = re.sub(r"\(\s*\?\d*(\s*,\s*\?\d*)*\s*\)", "(...)", sql)
+    sql = re.sub(r"\(\.\.\.\)(\s*,\s*\(\.\.\.\))+", "(...)", sql)
+    return " ".join(sql.split())
+
+
+def explain(con, sql, parameters):
+    """Get the query plan of a statement.
+
+    Args:
+        con (sqlite3.Connection): The connection the statement ran on.
+        sql (str): The statement.
+        parameters (tuple or dict): The statement's parameters.
+    Returns:
+        str: The plan as an indented tree, or None if it couldn't be explained."""
+    if parameters is None or not explainable.match(sql):
+        return None
+    try:
+        rows = con.cursor(sqlite3.Cursor).execute("EXPLAIN QUERY PLAN " + sql, parameters).fetchall()
+    except sqlite3.Error:
+        return None
+    depths, lines = {0: -1}, []
+    for id, parent, _, detail in rows:
+        depths[id] = depths.get(parent, -1) + 1
+        lines.append("  " * depths[id] + detail)
+    return "\n".join(lines)
+
+
+class sqlTracer:
+    def __init__(self, slowSeconds=0.1, logPath=None, maxStatements=1000, maxSlow=100):
+        """Count how often each statement runs and how long it takes, and log
+        the ones slower than slowSeconds with their query plan.
+
+        Args:
+            slowSeconds (float): Statements taking at least this long,
+                including reading their rows, are logged, default 0.1. (optional)
+            logPath (str): A file to append slow statements to as JSON
+                Lines, as well as logging them. (optional)
+            maxStatements (int): The most fingerprints to count, later ones
+                are counted together, default 1000. (optional)
+            maxSlow (int): The number of recent slow statements to keep for
+                stats, default 100. (optional)"""
+        self.slowSeconds = slowSeconds
+        self.logPath = logPath
+        self.maxStatements = maxStatements
+        self.lock = threading.Lock()
+        self.statements = {}
+        self.slow = collections.deque(maxlen=maxSlow)
+
+    def record(self, con, sql, parameters, seconds):
+        """Count a statement that finished.
+
+        Args:
+            con (sqlite3.Connection): The connection it ran on.
+            sql (str): The statement.
+            parameters (tuple or dict): Its parameters, None if unknown.
+            seconds (float): How long it took to run and read."""
+        key = fingerprint(sql)
+        with self.lock:
+            statement = self.statements.get(key)
+            if statement is None:
+                if len(self.statements) >= self.maxStatements:
+                    key = "(other statements)"
+                statement = self.statements.setdefault(key, [0, 0.0, 0.0])
+            statement[0] += 1
+            statement[1] += seconds
+            statement[2] = max(statement[2], seconds)
+
+        if seconds >= self.slowSeconds:
+            slow = {
+                "time": round(time.time(), 3),
+                "milliseconds": round(seconds * 1000, 3),
+                "fingerprint": key,
+                "sql": " ".join(sql.split()),
+                "plan": explain(con, sql, parameters)
+            }
+            logger.warning("Slow query (%.1f ms): %s\n%s", slow["milliseconds"], slow["sql"],
+                slow["plan"] or "(no plan)")
+            with self.lock:
+                self.slow.append(slow)
+                if self.logPath:
+                    with open(self.logPath, "a", encoding="utf-8") as file:
+                        file.write(json.dumps(slow) + "\n")
+
+    def stats(self, limit=50):
+        """Get the statements that took the most time.
+
+        Args:
+            limit (int): The most statements to list, default 50. (optional)
+        Returns:
+            dict: The "statements" with their fingerprint, count, total and
+                max milliseconds, and the most recent "slow" statements."""
+        with self.lock:
+            statements = sorted(self.statements.items(), key=lambda item: -item[1][1])[:limit]
+            slow = list(self.slow)
+        return {
+            "slowMilliseconds": self.slowSeconds * 1000,
+            "statements": [{
+                "fingerprint": key,
+                "count": count,
+                "totalMilliseconds": round(total * 1000, 3),
+                "maxMilliseconds": round(maximum * 1000, 3)
+            } for key, (count, total, maximum) in statements],
+            "slow": slow[::-1]
+        }
+
+    def clear(self):
+        """Forget every statement counted."""
+        with self.lock:
+            self.statements.clear()
+            self.slow.clear()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+import gzip
+import hashlib
+import json
+import os
+import sys
+import tempfile
+
+# Use brotli if it is installed, otherwise only gzip copies are made
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Files worth compressing, images and fonts are compressed already
+compressibleExtensions = (".css", ".html", ".ico", ".js", ".json", ".svg", ".txt", ".xml")
+
+
+class staticAssets:
+    def __init__(self, sourceDir, buildDir):
+        """Set up fingerprinting and precompression of static files.
+
+        Args:
+            sourceDir (str): The directory of static files.
+            buildDir (str): The directory to write compressed copies to."""
+        self.sourceDir = sourceDir
+        self.buildDir = buildDir
+        self.fingerprints = {}
+        self.assets = {}
+
+    @staticmethod
+    def encodings():
+        """Get the encodings that copies are made in, best first.
+
+        Returns:
+            list of str: The Content-Encoding names."""
+        return ["br", "gzip"] if brotli else ["gzip"]
+
+    def build(self):
+        """Hash every static file and write .gz and .br copies of the ones
+        that compress well. Copies that already exist for a file's current
+        hash are kept, so building again is quick.
+
+        Returns:
+            dict: The fingerprinted path of each file."""
+        os.makedirs(self.buildDir, exist_ok=True)
+        fingerprints, assets = {}, {}
+        for root, _, names in os.walk(self.sourceDir):
+            for name in names:
+                filePath = os.path.join(root, name)
+                path = os.path.relpath(filePath, self.sourceDir).replace(os.sep, "/")
+                with open(filePath, "rb") as file:
+                    data = file.read()
+                hash = hashlib.sha256(data).hexdigest()[:16]
+                base, extension = os.path.splitext(path)
+                fingerprint = f"{base}.{hash}{extension}"
+
+                encodings = {}
+                if extension.lower() in compressibleExtensions:
+                    for encoding in self.encodings():
+                        encodedPath = os.path.join(self.buildDir, hash + "." + encoding)
+                        if not os.path.exists(encodedPath):
+                            self.writeCompressed(data, encoding, encodedPath)
+                        encodings[encoding] = encodedPath
+
+                fingerprints[path] = fingerprint
+                assets[path] = {
+                    "path": filePath,
+                    "hash": hash,
+                    "fingerprinted": False,
+                    "encodings": encodings
+                }
+                assets[fingerprint] = dict(assets[path], fingerprinted=True)
+
+        with open(os.path.join(self.buildDir, "manifest.json"), "w") as file:
+            json.dump(fingerprints, file, indent=4, sort_keys=True)
+        self.fingerprints, self.assets = fingerprints, assets
+        return fingerprints
+
+    def writeCompressed(self, data, encoding, path):
+        """Compress a file at the highest level and write it atomically.
+
+        Args:
+            data (bytes): The file's content.
+            encoding (str): "br" or "gzip".
+            path (str): Where to write the compressed copy."""
+        if encoding == "br":
+            data = brotli.compress(data, quality=11)
+        else:
+            data = gzip.compress(data, compresslevel=9, mtime=0)
+        fd, tempPath = tempfile.mkstemp(dir=self.buildDir, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(data)
+            os.replace(tempPath, path)
+        finally:
+            if os.path.exists(tempPath):
+                os.remove(tempPath)
+
+    def url(self, path):
+        """Get the URL of a static file, fingerprinted if it was built.
+
+        Args:
+            path (str): The path of the file in the static directory.
+        Returns:
+            str: The URL."""
+        return "/static/" + self.fingerprints.get(path, path)
+
+    def get(self, path):
+        """Look up a built file by its path or fingerprinted path.
+
+        Args:
+            path (str): The path from the URL.
+        Returns:
+            dict: The file's path, hash, whether it was asked for by its
+                fingerprint and its compressed copies, or None."""
+        return self.assets.get(path)
+
+
+if __name__ == "__main__":
+    directory = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    buildDir = sys.argv[1] if len(sys.argv) > 1 else os.path.join(directory, "data", "static")
+    fingerprints = staticAssets(os.path.join(directory, "static"), buildDir).build()
+    print(f"Built {len(fingerprints)} static files into {buildDir}")
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+
+import bisect
+import heapq
+import re
+import threading
+import unicodedata
+
+from scripts.lruCache import lruCache
+
+# The order suggestions of each kind are listed in when they are as popular
+suggestionKinds = {"title": 0, "author": 1, "catalogue": 2}
+
+# Prefixes this short match too many keys to scan on every search, so their
+# most popular suggestions are kept until a suggestion they match changes
+headLength = 3
+
+
+def normalise(text):
+    """Fold the case and remove the accents of text, so "É" matches "e".
+
+    Args:
+        text (str): The text.
+    Returns:
+        str: The normalised text."""
+    text = unicodedata.normalize("NFKD", text)
+    return "".join(char for char in text if not unicodedata.combining(char)).casefold()
+
+
+class suggestIndex:
+    def __init__(self, loader, maxScan=20000, maxLimit=20, cacheSize=4096, beforeSearch=None):
+        """Set up an in memory index of titles, authors and catalogues that
+        start with, or have a word starting with, a prefix.
+
+        Each distinct text is a suggestion, ranked by the number of books
+        with it. Every word of a suggestion is a key in a sorted list, so
+        the suggestions for a prefix are found with a binary search.
+
+        Args:
+            loader (function): Returns every book as (bookID, title, author,
+                catalogues), used to build the index.
+            maxScan (int): The most keys to look at for one prefix longer
+                than headLength, default 20000. (optional)
+            maxLimit (int): The most suggestions a search can return, default 20. (optional)
+            cacheSize (int): The number of results to cache, default 4096. (optional)
+            beforeSearch (function): Called before each search, e.g. to
+                invalidate the index if another process changed books. (optional)"""
+        self.loader = loader
+        self.beforeSearch = beforeSearch
+        self.maxScan = maxScan
+        self.maxLimit = maxLimit
+        self.cache = lruCache(cacheSize)
+        self.lock = threading.RLock()
+        self.rebuildLock = threading.Lock()
+        self.books = {}
+        self.suggestions = {}
+        self.keys = []
+        self.heads = {}
+        self.built = False
+        self.stale = True
+        self.invalidations = 0
+        self.rebuilding = None
+        self.pending = None
+
+    def rebuild(self):
+        """Build the index again from every book.
+
+        The previous index is searched until the new one is ready. Books
+        set or removed while it loads are changed in both, so none are lost."""
+        with self.rebuildLock:
+            with self.lock:
+                invalidations = self.invalidations
+                self.pending = []
+            try:
+                books, suggestions = {}, {}
+                for bookID, title, author, catalogues in self.loader():
+                    books[bookID] = self.bookSuggestions(title, author, catalogues)
+                    for kind, text in books[bookID]:
+                        suggestion = suggestions.setdefault((kind, normalise(text)), [text, 0])
+                        suggestion[1] += 1
+                keys = sorted(key for id in suggestions for key in self.wordKeys(id))
+            finally:
+                with self.lock:
+                    pending, self.pending = self.pending, None
+                    if self.rebuilding is threading.current_thread():
+                        self.rebuilding = None
+
+            with self.lock:
+                self.books, self.suggestions, self.keys = books, suggestions, keys
+                self.heads = {}
+                for bookID, suggestions in pending:
+                    self.replaceBook(bookID, suggestions)
+                self.built = True
+                # Build it again next time if many books changed while it was loading
+                self.stale = invalidations != self.invalidations
+                self.cache.clear()
+
+    def refresh(self, wait=False):
+        """Rebuild the index on a background thread if it is stale, unless
+        it is already being rebuilt.
+
+        Args:
+            wait (bool): Wait until it is rebuilt, default False. (optional)"""
+        with self.lock:
+            if self.stale and self.rebuilding is None:
+                self.rebuilding = threading.Thread(target=self.rebuild, daemon=True)
+                self.rebuilding.start()
+            thread = self.rebuilding
+        if wait and thread is not None:
+            thread.join()
+
+    def invalidate(self):
+        """Rebuild the index before the next search, for changes to many books."""
+        with self.lock:
+            self.invalidations += 1
+            self.stale = True
+
+    @staticmethod
+    def bookSuggestions(title, author, catalogues):
+        """Get the suggestions from a book.
+
+        Returns:
+            list of tuple: The (kind, text) of each suggestion."""
+        suggestions = [("title", title), ("author", author)]
+        suggestions += [("catalogue", catalogue) for catalogue in catalogues or []]
+        return list(dict.fromkeys((kind, text.strip()) for kind, text in suggestions
+            if text and text.strip()))
+
+    @staticmethod
+    def wordKeys(id):
+        """Get the keys of a suggestion, one for each word it has.
+
+        Args:
+            id (tuple): The kind and normalised text of the suggestion.
+        Returns:
+            list of tuple: The keys, the text from a word onwards and the id."""
+        text = id[1]
+        return [(text[match.start():], id) for match in re.finditer(r"\w+", text)]
+
+    def setBook(self, bookID, title, author, catalogues):
+        """Add a book, or replace it if it was changed.
+
+        Args:
+            bookID (int): The ID of the book.
+            title (str): The title of the book.
+            author (str): The author of the book.
+            catalogues (list of str): The catalogues the book is in."""
+        suggestions = self.bookSuggestions(title, author, catalogues)
+        with self.lock:
+            if self.pending is not None:
+                self.pending.append((bookID, suggestions))
+            self.replaceBook(bookID, suggestions)
+
+    def removeBook(self, bookID):
+        """Remove a book.
+
+        Args:
+            bookID (int): The ID of the book."""
+        with self.lock:
+            if self.pending is not None:
+                self.pending.append((bookID, []))
+            self.replaceBook(bookID, [])
+
+    def replaceBook(self, bookID, suggestions):
+        """Replace a book's suggestions, the caller holds the lock.
+
+        Args:
+            bookID (int): The ID of the book.
+            suggestions (list of tuple): The book's suggestions from
+                bookSuggestions, none to remove it."""
+        for kind, text in self.books.pop(bookID, []):
+            id = (kind, normalise(text))
+            suggestion = self.suggestions[id]
+            suggestion[1] -= 1
+            self.changed(id)
+            if suggestion[1] <= 0:
+                del self.suggestions[id]
+                for key in self.wordKeys(id):
+                    index = bisect.bisect_left(self.keys, key)
+                    if index < len(self.keys) and self.keys[index] == key:
+                        del self.keys[index]
+
+        if suggestions:
+            self.books[bookID] = suggestions
+        for kind, text in suggestions:
+            id = (kind, normalise(text))
+            suggestion = self.suggestions.get(id)
+            if suggestion is None:
+                self.suggestions[id] = [text, 1]
+                for key in self.wordKeys(id):
+                    bisect.insort(self.keys, key)
+            else:
+                suggestion[1] += 1
+            self.changed(id)
+        self.cache.clear()
+
+    def changed(self, id):
+        """Forget the most popular suggestions of the short prefixes a
+        suggestion matches, after its count changed.
+
+        Args:
+            id (tuple): The kind and normalised text of the suggestion."""
+        for key, _ in self.wordKeys(id):
+            for length in range(1, headLength + 1):
+                self.heads.pop(key[:length], None)
+
+    def rank(self, ids, limit):
+        """Get the most popular suggestions.
+
+        Args:
+            ids (iterable of tuple): The ids of the suggestions to rank.
+            limit (int): The most suggestions to return.
+        Returns:
+            list of tuple: The ids of the most popular suggestions, in order."""
+        return heapq.nsmallest(limit, ids, key=lambda id: (
+            -self.suggestions[id][1], suggestionKinds[id[0]], id[1]))
+
+    def matches(self, prefix, maxScan=None):
+        """Get the suggestions with a word starting with a prefix.
+
+        Args:
+            prefix (str): The normalised prefix.
+            maxScan (int): The most keys to look at, default all of them. (optional)
+        Returns:
+            set of tuple: The ids of the suggestions."""
+        ids = set()
+        start = bisect.bisect_left(self.keys, (prefix,))
+        end = len(self.keys) if maxScan is None else min(start + maxScan, len(self.keys))
+        for index in range(start, end):
+            key, id = self.keys[index]
+            if not key.startswith(prefix):
+                break
+            ids.add(id)
+        return ids
+
+    def search(self, prefix, limit=8):
+        """Find the most popular suggestions with a word starting with a prefix.
+
+        Args:
+            prefix (str): What the user has typed so far.
+            limit (int): The most suggestions to return, default 8. (optional)
+        Returns:
+            list of dict: The suggestions' "text", "kind" and "count" of books."""
+        prefix = normalise(prefix).lstrip()
+        if not prefix or limit <= 0:
+            return []
+        if self.beforeSearch:
+            self.beforeSearch()
+        if self.stale:
+            # Only the first search waits, later ones use the previous index
+            self.refresh(wait=not self.built)
+
+        version = self.cache.version
+        results = self.cache.get((prefix, limit))
+        if results is not None:
+            return results
+
+        limit = min(limit, self.maxLimit)
+        with self.lock:
+            if len(prefix) <= headLength:
+                if prefix not in self.heads:
+                    self.heads[prefix] = self.rank(self.matches(prefix), self.maxLimit)
+                best = self.heads[prefix][:limit]
+            else:
+                best = self.rank(self.matches(prefix, self.maxScan), limit)
+            results = [{"text": self.suggestions[id][0], "kind": id[0],
+                "count": self.suggestions[id][1]} for id in best]
+        self.cache.set((prefix, limit), results, version)
+        return results
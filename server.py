@@ -3,16 +3,24 @@
 import flask
 import logging
 import os
+import socket
 import sys
+import time
 
 import scripts.routes as routes
 from scripts.database import database
+from scripts.jobQueue import jobQueue
+from scripts.prefork import supervisor
+from scripts.sessionStore import memorySessionStore, sessionInterface, sqliteSessionStore
+from scripts.staticAssets import staticAssets
 
 # Get variables from argv or use the defaults
 argv = {}
 for arg, var, default in [
     ("--host",      "host",     "0.0.0.0"),
     ("--port",      "port",     "80"),
+    ("--workers",   "workers",  "1"),
+    ("--slow-sql",  "slowSql",  None),
     ("--data-dir",  "dataDir",  os.path.join(os.path.dirname(__file__), "data"))
 ]:
     if arg in sys.argv:
@@ -20,21 +28,102 @@ for arg, var, default in [
     else:
         argv[var] = default
 
-def createServer(dataDir=argv["dataDir"], filename="database.db"):
+# Connection pool and pragmas used for the server's database
+databaseSettings = {
+    "poolSize": 8,
+    "journalMode": "WAL",
+    "synchronous": "NORMAL",
+    "cacheSize": -16000,
+    "mmapSize": 256 * 1024 * 1024,
+    "busyTimeout": 5000,
+    "bcryptRounds": 12,
+    "hashWorkers": 2,
+    "maxPendingHashes": 6
+}
+
+# Trace SQL and log statements slower than --slow-sql milliseconds with their plans
+if argv["slowSql"]:
+    databaseSettings["slowQuerySeconds"] = float(argv["slowSql"]) / 1000
+    databaseSettings["slowQueryLog"] = os.path.join(argv["dataDir"], "slowQueries.jsonl")
+
+# Look for books changed by other processes, such as import scripts writing
+# to the same database, with --check-changes. Workers always look.
+if "--check-changes" in sys.argv:
+    databaseSettings["checkChanges"] = True
+
+def loadSecretKey(dataDir):
+    """Get the secret key kept in the data directory, making it if needed,
+    so every process and restart signs things with the same key.
+
+    Args:
+        dataDir (str): The directory where data is stored.
+
+    Returns:
+        bytes: The secret key."""
+    os.makedirs(dataDir, exist_ok=True)
+    path = os.path.join(dataDir, "secret.key")
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        pass
+    else:
+        with os.fdopen(fd, "wb") as file:
+            file.write(os.urandom(32))
+
+    # Another process may still be writing a new key
+    for _ in range(50):
+        with open(path, "rb") as file:
+            key = file.read()
+        if len(key) == 32:
+            return key
+        time.sleep(0.01)
+    raise ValueError(f"Invalid secret key in {path}")
+
+def createServer(dataDir=argv["dataDir"], filename="database.db", jobWorkers=2,
+        sessions="memory", **settings):
     """Create a database and server object.
+
+    Args:
+        dataDir (str): The directory where data is stored.
+        filename (str): The name of the database file.
+        jobWorkers (int): The number of background job threads, 0 runs jobs
+            during the request that queued them.
+        sessions (str): Where to keep sessions, "memory" for a single
+            process or "sqlite" to share them between processes.
+        **settings: Overrides for databaseSettings, e.g. poolSize=0 to
+            open a new connection for every query.
     
     Returns:
         flask.Flask: The server object."""
-    app = flask.Flask(__name__)
+    app = flask.Flask(__name__, static_folder=None)
     app.config["SESSION_PERMANENT"] = False
-    app.config["SESSION_TYPE"] = "filesystem"
+    app.config["SESSION_COOKIE_SAMESITE"] = "Lax"
     app.config["TEMPLATES_AUTO_RELOAD"] = True
-    app.secret_key = os.urandom(32)
+    app.secret_key = loadSecretKey(dataDir)
 
-    db = database(dataDir, filename)
+    db = database(dataDir, filename, **{**databaseSettings, **settings})
     db.executeScript("databaseStructure.sql")
+    db.migrate()
+    db.backfillSearchIndex()
+    db.syncCaches()
+    db.suggestions.rebuild()
     app.db = db
 
+    lifetime = int(app.permanent_session_lifetime.total_seconds())
+    if sessions == "sqlite":
+        app.sessions = sqliteSessionStore(db, lifetime)
+    else:
+        app.sessions = memorySessionStore(lifetime=lifetime)
+    app.session_interface = sessionInterface(app.sessions)
+
+    app.jobs = jobQueue(db, jobWorkers)
+    app.jobs.start()
+
+    app.assets = staticAssets(os.path.join(os.path.dirname(__file__), "static"),
+        os.path.join(dataDir, "static"))
+    app.assets.build()
+    db.placeholderCoverURL = app.assets.url("img/cover.jpg")
+
     return routes.setUpRoutes(app)
 
 # Use waitress as the WSGI server if it is installed,
@@ -47,6 +136,73 @@ if not "--werkzeug" in sys.argv:
     except:
         print("Waitress is not installed, using built-in WSGI server (werkzeug).")
 
+def waitressMetrics(dispatcher):
+    """Make a collector for how busy waitress's threads are.
+
+    Args:
+        dispatcher (waitress.task.ThreadedTaskDispatcher): The server's dispatcher.
+    Returns:
+        function: The collector for requestMetrics.addCollector."""
+    def collect():
+        return [
+            ("diya_waitress_queue_depth", "gauge", "Requests waiting for a waitress thread.",
+                len(dispatcher.queue)),
+            ("diya_waitress_active_threads", "gauge", "Waitress threads handling a request.",
+                dispatcher.active_count),
+            ("diya_waitress_threads", "gauge", "Waitress threads.", len(dispatcher.threads))
+        ]
+    return collect
+
+def serve(app, sock=None):
+    """Serve the app with waitress or werkzeug until stopped.
+
+    Args:
+        app (flask.Flask): The server object.
+        sock (socket.socket): A listening socket to serve on instead of
+            --host and --port. (optional)"""
+    if useWaitress:
+        # Waitress warns when requests queue up, the depth is also in /admin/metrics
+        logging.basicConfig()
+        address = {"sockets": [sock]} if sock else {"host": argv["host"], "port": argv["port"]}
+        server = waitress.create_server(app, threads=8, **address,
+            ident=f"DIYA-Inc/1.0 (Python/{sys.version.split()[0]}; Waitress)")
+        app.metrics.addCollector(waitressMetrics(server.task_dispatcher))
+        server.print_listen("Serving on http://{}:{}")
+        server.run()
+    elif sock:
+        from werkzeug.serving import make_server
+        make_server(argv["host"], int(argv["port"]), app, threaded=True,
+            fd=sock.fileno()).serve_forever()
+    else:
+        app.run(host=argv["host"], port=argv["port"])
+
+def serveWorkers(workers):
+    """Serve with pre-forked worker processes sharing one listening socket.
+
+    Args:
+        workers (int): The number of worker processes."""
+    # Migrate the database, build static files and queue removing stored
+    # files left by unfinished transactions once before forking, without
+    # starting any threads
+    app = createServer(jobWorkers=0, sessions="sqlite", poolSize=0)
+    app.db.queueJob("sweepBlobs")
+    app.db.closeConnections()
+    del app
+
+    sock = socket.create_server((argv["host"], int(argv["port"])), backlog=1024)
+
+    def runWorker(index):
+        app = createServer(sessions="sqlite", checkChanges=True)
+        try:
+            serve(app, sock)
+        finally:
+            app.jobs.stop(timeout=5)
+            app.db.closeConnections()
+
+    print(f"Starting {workers} workers at http://{argv['host']}:{argv['port']}/")
+    supervisor(runWorker, workers).run()
+    sock.close()
+
 if __name__ == "__main__":
     if "--help" in sys.argv:
         print("DIYA Inc Book Server")
@@ -56,18 +212,28 @@ if __name__ == "__main__":
         print("  --help            Display this help and exit")
         print("  --host HOST       Set the servers host IP")
         print("  --port PORT       Set the servers port")
+        print("  --workers N       Serve with N worker processes (not on Windows)")
         print("  --werkzeug        Use werkzeug instead of waitress")
+        print("  --check-changes   Drop cached books changed by other processes, e.g. imports")
+        print("  --slow-sql MS     Trace SQL and log statements slower than MS milliseconds")
         print("  --data-dir DIR    Set the directory where data is stored")
         exit(0)
 
-    app = createServer()
+    workers = int(argv["workers"])
+    if workers > 1 and not hasattr(os, "fork"):
+        print("--workers needs os.fork, using a single process.")
+        workers = 1
 
     # Run server
-    if useWaitress:
-        print(f"Starting server at http://{argv['host']}:{argv['port']}/")
-        logging.getLogger("waitress.queue").setLevel(logging.CRITICAL)
-        waitress.serve(app, host=argv["host"], port=argv["port"], threads=8, 
-            ident=f"DIYA-Inc/1.0 (Python/{sys.version.split()[0]}; Waitress)")
-        print()
+    if workers > 1:
+        serveWorkers(workers)
     else:
-        app.run(host=argv["host"], port=argv["port"])
+        app = createServer()
+        # Remove stored files left by transactions that never finished
+        app.db.queueJob("sweepBlobs")
+        app.jobs.notify()
+        if useWaitress:
+            print(f"Starting server at http://{argv['host']}:{argv['port']}/")
+        serve(app)
+        print()
+        app.jobs.stop(timeout=5)
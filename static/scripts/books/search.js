@@ -0,0 +1,39 @@
+"use strict";
+
+/**
+ * Replace the "More results" link with the next page of results.
+ *
+ * @param {HTMLAnchorElement} link The "More results" link.
+ */
+function loadMoreResults(link) {
+    var xhr = new XMLHttpRequest();
+    xhr.open("GET", link.dataset.results, true);
+    xhr.onreadystatechange = function () {
+        if (xhr.readyState === 4 && xhr.status === 200) {
+            link.insertAdjacentHTML("afterend", xhr.responseText);
+            link.remove();
+            watchMoreResults();
+        }
+    };
+    xhr.send();
+}
+
+/**
+ * Load the next page of results when the "More results" link is close to
+ * being scrolled into view. Without IntersectionObserver the link is kept.
+ */
+function watchMoreResults() {
+    var link = document.querySelector(".loadMore");
+    if (!link || !("IntersectionObserver" in window)) {
+        return;
+    }
+    var observer = new IntersectionObserver((entries) => {
+        if (entries[0].isIntersecting) {
+            observer.disconnect();
+            loadMoreResults(link);
+        }
+    }, { rootMargin: "800px" });
+    observer.observe(link);
+}
+
+document.addEventListener("DOMContentLoaded", watchMoreResults);
@@ -0,0 +1,43 @@
+"use strict";
+
+/**
+ * Fill the search box's list with suggestions as the user types. Requests
+ * are only sent after a short pause, and responses to older requests are
+ * ignored.
+ */
+function watchSuggestions() {
+    var input = document.getElementById("query");
+    var list = document.getElementById("suggestions");
+    if (!input || !list) {
+        return;
+    }
+    var timer = null;
+    var latest = 0;
+
+    input.addEventListener("input", () => {
+        clearTimeout(timer);
+        var prefix = input.value.trim();
+        if (!prefix) {
+            list.replaceChildren();
+            return;
+        }
+        timer = setTimeout(() => {
+            var request = ++latest;
+            var xhr = new XMLHttpRequest();
+            xhr.open("GET", "/api/books/suggest?prefix=" + encodeURIComponent(prefix), true);
+            xhr.onreadystatechange = function () {
+                if (xhr.readyState === 4 && xhr.status === 200 && request === latest) {
+                    list.replaceChildren(...JSON.parse(xhr.responseText).map((suggestion) => {
+                        var option = document.createElement("option");
+                        option.value = suggestion.text;
+                        option.label = suggestion.kind;
+                        return option;
+                    }));
+                }
+            };
+            xhr.send();
+        }, 150);
+    });
+}
+
+document.addEventListener("DOMContentLoaded", watchSuggestions);
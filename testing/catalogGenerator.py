@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+import itertools
+import os
+import random
+import sys
+import time
+
+directory = os.path.dirname(os.path.realpath(__file__))
+if "testing" == directory.split(os.sep)[-1]:
+    sys.path.append(os.path.dirname(directory))
+
+from scripts.database import database
+
+# Syllables words are made from, so there are thousands of distinct words
+# for the search index like a real catalogue
+syllables = ("an", "bel", "cor", "da", "el", "fen", "gar", "hol", "in", "jor", "ka", "lin",
+    "mar", "nor", "o", "pel", "quin", "ros", "sa", "tor", "u", "val", "wen", "xi", "yor", "zel")
+commonWords = ("the", "of", "and", "a", "in", "to", "river", "garden", "shadow", "winter",
+    "python", "linux", "empire", "ocean", "machine", "silver", "forest", "history", "island",
+    "network", "summer", "dragon", "kitchen", "secret", "planet", "engine", "letters", "journey")
+firstNames = ("James", "Mary", "Robert", "Patricia", "John", "Jennifer", "Michael", "Linda",
+    "David", "Elizabeth", "William", "Barbara", "Richard", "Susan", "Joseph", "Jessica",
+    "Thomas", "Sarah", "Chen", "Aisha", "Hiroshi", "Olga", "Mateo", "Priya", "Kwame", "Ingrid")
+genres = ("Fiction", "Fantasy", "Science Fiction", "Mystery", "Romance", "History",
+    "Biography", "Programming", "Science", "Travel", "Cooking", "Poetry", "Children", "Horror")
+# Languages with how common they are
+languages = (("en", 70), ("fr", 8), ("de", 7), ("es", 7), ("it", 3), ("ja", 3), ("zh", 2))
+
+
+def zipfWeights(count, exponent=1.1):
+    """Get cumulative weights where the nth item is picked about 1/n^exponent
+    as often as the first, like word and author popularity.
+
+    Args:
+        count (int): The number of items.
+        exponent (float): How quickly popularity falls, default 1.1. (optional)
+    Returns:
+        list of float: The cumulative weights for random.choices."""
+    return list(itertools.accumulate(1 / (rank ** exponent) for rank in range(1, count + 1)))
+
+
+def isbn13(number):
+    """Make a valid ISBN-13 from a number, so every book's ISBN is unique.
+
+    Args:
+        number (int): The number, less than 10^9.
+    Returns:
+        str: The ISBN with its check digit."""
+    digits = f"978{number:09d}"
+    total = sum(int(digit) * (3 if index % 2 else 1) for index, digit in enumerate(digits))
+    return digits + str((10 - total % 10) % 10)
+
+
+class catalogGenerator:
+    def __init__(self, books, seed=1):
+        """Set up a deterministic generator of realistic books, so the same
+        seed and scale always make the same catalogue.
+
+        Words, authors and catalogues are picked with Zipf weights, so some
+        are in many books and most are in a few, and the number of authors,
+        publishers and catalogues grows with the number of books.
+
+        Args:
+            books (int): The number of books the catalogue will have.
+            seed (int): The random seed, default 1. (optional)"""
+        self.rng = random.Random(seed)
+        rng = self.rng
+
+        words = set()
+        while len(words) < 5000:
+            words.add("".join(rng.choices(syllables, k=rng.randint(2, 4))))
+        self.words = list(commonWords) + sorted(words)
+        rng.shuffle(self.words)
+        self.wordWeights = zipfWeights(len(self.words))
+
+        surnames = sorted({"".join(rng.choices(syllables, k=rng.randint(2, 3))).title()
+            for _ in range(max(200, books // 20))})
+        self.authors = [f"{rng.choice(firstNames)} {surname}" for surname in surnames]
+        self.authorWeights = zipfWeights(len(self.authors), 0.9)
+        self.publishers = [" ".join(self.pickWords(2)).title() + " " + rng.choice(("Press", "Books", "Publishing"))
+            for _ in range(max(20, books // 500))]
+        self.catalogues = sorted({" ".join(self.pickWords(rng.randint(1, 2))).title()
+            for _ in range(max(30, books // 100))})
+        self.catalogueWeights = zipfWeights(len(self.catalogues))
+        self.languages, self.languageWeights = zip(*languages)
+
+    def pickWords(self, count):
+        """Pick words, the common ones more often."""
+        return self.rng.choices(self.words, cum_weights=self.wordWeights, k=count)
+
+    def book(self, number):
+        """Make a book.
+
+        Args:
+            number (int): The book's number, which its ISBN is made from.
+        Returns:
+            dict: The book's addBookMetadata arguments."""
+        rng = self.rng
+        catalogues = rng.choices(self.catalogues, cum_weights=self.catalogueWeights,
+            k=rng.choice((0, 1, 1, 2, 2, 3, 4)))
+        return {
+            "title": " ".join(self.pickWords(rng.randint(1, 6))).capitalize()[:128],
+            "author": rng.choices(self.authors, cum_weights=self.authorWeights)[0],
+            "isbn": isbn13(number),
+            "publisher": rng.choice(self.publishers),
+            "publicationDate": f"{rng.randint(1900, 2024)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+            "description": " ".join(self.pickWords(rng.randint(20, 80))).capitalize() + ".",
+            "pageCount": rng.randint(32, 1200),
+            "language": rng.choices(self.languages, self.languageWeights)[0],
+            "genre": rng.choice(genres),
+            "readingAge": rng.choice((None, 5, 8, 12, 16, 18)),
+            "catalogues": list(dict.fromkeys(catalogues))
+        }
+
+    def books(self, count, start=0):
+        """Make books.
+
+        Args:
+            count (int): The number of books.
+            start (int): The number of the first book, default 0. (optional)
+        Yields:
+            dict: Each book's addBookMetadata arguments."""
+        for number in range(start, start + count):
+            yield self.book(number)
+
+
+def generateCatalog(db, books, users=0, seed=1, batchSize=10000, progress=None):
+    """Fill a database with generated books, catalogues and users, adding
+    them in batches with database.addBooks and addUsers.
+
+    Args:
+        db (database): The database to fill, best opened with
+            synchronous="OFF" and a large cacheSize while it's filled.
+        books (int): The number of books.
+        users (int): The number of users, each with the password
+            "Password-generated", default 0. (optional)
+        seed (int): The random seed, default 1. (optional)
+        batchSize (int): The number of books per transaction, default 10000. (optional)
+        progress (function): Called with the number of books added after
+            each batch. (optional)
+    Returns:
+        dict: The number of books and users added and the seconds it took."""
+    start = time.monotonic()
+    generator = catalogGenerator(books, seed)
+    added = 0
+    for batchStart in range(0, books, batchSize):
+        batch = list(generator.books(min(batchSize, books - batchStart), batchStart))
+        added += sum(error is None for error in db.addBooks(batch))
+        if progress:
+            progress(batchStart + len(batch))
+
+    addedUsers = 0
+    for batchStart in range(0, users, batchSize):
+        addedUsers += db.addUsers([f"user{number}@example.com"
+            for number in range(batchStart, min(users, batchStart + batchSize))], "Password-generated")
+    return {"books": added, "users": addedUsers, "seconds": round(time.monotonic() - start, 3)}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or "--help" in sys.argv:
+        print("Usage: python -m testing.catalogGenerator BOOKS [options]")
+        print("Fills a database with BOOKS generated books, e.g. 100000.")
+        print("Options:")
+        print("  --data-dir DIR    Set the directory of the database, default ./benchmarkData")
+        print("  --users N         Set the number of users, default BOOKS / 10")
+        print("  --seed N          Set the random seed, default 1")
+        exit(0)
+
+    books = int(float(sys.argv[1]))
+    options = {}
+    for arg, var, default in [
+        ("--data-dir", "dataDir", os.path.join(os.path.dirname(directory), "benchmarkData")),
+        ("--users",    "users",   str(books // 10)),
+        ("--seed",     "seed",    "1")
+    ]:
+        options[var] = sys.argv[sys.argv.index(arg) + 1] if arg in sys.argv else default
+
+    db = database(options["dataDir"], "database.db", journalMode="WAL", synchronous="OFF",
+        cacheSize=-256000, bcryptRounds=4)
+    db.executeScript("databaseStructure.sql")
+    db.migrate()
+    result = generateCatalog(db, books, int(options["users"]), int(options["seed"]),
+        progress=lambda done: print(f"\r{done}/{books} books", end="", flush=True))
+    print(f"\nAdded {result['books']} books and {result['users']} users in {result['seconds']} seconds")
@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+
+import gc
+import itertools
+import json
+import os
+import random
+import resource
+import sys
+import time
+import tracemalloc
+
+directory = os.path.dirname(os.path.realpath(__file__))
+if "testing" == directory.split(os.sep)[-1]:
+    sys.path.append(os.path.dirname(directory))
+
+from scripts.database import database
+from testing.catalogGenerator import catalogGenerator, generateCatalog, genres, isbn13
+from testing.loadTest import percentile
+
+# Books the write benchmarks add are numbered from here, after any
+# generated book, so they can be found and deleted after
+benchmarkBookNumber = 900000000
+
+
+def openDatabase(dataDir, books, seed=1, **settings):
+    """Open the benchmark database, generating its catalogue if it's empty.
+
+    Args:
+        dataDir (str): The directory of the database.
+        books (int): The number of books to generate if it's empty.
+        seed (int): The random seed, default 1. (optional)
+        **settings: Overrides for the database's settings, which are the
+            server's by default.
+    Returns:
+        database: The database."""
+    settings = {"journalMode": "WAL", "synchronous": "NORMAL", "cacheSize": -16000,
+        "mmapSize": 256 * 1024 * 1024, "bcryptRounds": 4, **settings}
+    db = database(dataDir, "database.db", **settings)
+    db.executeScript("databaseStructure.sql")
+    db.migrate()
+
+    con, cur = db.connect()
+    existing = cur.execute("SELECT COUNT(*) FROM books").fetchone()[0]
+    con.close()
+    if not existing:
+        loader = database(dataDir, "database.db", journalMode="WAL", synchronous="OFF",
+            cacheSize=-256000, bcryptRounds=4)
+        result = generateCatalog(loader, books, books // 10, seed,
+            progress=lambda done: print(f"\rGenerating {done}/{books} books", end="", flush=True))
+        print(f"\nGenerated {result['books']} books and {result['users']} users in {result['seconds']} seconds")
+        loader.closeConnections()
+    db.suggestions.rebuild()
+    return db
+
+
+class benchmarkData:
+    def __init__(self, db, seed=1):
+        """Read what the benchmarks pick their arguments from.
+
+        Args:
+            db (database): The benchmark database.
+            seed (int): The random seed, default 1. (optional)"""
+        self.db = db
+        self.rng = random.Random(seed)
+        self.cleanUp()
+        con, cur = db.connect()
+        self.bookIDs = [bookID for (bookID,) in cur.execute("SELECT bookID FROM books").fetchall()]
+        self.catalogues = [name for (name,) in cur.execute(
+            "SELECT catalogueName FROM bookCatalogues ORDER BY catalogueName").fetchall()]
+        con.close()
+        if not self.bookIDs:
+            raise ValueError("The database has no books to benchmark.")
+
+        # Words are picked as often as the generated books have them
+        self.generator = catalogGenerator(len(self.bookIDs), seed)
+        self.nextNumber = benchmarkBookNumber
+        self.toDelete = []
+
+    def word(self):
+        """Pick a word from the catalogue."""
+        return self.generator.pickWords(1)[0]
+
+    def newBooks(self, count):
+        """Make books with ISBNs that no generated book has."""
+        books = list(self.generator.books(count, self.nextNumber))
+        self.nextNumber += count
+        return books
+
+    def addedBookIDs(self):
+        """Get the IDs of the books the write benchmarks added."""
+        con, cur = self.db.connect()
+        bookIDs = [bookID for (bookID,) in cur.execute("SELECT bookID FROM books WHERE ISBN >= ?",
+            (isbn13(benchmarkBookNumber),)).fetchall()]
+        con.close()
+        return bookIDs
+
+    def cleanUp(self):
+        """Delete the books the write benchmarks added, so the catalogue is
+        as it was generated even if an earlier run was stopped."""
+        for bookID in self.addedBookIDs():
+            self.db.deleteBook(bookID)
+
+
+def searchWord(data):
+    query = data.word()
+    return lambda: data.db.searchBooks(query, limit=20)
+
+
+def searchWords(data):
+    query = " ".join(data.generator.pickWords(2))
+    return lambda: data.db.searchBooks(query, limit=20)
+
+
+def searchRelevance(data):
+    query = data.word()
+    return lambda: data.db.searchBooks(query, limit=20, sort="relevance")
+
+
+def searchFilters(data):
+    genre, language = data.rng.choice(genres), data.rng.choice(("en", "fr", "de"))
+    return lambda: data.db.searchBooks(genre=genre, language=language, limit=20, sort="publicationDate")
+
+
+def searchCatalogue(data):
+    catalogue = data.rng.choice(data.catalogues)
+    return lambda: data.db.searchBooks(catalogue=catalogue, limit=20)
+
+
+def searchOffset(data):
+    offset = data.rng.randrange(len(data.bookIDs))
+    return lambda: data.db.searchBooks(limit=20, offset=offset)
+
+
+def searchAfter(data):
+    """Get the page of a search after a random book, by its cursor."""
+    query = data.word()
+    page = data.db.searchBooks(query, limit=20)
+    after = (page[-1]["sortKey"], page[-1]["bookID"]) if page else None
+    return lambda: data.db.searchBooks(query, limit=20, after=after)
+
+
+def bookUncached(data):
+    bookID = data.rng.choice(data.bookIDs)
+    data.db.metadataCache.invalidate(bookID)
+    return lambda: data.db.getBookMetadata(bookID)
+
+
+def bookCached(data):
+    bookID = data.bookIDs[data.rng.randrange(min(100, len(data.bookIDs)))]
+    data.db.getBookMetadata(bookID)
+    return lambda: data.db.getBookMetadata(bookID)
+
+
+def booksMetadata(data):
+    bookIDs = data.rng.sample(data.bookIDs, min(50, len(data.bookIDs)))
+    return lambda: data.db.getBooksMetadata(bookIDs)
+
+
+def facetsQuery(data):
+    query = data.word()
+    return lambda: data.db.bookFacets(query)
+
+
+def suggest(data):
+    prefix = data.word()[:data.rng.randint(1, 4)]
+    return lambda: data.db.suggestions.search(prefix)
+
+
+def export(data):
+    return lambda: sum(1 for _ in itertools.islice(data.db.exportBooks(), 5000))
+
+
+def addBook(data):
+    book = data.newBooks(1)[0]
+    return lambda: data.db.addBookMetadata(**book)
+
+
+def updateBook(data):
+    """Rewrite every field and catalogue of a book a benchmark added."""
+    bookIDs = data.addedBookIDs()
+    if not bookIDs:
+        bookIDs = [data.db.addBookMetadata(**data.newBooks(1)[0])]
+    bookID, book = data.rng.choice(bookIDs), data.newBooks(1)[0]
+    return lambda: data.db.updateBookMetadata(bookID, **book)
+
+
+def addBooks(data):
+    books = data.newBooks(100)
+    return lambda: data.db.addBooks(books)
+
+
+def deleteBook(data):
+    """Delete a book a benchmark added, each call deleting a different one."""
+    if not data.toDelete:
+        data.toDelete = data.addedBookIDs()
+        if not data.toDelete:
+            data.db.addBooks(data.newBooks(100))
+            data.toDelete = data.addedBookIDs()
+    bookID = data.toDelete.pop()
+    return lambda: data.db.deleteBook(bookID)
+
+
+# Each benchmark makes a call from the data, so picking its arguments isn't
+# timed, and has the fraction of --repeat calls to make. The write benchmarks
+# add books with their own ISBNs, which are deleted after.
+benchmarks = {
+    "searchBooks.all": (lambda data: lambda: data.db.searchBooks(limit=20), 1),
+    "searchBooks.word": (searchWord, 1),
+    "searchBooks.words": (searchWords, 1),
+    "searchBooks.relevance": (searchRelevance, 1),
+    "searchBooks.filters": (searchFilters, 1),
+    "searchBooks.catalogue": (searchCatalogue, 1),
+    "searchBooks.offset": (searchOffset, 1),
+    "searchBooks.after": (searchAfter, 1),
+    "getBookMetadata.uncached": (bookUncached, 1),
+    "getBookMetadata.cached": (bookCached, 1),
+    "getBooksMetadata": (booksMetadata, 1),
+    "randomBooks": (lambda data: lambda: data.db.randomBooks(4), 1),
+    "bookFacets": (lambda data: data.db.bookFacets, 1),
+    "bookFacets.query": (facetsQuery, 0.2),
+    "suggestions.search": (suggest, 1),
+    "suggestions.rebuild": (lambda data: data.db.suggestions.rebuild, 0.01),
+    "exportBooks": (export, 0.02),
+    "addBookMetadata": (addBook, 0.2),
+    "updateBookMetadata": (updateBook, 0.2),
+    "addBooks": (addBooks, 0.02),
+    "deleteBook": (deleteBook, 0.2)
+}
+
+
+def runBenchmark(name, data, repeat=200, memoryCalls=10):
+    """Time a benchmark's calls, then measure the memory a few more allocate.
+
+    Memory is traced in its own calls, as tracemalloc slows everything down.
+
+    Args:
+        name (str): The benchmark, a key of benchmarks.
+        data (benchmarkData): What the benchmarks pick their arguments from.
+        repeat (int): The calls to make for a benchmark with a weight of
+            1, default 200. (optional)
+        memoryCalls (int): The most calls to trace memory in, default 10. (optional)
+    Returns:
+        dict: The calls, calls per second, latency in milliseconds and the
+            most KiB allocated during a call."""
+    makeCall, weight = benchmarks[name]
+    calls = max(1, int(repeat * weight))
+    prepared = [makeCall(data) for _ in range(calls)]
+
+    gc.collect()
+    latencies = []
+    for call in prepared:
+        start = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - start)
+
+    traced = [makeCall(data) for _ in range(min(calls, memoryCalls))]
+    peak = 0
+    tracemalloc.start()
+    for call in traced:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        call()
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - before)
+    tracemalloc.stop()
+
+    total = sum(latencies)
+    latencies.sort()
+    return {
+        "calls": calls,
+        "throughput": round(calls / total, 2) if total else 0.0,
+        "mean": round(total / calls * 1000, 3),
+        "p50": round(percentile(latencies, 0.5) * 1000, 3),
+        "p95": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99": round(percentile(latencies, 0.99) * 1000, 3),
+        "max": round(latencies[-1] * 1000, 3),
+        "peakKiB": round(peak / 1024, 1)
+    }
+
+
+def run(names, dataDir, books=100000, repeat=200, seed=1):
+    """Open or generate the database and run benchmarks against it.
+
+    Args:
+        names (list of str): The benchmarks to run, in order.
+        dataDir (str): The directory of the database, which is kept.
+        Others: See openDatabase and runBenchmark.
+    Returns:
+        dict: The settings and each benchmark's results."""
+    db = openDatabase(dataDir, books, seed)
+    data = benchmarkData(db, seed)
+    results = {}
+    try:
+        for name in names:
+            results[name] = runBenchmark(name, data, repeat)
+            print(f"{name:>26}: {results[name]['throughput']:>10}/s  mean {results[name]['mean']:>9} ms  "
+                f"p95 {results[name]['p95']:>9} ms  p99 {results[name]['p99']:>9} ms  "
+                f"peak {results[name]['peakKiB']:>9} KiB", flush=True)
+    finally:
+        data.cleanUp()
+        db.closeConnections()
+
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "settings": {"books": len(data.bookIDs), "catalogues": len(data.catalogues),
+            "repeat": repeat, "seed": seed},
+        "maxRssKiB": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "benchmarks": results
+    }
+
+
+if __name__ == "__main__":
+    if "--help" in sys.argv:
+        print("Usage: python -m testing.databaseBenchmarks [options]")
+        print("Times database methods against a generated catalogue, generating it if needed.")
+        print("Options:")
+        print("  --benchmarks A,B   Set the benchmarks to run, default all of:")
+        print("                     " + ", ".join(benchmarks))
+        print("  --books N          Set the number of books to generate, default 100000")
+        print("  --data-dir DIR     Set the directory of the database, default ./benchmarkData")
+        print("  --repeat N         Set the calls to make of the quick benchmarks, default 200")
+        print("  --seed N           Set the random seed, default 1")
+        print("  --output FILE      Set where to save the results as JSON")
+        exit(0)
+
+    options = {}
+    for arg, var, default in [
+        ("--benchmarks", "benchmarks", ",".join(benchmarks)),
+        ("--books",      "books",      "100000"),
+        ("--data-dir",   "dataDir",    os.path.join(os.path.dirname(directory), "benchmarkData")),
+        ("--repeat",     "repeat",     "200"),
+        ("--seed",       "seed",       "1"),
+        ("--output",     "output",     None)
+    ]:
+        options[var] = sys.argv[sys.argv.index(arg) + 1] if arg in sys.argv else default
+
+    names = options["benchmarks"].split(",")
+    for name in names:
+        if name not in benchmarks:
+            print(f"Unknown benchmark {name}, use one of: {', '.join(benchmarks)}")
+            exit(2)
+
+    results = run(names, options["dataDir"], int(float(options["books"])),
+        int(options["repeat"]), int(options["seed"]))
+    print(f"Peak memory of the process: {results['maxRssKiB']} KiB")
+    if options["output"]:
+        with open(options["output"], "w") as file:
+            json.dump(results, file, indent=4)
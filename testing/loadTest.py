@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+
+import http.client
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+directory = os.path.dirname(os.path.realpath(__file__))
+if "testing" == directory.split(os.sep)[-1]:
+    sys.path.append(os.path.dirname(directory))
+
+from scripts.bulkImport import bulkImport
+from scripts.database import database
+from testing.utils import makeEpub
+
+serverDirectory = os.path.dirname(directory)
+
+# Words books and searches are made from, so searches find a few books each
+words = ("river", "garden", "shadow", "winter", "python", "linux", "empire", "ocean",
+    "machine", "silver", "forest", "history", "island", "network", "summer", "dragon",
+    "kitchen", "secret", "planet", "engine", "letters", "mountain", "circuit", "journey")
+genres = ("Fiction", "Fantasy", "History", "Programming", "Science", "Travel", "Cooking")
+languages = ("en", "fr", "de", "es")
+
+
+def seedData(dataDir, books=2000, users=20, files=20, seed=1):
+    """Fill a data directory with books, book files and users to load test.
+
+    Args:
+        dataDir (str): The data directory, a database.db in it is reused
+            if it already has users.
+        books (int): The number of books without files, default 2000. (optional)
+        users (int): The number of users, default 20. (optional)
+        files (int): The number of books with an EPUB and cover, default 20. (optional)
+        seed (int): The random seed, so the same data is made every time. (optional)
+    Returns:
+        dict: The "users" as (email, password), the "bookIDs" and the
+            "fileHashes" of the books with files."""
+    rng = random.Random(seed)
+    db = database(dataDir, "database.db", journalMode="WAL", synchronous="NORMAL")
+    db.executeScript("databaseStructure.sql")
+    db.migrate()
+    accounts = [(f"reader{i}@example.com", f"Password-{i:04d}") for i in range(users)]
+
+    con, cur = db.connect()
+    seeded = cur.execute("SELECT COUNT(*) FROM users").fetchone()[0] > 0
+    con.close()
+    if not seeded:
+        for email, password in accounts:
+            db.addUser(email, password)
+        db.addBooks([{
+            "title": " ".join(rng.sample(words, 3)).title(),
+            "author": " ".join(rng.sample(words, 2)).title(),
+            "isbn": f"978{i:010d}",
+            "description": " ".join(rng.choices(words, k=30)),
+            "language": rng.choice(languages),
+            "genre": rng.choice(genres),
+            "publicationDate": f"{rng.randint(1950, 2023)}-01-01",
+            "catalogues": rng.sample(genres, 2)
+        } for i in range(books)])
+
+        epubs = tempfile.mkdtemp(dir=dataDir)
+        try:
+            for i in range(files):
+                makeEpub(os.path.join(epubs, f"{i}.epub"), f"979{i:010d}",
+                    " ".join(rng.sample(words, 2)).title())
+            bulkImport(db, epubs, processes=0).run()
+        finally:
+            shutil.rmtree(epubs)
+
+    con, cur = db.connect()
+    bookIDs = [bookID for (bookID,) in cur.execute("SELECT bookID FROM books").fetchall()]
+    fileHashes = [hash for (hash,) in cur.execute(
+        "SELECT DISTINCT fileHash FROM books WHERE fileHash IS NOT NULL").fetchall()]
+    con.close()
+    db.closeConnections()
+    return {"users": accounts, "bookIDs": bookIDs, "fileHashes": fileHashes}
+
+
+def percentile(latencies, fraction):
+    """Get a percentile of sorted latencies by the nearest rank.
+
+    Args:
+        latencies (list of float): The sorted latencies.
+        fraction (float): The percentile, e.g. 0.99.
+    Returns:
+        float: The latency, 0 if there are none."""
+    if not latencies:
+        return 0.0
+    return latencies[min(len(latencies) - 1, max(0, int(fraction * len(latencies) + 0.5) - 1))]
+
+
+class client:
+    def __init__(self, port, account=None):
+        """A keep-alive HTTP connection to the server with its own session.
+
+        Args:
+            port (int): The server's port on localhost.
+            account (tuple): The (email, password) to log in with. (optional)"""
+        self.port = port
+        self.connection = None
+        self.cookie = None
+        if account:
+            status = self.request("POST", "/account/login", {"email": account[0], "password": account[1]})
+            if status != 302 or not self.cookie:
+                raise RuntimeError(f"Couldn't log in as {account[0]}, status {status}.")
+
+    def request(self, method, path, form=None):
+        """Send a request and read the whole response.
+
+        Args:
+            method (str): The HTTP method.
+            path (str): The path and query string.
+            form (dict): Form fields to POST. (optional)
+        Returns:
+            int: The response's status code."""
+        headers = {"Accept-Encoding": "identity"}
+        body = None
+        if form is not None:
+            body = urllib.parse.urlencode(form)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        if self.cookie:
+            headers["Cookie"] = self.cookie
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=60)
+            try:
+                self.connection.request(method, path, body, headers)
+                response = self.connection.getresponse()
+                response.read()
+                break
+            except (http.client.HTTPException, ConnectionError):
+                # The server closed the kept alive connection, try a new one
+                self.close()
+                if attempt:
+                    raise
+        cookie = response.getheader("Set-Cookie")
+        if cookie and cookie.startswith("session="):
+            self.cookie = cookie.split(";", 1)[0]
+        return response.status
+
+    def close(self):
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+
+# Each scenario makes a request from a random number generator and the
+# seeded data, returning the method, path and form
+scenarios = {
+    "login": lambda rng, data: ("POST", "/account/login",
+        dict(zip(("email", "password"), rng.choice(data["users"])))),
+    "home": lambda rng, data: ("GET", "/", None),
+    "search": lambda rng, data: ("GET", "/books/search?" + urllib.parse.urlencode({
+        "query": rng.choice(words), "genre": rng.choice(genres + ("",)),
+        "sort": rng.choice(("relevance", "title", "date"))}), None),
+    "searchApi": lambda rng, data: ("GET", "/api/books/search?" + urllib.parse.urlencode({
+        "query": " ".join(rng.sample(words, rng.randint(1, 2))), "language": rng.choice(languages),
+        "limit": 24}), None),
+    "view": lambda rng, data: ("GET", f"/books/view/{rng.choice(data['bookIDs'])}", None),
+    "cover": lambda rng, data: ("GET", f"/books/cover/{rng.choice(data['fileHashes'])}.jpg"
+        + rng.choice(("", "?w=160", "?w=320&fmt=webp")), None),
+    "epub": lambda rng, data: ("GET", f"/books/file/{rng.choice(data['fileHashes'])}.epub", None)
+}
+
+
+def runScenario(name, port, data, sessions, duration=10, warmup=1, seed=1):
+    """Send one scenario's requests from a thread per session, each waiting
+    for its last response before sending the next.
+
+    Args:
+        name (str): The scenario, a key of scenarios.
+        port (int): The server's port on localhost.
+        data (dict): The seeded data from seedData.
+        sessions (list of client): A logged in client for each thread, the
+            login scenario uses new clients instead.
+        duration (float): Seconds to measure for, default 10. (optional)
+        warmup (float): Seconds to send requests for before measuring, default 1. (optional)
+        seed (int): The random seed. (optional)
+    Returns:
+        dict: The requests, errors, statuses, throughput and latency
+            percentiles in milliseconds."""
+    makeRequest = scenarios[name]
+    latencies, statuses, errors = [], {}, []
+    lock = threading.Lock()
+    start = time.monotonic() + warmup
+    end = start + duration
+
+    def worker(index):
+        rng = random.Random(seed * 1000 + index)
+        # Logging in is what the login scenario measures, the others reuse a session
+        session = client(port) if name == "login" else sessions[index]
+        mine, myStatuses = [], {}
+        while True:
+            method, path, form = makeRequest(rng, data)
+            if name == "login":
+                session.cookie = None
+            sent = time.monotonic()
+            if sent >= end:
+                break
+            try:
+                status = session.request(method, path, form)
+            except (OSError, http.client.HTTPException) as error:
+                status = type(error).__name__
+            if sent >= start:
+                mine.append(time.monotonic() - sent)
+                myStatuses[status] = myStatuses.get(status, 0) + 1
+        session.close()
+        with lock:
+            latencies.extend(mine)
+            for status, count in myStatuses.items():
+                statuses[str(status)] = statuses.get(str(status), 0) + count
+
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(len(sessions))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    latencies.sort()
+    failed = sum(count for status, count in statuses.items()
+        if not status.isdigit() or int(status) >= 400)
+    return {
+        "requests": len(latencies),
+        "errors": failed,
+        "statuses": statuses,
+        "throughput": round(len(latencies) / duration, 2),
+        "p50": round(percentile(latencies, 0.5) * 1000, 3),
+        "p95": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99": round(percentile(latencies, 0.99) * 1000, 3),
+        "max": round(latencies[-1] * 1000, 3) if latencies else 0.0
+    }
+
+
+def compare(results, baseline, threshold=0.1):
+    """Find the scenarios that got slower than a baseline.
+
+    Args:
+        results (dict): The results from run.
+        baseline (dict): Earlier results to compare to.
+        threshold (float): The fraction throughput can drop or the p95 and
+            p99 latency can rise by before it's a regression, default 0.1. (optional)
+    Returns:
+        list of str: A description of each regression."""
+    regressions = []
+    for name, result in results["scenarios"].items():
+        before = baseline.get("scenarios", {}).get(name)
+        if before is None:
+            continue
+        if result["throughput"] < before["throughput"] * (1 - threshold):
+            regressions.append(f"{name}: throughput {result['throughput']}/s, was {before['throughput']}/s")
+        for key in ("p95", "p99"):
+            if result[key] > before[key] * (1 + threshold):
+                regressions.append(f"{name}: {key} {result[key]} ms, was {before[key]} ms")
+        if result["errors"] > before["errors"] and result["errors"] > threshold * result["requests"]:
+            regressions.append(f"{name}: {result['errors']} errors, was {before['errors']}")
+    return regressions
+
+
+def freePort():
+    """Find a free port on localhost."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def startServer(dataDir, port, workers=1, timeout=60):
+    """Start server.py under waitress in another process and wait until it
+    accepts connections.
+
+    Returns:
+        subprocess.Popen: The server process."""
+    log = open(os.path.join(dataDir, "loadTestServer.log"), "ab")
+    process = subprocess.Popen([sys.executable, "server.py", "--host", "127.0.0.1",
+        "--port", str(port), "--data-dir", dataDir, "--workers", str(workers)],
+        cwd=serverDirectory, stdout=log, stderr=subprocess.STDOUT)
+    log.close()
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"The server exited, see {log.name}.")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("The server didn't start in time.")
+
+
+def run(names, dataDir=None, books=2000, users=20, files=20, workers=1, concurrency=8,
+        duration=10, warmup=1, seed=1):
+    """Seed a data directory, start the server and run scenarios against it.
+
+    Args:
+        names (list of str): The scenarios to run, in order.
+        dataDir (str): The data directory to use and keep, default a
+            temporary one that is removed after. (optional)
+        concurrency (int): The number of clients sending requests, default 8. (optional)
+        Others: See seedData and runScenario.
+    Returns:
+        dict: The settings and each scenario's results."""
+    temporary = dataDir is None
+    if temporary:
+        dataDir = tempfile.mkdtemp(prefix="DIYA-Server-Load-")
+    try:
+        data = seedData(dataDir, books, users, files, seed)
+        port = freePort()
+        server = startServer(dataDir, port, workers)
+        try:
+            sessions = [client(port, data["users"][index % len(data["users"])])
+                for index in range(concurrency)]
+            results = {}
+            for name in names:
+                results[name] = runScenario(name, port, data, sessions, duration, warmup, seed)
+                print(f"{name:>10}: {results[name]['throughput']:>8}/s  p50 {results[name]['p50']:>8} ms  "
+                    f"p95 {results[name]['p95']:>8} ms  p99 {results[name]['p99']:>8} ms  "
+                    f"errors {results[name]['errors']}", flush=True)
+        finally:
+            server.terminate()
+            server.wait(timeout=30)
+    finally:
+        if temporary:
+            shutil.rmtree(dataDir, ignore_errors=True)
+
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "cpus": os.cpu_count(),
+        "settings": {"books": books, "users": users, "files": files, "workers": workers,
+            "concurrency": concurrency, "duration": duration, "seed": seed},
+        "scenarios": results
+    }
+
+
+if __name__ == "__main__":
+    if "--help" in sys.argv:
+        print("Usage: python -m testing.loadTest [options]")
+        print("Starts the server against generated data and measures each scenario.")
+        print("Options:")
+        print("  --scenarios A,B     Set the scenarios to run, default all of:")
+        print("                      " + ", ".join(scenarios))
+        print("  --concurrency N     Set the number of clients, default 8")
+        print("  --duration S        Set the seconds to measure each scenario, default 10")
+        print("  --workers N         Set the server's worker processes, default 1")
+        print("  --books N           Set the number of books to generate, default 2000")
+        print("  --data-dir DIR      Set the data directory to generate and keep")
+        print("  --output FILE       Set where to save the results as JSON")
+        print("  --baseline FILE     Set the results to compare to, exits with 1 if slower")
+        print("  --threshold F       Set the fraction slower that fails, default 0.1")
+        print("  --save-baseline     Save the results as the baseline instead")
+        exit(0)
+
+    options = {}
+    for arg, var, default in [
+        ("--scenarios",   "scenarios",   ",".join(scenarios)),
+        ("--concurrency", "concurrency", "8"),
+        ("--duration",    "duration",    "10"),
+        ("--workers",     "workers",     "1"),
+        ("--books",       "books",       "2000"),
+        ("--data-dir",    "dataDir",     None),
+        ("--output",      "output",      None),
+        ("--baseline",    "baseline",    os.path.join(directory, "loadTestBaseline.json")),
+        ("--threshold",   "threshold",   "0.1")
+    ]:
+        options[var] = sys.argv[sys.argv.index(arg) + 1] if arg in sys.argv else default
+
+    names = options["scenarios"].split(",")
+    for name in names:
+        if name not in scenarios:
+            print(f"Unknown scenario {name}, use one of: {', '.join(scenarios)}")
+            exit(2)
+
+    results = run(names, options["dataDir"], books=int(options["books"]),
+        workers=int(options["workers"]), concurrency=int(options["concurrency"]),
+        duration=float(options["duration"]))
+
+    if options["output"]:
+        with open(options["output"], "w") as file:
+            json.dump(results, file, indent=4)
+    if "--save-baseline" in sys.argv:
+        with open(options["baseline"], "w") as file:
+            json.dump(results, file, indent=4)
+        print(f"Saved the baseline to {options['baseline']}")
+    elif os.path.exists(options["baseline"]):
+        with open(options["baseline"]) as file:
+            baseline = json.load(file)
+        if baseline["settings"] != results["settings"]:
+            print("The baseline was measured with different settings:", baseline["settings"])
+        regressions = compare(results, baseline, float(options["threshold"]))
+        for regression in regressions:
+            print("Regression:", regression)
+        if regressions:
+            exit(1)
+        print(f"No regressions compared to {options['baseline']}")
@@ -1,22 +1,38 @@
 #!/usr/bin/env python3
 
+import contextlib
+import csv
 import hashlib
+import io
+import json
 import os
+import sqlite3
 import sys
+import threading
 import unittest
+import unittest.mock
 
 directory = os.path.dirname(os.path.realpath(__file__))
 if "testing" == directory.split(os.sep)[-1]:
     sys.path.append(os.path.dirname(directory))
 
-from scripts.database import database
-from testing.utils import TestUtils, sampleBookMetadata
+from scripts.bulkImport import bulkImport
+from scripts.catalogSync import exportLines, importLines
+from scripts.coverCache import coverCache
+from scripts.database import database, queryTime
+from scripts.jobQueue import jobQueue
+from scripts.sqlTrace import fingerprint
+from scripts.suggestIndex import suggestIndex
+from testing.catalogGenerator import catalogGenerator, generateCatalog
+from testing.databaseBenchmarks import openDatabase, run as runBenchmarks
+from testing.utils import TestUtils, makeEpub, sampleBookMetadata
 
 
 class TestDatabase(TestUtils):
     def setUp(self):
         self.db = database(self.tempDataDir, self.randomString() + ".db")
         self.db.executeScript("databaseStructure.sql")
+        self.db.migrate()
 
     def testStructure(self):
         """Check that the tabled were created without errors."""
@@ -27,6 +43,43 @@ class TestDatabase(TestUtils):
             self.assertIn((table,), tables)
         con.close()
 
+    def testMigrate(self):
+        """Check that migrations run once and record the schema version."""
+        db = database(self.tempDataDir, self.randomString() + ".db")
+        db.executeScript("databaseStructure.sql")
+        version = db.migrate()
+        self.assertGreaterEqual(version, 1)
+        self.assertEqual(db.migrate(), version)
+        con, cur = db.connect()
+        self.assertEqual(cur.execute("PRAGMA user_version").fetchone()[0], version)
+        cur.execute("SELECT name FROM sqlite_master WHERE type='index'")
+        indexes = [index[0] for index in cur.fetchall()]
+        for index in ("bookCatalogueLinkBookID", "bookCatalogueLinkCatalogueID",
+                      "booksGenre", "booksLanguage", "booksFileHash"):
+            self.assertIn(index, indexes)
+        self.assertTrue(cur.execute("SELECT * FROM sqlite_stat1").fetchall())
+        con.close()
+
+    def testConnectionPool(self):
+        """Check that pooled connections are reused and reset."""
+        db = database(self.tempDataDir, self.randomString() + ".db",
+                      poolSize=2, journalMode="WAL", synchronous="NORMAL")
+        db.executeScript("databaseStructure.sql")
+        con, cur = db.connect()
+        self.assertEqual(cur.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        self.assertEqual(cur.execute("PRAGMA synchronous").fetchone()[0], 1)
+        cur.execute("INSERT INTO users (email, passwordHash) VALUES ('a', 'b')")
+        con.close()
+        con2, cur2 = db.connect()
+        self.assertIs(con, con2)
+        self.assertEqual(cur2.execute("SELECT * FROM users").fetchall(), [])
+        con3, cur3 = db.connect()
+        self.assertIsNot(con2, con3)
+        con2.close()
+        con3.close()
+        db.closeConnections()
+        self.assertTrue(db.pool.empty())
+
     def testRegister(self, email="joe@joeblakeb.com", password="Password123"):
         """Check that the add user function works correctly."""
         self.db.addUser(email, password)
@@ -70,6 +123,37 @@ class TestDatabase(TestUtils):
             self.db.checkUser("example@test.com", password),
             (False,), "Incorrect email")
 
+    def testRehashPassword(self):
+        """Passwords hashed with an old work factor should be hashed again on login."""
+        email, password = "rehash@diya.ink", "Password123"
+        self.db.hasher.rounds = 4
+        self.testRegister(email, password)
+        self.db.hasher.rounds = 5
+        self.assertTrue(self.db.checkUser(email, password)[0])
+
+        con, cur = self.db.connect()
+        cur.execute("SELECT passwordHash FROM users WHERE email = ?", (email,))
+        passwordHash = cur.fetchone()[0]
+        con.close()
+        self.assertTrue(passwordHash.startswith(b"$2b$05$"))
+        self.assertFalse(self.db.hasher.needsRehash(passwordHash))
+        self.assertTrue(self.db.checkUser(email, password)[0])
+
+    def testSessions(self):
+        """Check that sessions are saved, expire and are revoked by user."""
+        self.db.saveSession("a", {"user": {"id": 1}}, 1)
+        self.db.saveSession("b", {"user": {"id": 1}}, 1)
+        self.db.saveSession("c", {"email": "test@diya.ink"})
+        self.db.saveSession("d", {}, lifetime=-1)
+        self.assertEqual(self.db.getSession("a"), {"user": {"id": 1}})
+        self.assertIsNone(self.db.getSession("d"))
+
+        self.assertEqual(sorted(self.db.deleteUserSessions(1)), ["a", "b"])
+        self.assertIsNone(self.db.getSession("a"))
+        self.assertEqual(self.db.getSession("c"), {"email": "test@diya.ink"})
+        self.db.deleteSession("c")
+        self.assertIsNone(self.db.getSession("c"))
+
     def testAddBookMetadata(self):
         """Tests getting a book from the database."""
         for i in range(len(sampleBookMetadata)):
@@ -89,6 +173,62 @@ class TestDatabase(TestUtils):
             for key in sampleBookMetadata[i]:
                 self.assertEqual(book[key], sampleBookMetadata[i][key])
 
+    def testBookMetadataCache(self):
+        """Tests that cached book metadata is never stale."""
+        self.testAddBookMetadata()
+        book = self.db.getBookMetadata(2)
+        book["catalogues"].append("Mung")
+        self.assertEqual(self.db.getBookMetadata(2)["catalogues"], ["Computers", "Programming"])
+        self.assertIn(2, self.db.metadataCache.items)
+        self.db.updateBookMetadata(2, title="Learning iOS", catalogues=["Apple"])
+        book = self.db.getBookMetadata(2)
+        self.assertEqual((book["title"], book["catalogues"]), ("Learning iOS", ["Apple"]))
+        self.db.deleteBook(2)
+        self.assertRaises(ValueError, self.db.getBookMetadata, 2)
+        self.assertEqual(list(self.db.getBooksMetadata([1, 2, 3])), [1, 3])
+        self.assertEqual(self.db.searchBooks("linux")[0]["catalogues"], ["Computers", "Linux"])
+
+    def testCachesShared(self):
+        """Tests that books changed by another process aren't served from the caches."""
+        filename = self.randomString() + ".db"
+        writer = database(self.tempDataDir, filename)
+        writer.executeScript("databaseStructure.sql")
+        writer.migrate()
+        bookID = writer.addBookMetadata("Old Title", "George Orwell", "978-0451524935", catalogues=["Old"])
+        reader = database(self.tempDataDir, filename, poolSize=2, checkChanges=True)
+        self.assertEqual(reader.getBookMetadata(bookID)["title"], "Old Title")
+        self.assertEqual([s["text"] for s in reader.suggestions.search("old")], ["Old Title", "Old"])
+
+        writer.updateBookMetadata(bookID, title="New Title", catalogues=["New"])
+        self.assertEqual(reader.getBookMetadata(bookID)["catalogues"], ["New"])
+        reader.suggestions.refresh(wait=True)
+        self.assertEqual([s["text"] for s in reader.suggestions.search("new")], ["New Title", "New"])
+        self.assertEqual(reader.suggestions.search("old"), [])
+        writer.deleteBook(bookID)
+        self.assertRaises(ValueError, reader.getBookMetadata, bookID)
+        reader.closeConnections()
+
+    def testOwnChangesKeepCaches(self):
+        """Tests that a process's own writes don't clear its caches."""
+        filename = self.randomString() + ".db"
+        db = database(self.tempDataDir, filename, poolSize=2, checkChanges=True)
+        db.executeScript("databaseStructure.sql")
+        db.migrate()
+        bookID = db.addBookMetadata("Old Title", "George Orwell", "978-0451524935")
+        otherID = db.addBookMetadata("Other Title", "George Orwell", "978-0452284234")
+        db.getBookMetadata(otherID)
+        db.suggestions.search("old")
+        db.updateBookMetadata(bookID, title="New Title")
+        db.getBookMetadata(bookID)
+        self.assertIn(otherID, db.metadataCache.items)
+        self.assertFalse(db.suggestions.stale)
+
+        writer = database(self.tempDataDir, filename)
+        writer.deleteBook(bookID)
+        self.assertRaises(ValueError, db.getBookMetadata, bookID)
+        self.assertNotIn(otherID, db.metadataCache.items)
+        db.closeConnections()
+
     def testUpdateBookMetadata(self):
         """Tests updating a book in the database."""
         self.testAddBookMetadata()
@@ -127,22 +267,509 @@ class TestDatabase(TestUtils):
         self.assertEqual(cur.fetchall(), [])
         con.close()
 
+    def testSearchBooks(self):
+        """Tests the full text search and relevance ranking."""
+        self.testAddBookMetadata()
+        self.db.addBookMetadata("Android Linux", "Someone", "1",
+                                description="Not about Linux really")
+        for query, sort, expectedBooks in (
+            ("", "bookName", [1, 4, 2, 3]),
+            ("linux", "bookName", [4, 3]),
+            ("linux", "relevance", [3, 4]),
+            ("andr", "relevance", [4, 2]),
+            ("orwell", "relevance", [1]),
+            ('"bible*', "relevance", [3]),
+            ("learning bible", "relevance", []),
+        ):
+            books = self.db.searchBooks(query, sort=sort)
+            self.assertEqual([book["bookID"] for book in books], expectedBooks, query)
+
+        self.db.updateBookMetadata(4, title="Something Else")
+        self.assertEqual([book["bookID"] for book in self.db.searchBooks("android")], [2])
+        self.db.deleteBook(3)
+        self.assertEqual([book["bookID"] for book in self.db.searchBooks("bible")], [])
+
+    def testBookFacets(self):
+        """Tests that facet counts follow added, edited and deleted books."""
+        self.testAddBookMetadata()
+        self.db.addBookMetadata("Linux Pocket Guide", "Daniel Barrett", "978-1491927571",
+            language="EN", genre="programming", catalogues=["linux"])
+        facets = self.db.bookFacets()
+        self.assertEqual(facets["genre"], [{"value": "Programming", "count": 2}])
+        self.assertEqual(facets["language"], [{"value": "en", "count": 2}])
+        self.assertEqual(facets["catalogue"], [{"value": "Computers", "count": 2},
+            {"value": "Linux", "count": 2}, {"value": "Programming", "count": 1}])
+
+        self.db.updateBookMetadata(2, genre="Mobile", catalogues=["Computers"])
+        self.db.deleteBook(3)
+        facets = self.db.bookFacets()
+        self.assertEqual(facets["genre"], [{"value": "Mobile", "count": 1},
+            {"value": "Programming", "count": 1}])
+        self.assertEqual(facets["catalogue"], [{"value": "Computers", "count": 1},
+            {"value": "Linux", "count": 1}])
+
+        self.assertEqual(self.db.bookFacets("linux"), {"genre": [{"value": "programming", "count": 1}],
+            "language": [{"value": "EN", "count": 1}], "catalogue": [{"value": "linux", "count": 1}]})
+        self.assertEqual(self.db.bookFacets(genre="mobile")["catalogue"],
+            [{"value": "Computers", "count": 1}])
+
+    def testBookSuggestions(self):
+        """Tests that suggestions follow added, edited and deleted books."""
+        self.testAddBookMetadata()
+        self.assertEqual(self.db.suggestions.search("comp"),
+            [{"text": "Computers", "kind": "catalogue", "count": 2}])
+        self.assertEqual([suggestion["text"] for suggestion in self.db.suggestions.search("l")],
+            ["Learning Android", "Linux Bible", "Linux"])
+        self.assertEqual(self.db.suggestions.search("  BIBLE")[0]["text"], "Linux Bible")
+
+        self.db.addBookMetadata("Éloge de l'ombre", "Jun'ichirō Tanizaki", "978-2864321373",
+            catalogues=["linux"])
+        self.assertEqual(self.db.suggestions.search("eloge")[0]["text"], "Éloge de l'ombre")
+        self.assertEqual(self.db.suggestions.search("ichiro")[0]["text"], "Jun'ichirō Tanizaki")
+        self.assertEqual(self.db.suggestions.search("linux", 1),
+            [{"text": "Linux", "kind": "catalogue", "count": 2}])
+
+        self.db.updateBookMetadata(3, title="Fedora Bible", catalogues=["Computers"])
+        self.db.deleteBook(2)
+        self.assertEqual(self.db.suggestions.search("comp"),
+            [{"text": "Computers", "kind": "catalogue", "count": 1}])
+        self.assertEqual(self.db.suggestions.search("linux"),
+            [{"text": "Linux", "kind": "catalogue", "count": 1}])
+        self.assertEqual(self.db.suggestions.search("bible")[0]["text"], "Fedora Bible")
+        self.assertEqual(self.db.suggestions.search("android"), [])
+
+        self.db.addBooks([{"title": "Android Internals", "author": "Jonathan Levin", "isbn": "1"}])
+        self.db.suggestions.refresh(wait=True)
+        self.assertEqual(self.db.suggestions.search("android")[0]["text"], "Android Internals")
+
+    def testSuggestionsRebuild(self):
+        """Tests a stale suggestions index is rebuilt once while the previous one is searched."""
+        books = [(1, "Linux Bible", "Christopher Negus", ["Linux"])]
+        loads, loading = [], threading.Event()
+        def loader():
+            loads.append(list(books))
+            loading.wait(5)
+            return loads[-1]
+
+        index = suggestIndex(loader)
+        loading.set()
+        self.assertEqual(index.search("linux")[0]["text"], "Linux Bible")
+        loading.clear()
+        books.append((2, "Linux Kernel Development", "Robert Love", ["Linux"]))
+        index.invalidate()
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(index.search("linux")))
+            for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(len(results), 8)
+        self.assertTrue(all(result[0]["text"] == "Linux Bible" for result in results))
+        self.assertEqual(len(loads), 2)
+
+        # Books changed while the index loads are kept after it's swapped
+        index.setBook(3, "Linux Pocket Guide", "Daniel Barrett", [])
+        index.removeBook(1)
+        loading.set()
+        index.refresh(wait=True)
+        self.assertEqual(len(loads), 2)
+        self.assertFalse(index.stale)
+        self.assertEqual([result["text"] for result in index.search("linux")],
+            ["Linux Kernel Development", "Linux Pocket Guide", "Linux"])
+
+    def testSqlTracing(self):
+        """Tests counting statements and logging slow ones with their plans."""
+        self.assertEqual(fingerprint("SELECT * FROM books\n  WHERE bookID IN (?, ?, ?) AND x = 'it''s' LIMIT 10"),
+            "SELECT * FROM books WHERE bookID IN (...) AND x = ? LIMIT ?")
+        self.assertEqual(fingerprint("INSERT INTO t VALUES (?1, ?2), (?1, ?3)"), "INSERT INTO t VALUES (...)")
+
+        logPath = os.path.join(self.tempDataDir, self.randomString() + ".jsonl")
+        with self.assertLogs("scripts.sqlTrace", "WARNING") as logs:
+            self.db = database(self.tempDataDir, self.randomString() + ".db", poolSize=2,
+                metadataCacheSize=0, slowQuerySeconds=0, slowQueryLog=logPath)
+            self.db.executeScript("databaseStructure.sql")
+            self.db.migrate()
+            self.testAddBookMetadata()
+            queryTime.reset()
+            for bookID in (1, 2, 3):
+                self.db.getBookMetadata(bookID)
+            seconds, queries = queryTime.reset()
+        self.assertTrue(logs.output[-1].startswith("WARNING:scripts.sqlTrace:Slow query"))
+        self.assertEqual(queries, 3)
+        self.assertGreater(seconds, 0)
+
+        stats = self.db.tracer.stats()
+        statement = [statement for statement in stats["statements"]
+            if statement["fingerprint"].startswith("SELECT books.bookID") and
+                statement["fingerprint"].endswith("WHERE bookID IN (...)")][0]
+        self.assertEqual(statement["count"], 3)
+        self.assertIn("SEARCH books USING INTEGER PRIMARY KEY", stats["slow"][0]["plan"])
+        with open(logPath) as file:
+            slow = [json.loads(line) for line in file]
+        self.assertEqual(len(slow), sum(statement["count"] for statement in stats["statements"]))
+        self.assertEqual(slow[-1]["sql"], stats["slow"][0]["sql"])
+
+    def testRandomBooks(self):
+        """Tests picking random books, skipping deleted ones."""
+        self.assertEqual(self.db.randomBooks(), [])
+        self.testAddBookMetadata()
+        books = self.db.randomBooks(4)
+        self.assertEqual(sorted(book["bookID"] for book in books), [1, 2, 3])
+        self.assertEqual(books[0].keys(), self.db.searchBooks()[0].keys() - {"sortKey"})
+
+        for i in range(4, 60):
+            self.db.addBookMetadata("Book " + str(i), "Author", str(i))
+        for i in range(5, 50):
+            self.db.deleteBook(i)
+        for _ in range(10):
+            bookIDs = [book["bookID"] for book in self.db.randomBooks(4)]
+            self.assertEqual(len(bookIDs), len(set(bookIDs)))
+            self.assertTrue(1 <= len(bookIDs) <= 4)
+            for bookID in bookIDs:
+                self.assertFalse(5 <= bookID < 50)
+
+    def testRandomBooksDeleted(self):
+        """Tests picking random books while the last book is deleted by another connection."""
+        db = database(self.tempDataDir, self.randomString() + ".db", journalMode="WAL")
+        db.executeScript("databaseStructure.sql")
+        db.migrate()
+        db.addBooks([{"title": f"Book {i}", "author": "Author", "isbn": str(i)} for i in range(20)])
+
+        def deleteHighest(lowest, highest):
+            db.deleteBook(highest)
+            return highest
+        with unittest.mock.patch("scripts.database.random.randint", side_effect=deleteHighest):
+            self.assertEqual([book["bookID"] for book in db.randomBooks(2)], [20])
+        self.assertEqual(sorted(book["bookID"] for book in db.randomBooks(30)), list(range(1, 20)))
+
+    def testBackfillSearchIndex(self):
+        """Tests indexing books added before the search index existed."""
+        self.testAddBookMetadata()
+        con, cur = self.db.connect()
+        cur.execute("INSERT INTO booksSearch (booksSearch) VALUES ('delete-all')")
+        con.commit()
+        con.close()
+        self.assertEqual(self.db.searchBooks("orwell"), [])
+        self.db.backfillSearchIndex()
+        self.assertEqual([book["bookID"] for book in self.db.searchBooks("orwell")], [1])
+
     def testAddFile(self):
         """Tests adding a file to the database"""
         self.testAddBookMetadata()
         with open(os.path.join(os.path.dirname(__file__), "data/book.epub"), "rb") as file:
             fileData = file.read()
-        hash = hashlib.md5(fileData).hexdigest()
+        hash = hashlib.sha256(fileData).hexdigest()
         self.db.addFile(1, fileData)
         book = self.db.getBookMetadata(1)
         self.assertEqual(book["fileURL"], "/books/file/" + hash + ".epub")
         self.assertEqual(book["coverURL"], "/books/cover/" + hash + ".jpg")
-        self.assertTrue(os.path.exists(os.path.join(self.tempDataDir, hash + ".epub")))
-        self.assertTrue(os.path.exists(os.path.join(self.tempDataDir, hash + ".jpg")))
-        self.assertEqual(fileData, open(os.path.join(self.tempDataDir, hash + ".epub"), "rb").read())
+        epubPath, coverPath = self.db.blobs.path(hash, ".epub"), self.db.blobs.path(hash, ".jpg")
+        self.assertEqual(epubPath, os.path.join(self.tempDataDir, "blobs", hash[:2], hash[2:4], hash + ".epub"))
+        self.assertTrue(os.path.exists(epubPath))
+        self.assertFalse(os.path.exists(coverPath))
+        self.assertTrue(self.db.coverPending(1))
+        jobQueue(self.db, workers=0).runPending()
+        self.assertFalse(self.db.coverPending(1))
+        self.assertIsNone(self.db.jobStatus("deriveAssets", hash))
+        self.assertTrue(os.path.exists(coverPath))
+        self.assertEqual(fileData, open(epubPath, "rb").read())
+        self.db.deleteBook(1)
+        self.assertFalse(os.path.exists(epubPath))
+        self.assertFalse(os.path.exists(coverPath))
+
+    def testSharedFile(self):
+        """Tests that a file used by two books is kept until both are done with it."""
+        self.testAddBookMetadata()
+        with open(os.path.join(os.path.dirname(__file__), "data/book.epub"), "rb") as file:
+            fileData = file.read()
+        hash = hashlib.sha256(fileData).hexdigest()
+        for bookID in (1, 2, 3):
+            self.db.addFile(bookID, fileData)
+        con, cur = self.db.connect()
+        self.assertEqual(cur.execute("SELECT * FROM blobs").fetchall(), [(hash, 3)])
         self.db.deleteBook(1)
-        self.assertFalse(os.path.exists(os.path.join(self.tempDataDir, hash + ".epub")))
-        self.assertFalse(os.path.exists(os.path.join(self.tempDataDir, hash + ".jpg")))
+        self.db.updateBookMetadata(2, title="Something Else")
+        self.assertTrue(os.path.exists(self.db.blobs.path(hash, ".epub")))
+        self.db.addFile(2, fileData + b"Different")
+        self.assertTrue(os.path.exists(self.db.blobs.path(hash, ".epub")))
+        self.db.deleteBook(3)
+        self.assertFalse(os.path.exists(self.db.blobs.path(hash, ".epub")))
+        self.assertEqual(len(cur.execute("SELECT * FROM blobs").fetchall()), 1)
+        con.close()
+
+    def testFilesRolledBack(self):
+        """Tests that stored files are removed with a rolled back transaction or by a sweep."""
+        # Its own blob store, so the test EPUB isn't already stored
+        self.db = database(os.path.join(self.tempDataDir, self.randomString()), "database.db")
+        self.db.executeScript("databaseStructure.sql")
+        self.db.migrate()
+        with open(os.path.join(os.path.dirname(__file__), "data/book.epub"), "rb") as file:
+            tempPath, hash = self.db.blobs.write(file)
+        epubPath = self.db.blobs.path(hash, ".epub")
+        con, cur = self.db.connect()
+        cur.execute("BEGIN IMMEDIATE")
+        self.assertEqual(self.db.addBooks([{"title": "Testing", "author": "Author",
+            "isbn": "1", "file": (tempPath, hash)}], cur), [None])
+        self.assertTrue(os.path.exists(epubPath))
+        con.rollback()
+        con.close()
+        self.assertFalse(os.path.exists(epubPath))
+        self.assertEqual(self.db.searchBooks(), [])
+
+        # Files left by a process that stopped before rolling back are swept once old
+        bookID = self.db.addBookMetadata("Kept", "Author", "2")
+        with open(os.path.join(os.path.dirname(__file__), "data/book.epub"), "rb") as file:
+            self.db.addFile(bookID, file)
+        orphanPath = self.db.blobs.path("0" * 64, ".epub")
+        os.makedirs(os.path.dirname(orphanPath), exist_ok=True)
+        for path in (orphanPath, os.path.join(self.db.blobs.directory, "upload.part")):
+            open(path, "wb").close()
+        self.assertEqual(self.db.sweepBlobs(), 0)
+        self.assertEqual(self.db.sweepBlobs(minAge=-1), 2)
+        self.assertFalse(os.path.exists(orphanPath))
+        self.assertTrue(os.path.exists(epubPath))
+
+    def testCoverCache(self):
+        """Tests that resized covers are cached and evicted, also when shared."""
+        self.testAddFile()
+        with open(os.path.join(os.path.dirname(__file__), "data/book.epub"), "rb") as file:
+            self.db.addFile(2, file)
+        jobQueue(self.db, workers=0).runPending()
+        hash = self.db.getBookMetadata(2)["fileURL"][12:-5]
+        covers = coverCache(self.db.blobs, os.path.join(self.tempDataDir, self.randomString()))
+
+        path, mimetype = covers.get(hash, 100, "webp")
+        self.assertEqual((os.path.basename(path), mimetype), (hash + "-160.webp", "image/webp"))
+        self.assertEqual(covers.get(hash, 160, "webp")[0], path)
+        covers.get(hash, 400, "jpg")
+        self.assertEqual(covers.size, sum(os.path.getsize(os.path.join(covers.directory, name))
+                                          for name in os.listdir(covers.directory)))
+        self.assertRaises(FileNotFoundError, covers.get, "0" * 64, 160, "jpg")
+        self.assertRaises(ValueError, covers.get, hash, 160, "bmp")
+
+        covers.maxBytes = covers.size - 1
+        covers.get(hash, 80, "jpg")
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(list(covers.files), [hash + "-400.jpg", hash + "-80.jpg"])
+        self.assertEqual(list(coverCache(self.db.blobs, covers.directory).files), list(covers.files))
+        covers.remove(hash)
+        self.assertEqual(os.listdir(covers.directory), [])
+
+        # Another process's cache in the same directory counts these covers
+        shared = coverCache(self.db.blobs, covers.directory)
+        covers.maxBytes = 256 * 1024 * 1024
+        covers.get(hash, 80, "jpg")
+        covers.get(hash, 160, "jpg")
+        shared.maxBytes = covers.size
+        shared.get(hash, 240, "jpg")
+        self.assertFalse(os.path.exists(os.path.join(covers.directory, hash + "-80.jpg")))
+        self.assertEqual(shared.size, sum(os.path.getsize(os.path.join(covers.directory, name))
+                                          for name in os.listdir(covers.directory)))
+
+    def testJobQueue(self):
+        """Tests that jobs are retried, then marked as failed."""
+        calls = []
+        def handler(payload):
+            calls.append(payload)
+            if payload["fail"]:
+                raise Exception("Mung")
+        jobs = jobQueue(self.db, workers=0, retryDelay=0)
+        jobs.register("test", handler)
+
+        self.db.queueJob("test", "good", {"fail": False})
+        self.db.queueJob("test", "bad", {"fail": True}, maxAttempts=2)
+        self.db.queueJob("unknown", "unknown", maxAttempts=1)
+        jobs.notify()
+        self.assertEqual(calls, [{"fail": False}, {"fail": True}, {"fail": True}])
+        self.assertIsNone(self.db.jobStatus("test", "good"))
+        self.assertEqual(self.db.jobStatus("test", "bad"), "failed")
+        self.assertEqual(self.db.jobStatus("unknown", "unknown"), "failed")
+
+        jobID = self.db.queueJob("test", "lost", {"fail": False})
+        self.assertEqual(self.db.claimJob(leaseSeconds=-1)["jobID"], jobID)
+        self.assertEqual(self.db.jobStatus("test", "lost"), "running")
+        jobs.runPending()
+        self.assertIsNone(self.db.jobStatus("test", "lost"))
+
+        claims = []
+        jobs = jobQueue(self.db, workers=0, leaseSeconds=-1)
+        def longJob(payload):
+            jobs.renewLease()
+            jobs.leaseSeconds = 600
+            jobs.renewLease()
+            claims.append(self.db.claimJob())
+        jobs.register("long", longJob)
+        self.db.queueJob("long", "long", maxAttempts=1)
+        jobs.notify()
+        self.assertEqual(claims, [None])
+        self.assertIsNone(self.db.jobStatus("long", "long"))
+
+    def testJobWorkers(self):
+        """Tests that worker threads run queued jobs, and keep running after errors."""
+        done = threading.Event()
+        jobs = jobQueue(self.db, workers=2, pollInterval=0.05)
+        jobs.register("test", lambda payload: done.set())
+        claimJob = self.db.claimJob
+        errors = [sqlite3.OperationalError("database is locked")]
+        def flakyClaim(leaseSeconds):
+            if errors:
+                raise errors.pop()
+            return claimJob(leaseSeconds)
+        with unittest.mock.patch.object(self.db, "claimJob", flakyClaim), \
+                self.assertLogs("scripts.jobQueue", "ERROR"):
+            jobs.start()
+            self.db.queueJob("test")
+            jobs.notify()
+            self.assertTrue(done.wait(5))
+            jobs.stop(timeout=5)
+        self.assertEqual(errors, [])
+
+    def testMigrateFlatFiles(self):
+        """Tests moving files from before the blob store into it."""
+        filename = self.randomString() + ".db"
+        db = database(self.tempDataDir, filename)
+        db.executeScript("databaseStructure.sql")
+        bookID = db.addBookMetadata(**sampleBookMetadata[0])
+        with open(os.path.join(os.path.dirname(__file__), "data/book.epub"), "rb") as file:
+            fileData = file.read()
+        oldHash = hashlib.md5(fileData).hexdigest()
+        with open(os.path.join(self.tempDataDir, oldHash + ".epub"), "wb") as file:
+            file.write(fileData)
+        con, cur = db.connect()
+        cur.execute("UPDATE books SET fileHash = ? WHERE bookID = ?", (oldHash, bookID))
+        con.commit()
+        con.close()
+
+        db.migrate()
+        hash = hashlib.sha256(fileData).hexdigest()
+        self.assertEqual(db.getBookMetadata(bookID)["fileURL"], "/books/file/" + hash + ".epub")
+        self.assertEqual(open(db.blobs.path(hash, ".epub"), "rb").read(), fileData)
+        self.assertFalse(os.path.exists(os.path.join(self.tempDataDir, oldHash + ".epub")))
+        db.deleteBook(bookID)
+        self.assertFalse(os.path.exists(db.blobs.path(hash, ".epub")))
+
+    def testBulkImport(self):
+        """Tests importing a directory of EPUBs and resuming the import."""
+        directory = os.path.join(self.tempDataDir, "import-" + self.randomString())
+        os.makedirs(os.path.join(directory, "more"))
+        makeEpub(os.path.join(directory, "a.epub"), "978-0451524935", "1984",
+            "<dc:subject>Fiction</dc:subject><dc:subject>Dystopia</dc:subject>"
+            "<dc:publisher>Signet</dc:publisher><dc:date>1961-01-01T00:00:00Z</dc:date>"
+            "<dc:description>&lt;p&gt;Big Brother &amp;amp; you&lt;/p&gt;</dc:description>")
+        makeEpub(os.path.join(directory, "more", "b.epub"), "9781449331818", "Learning Android")
+        makeEpub(os.path.join(directory, "more", "c.epub"), "978-0451524935", "Duplicate")
+        with open(os.path.join(directory, "bad.epub"), "wb") as file:
+            file.write(b"mungus")
+
+        report = os.path.join(directory, "errors.csv")
+        result = bulkImport(self.db, directory, report, processes=0, batchSize=2).run()
+        self.assertEqual((result["imported"], result["skipped"], result["failed"]), (2, 0, 2))
+        with open(report) as file:
+            errors = {row["path"]: row["error"] for row in csv.DictReader(file)}
+        self.assertEqual(errors, {
+            os.path.join(directory, "bad.epub"): "Invalid EPUB file.",
+            os.path.join(directory, "more", "c.epub"): "ISBN already exists."})
+
+        books = {book["title"]: book for book in self.db.searchBooks(limit=10)}
+        self.assertEqual(set(books), {"1984", "Learning Android"})
+        book = self.db.getBookMetadata(books["1984"]["bookID"])
+        self.assertEqual((book["author"], book["isbn"], book["publisher"], book["publicationDate"],
+            book["language"], book["description"], book["catalogues"]),
+            ("Joe Baker", "978-0451524935", "Signet", "1961-01-01", "en",
+                "Big Brother & you", ["Fiction", "Dystopia"]))
+        hash = book["fileURL"][len("/books/file/"):-len(".epub")]
+        self.assertTrue(os.path.exists(self.db.blobs.path(hash, ".epub")))
+        self.assertTrue(os.path.exists(self.db.blobs.path(hash, ".jpg")))
+        self.assertFalse([name for name in os.listdir(self.db.blobs.directory) if name.endswith(".part")])
+
+        result = bulkImport(self.db, directory, processes=2).run()
+        self.assertEqual((result["imported"], result["skipped"], result["failed"]), (0, 2, 2))
+
+    def testExportImportBooks(self):
+        """Tests exporting books as JSON Lines and importing them elsewhere."""
+        self.testAddBookMetadata()
+        lines = list(exportLines(self.db, batchSize=2))
+        self.assertEqual(len(lines), len(sampleBookMetadata))
+        books = [json.loads(line) for line in lines]
+        self.assertEqual(books[1]["catalogues"], ["Computers", "Programming"])
+        self.assertEqual(books[1]["pageCount"], 400)
+
+        other = database(self.tempDataDir, self.randomString() + ".db")
+        other.executeScript("databaseStructure.sql")
+        other.migrate()
+        other.addBookMetadata("Old title", "Old author", books[2]["isbn"], catalogues=["Old"])
+        result = importLines(other, lines + ["mungus\n", "\n", '{"title": "No ISBN"}\n'], batchSize=2)
+        self.assertEqual((result["added"], result["updated"], result["failed"]), (2, 1, 2))
+        self.assertEqual([error["line"] for error in result["errors"]], [4, 6])
+        self.assertEqual([json.loads(line) for line in exportLines(other)],
+            [books[2], books[0], books[1]])
+        self.assertEqual(other.searchBooks(catalogue="Old"), [])
+
+    def testImportBooksRepeated(self):
+        """Tests importing an ISBN twice keeps the last and leaves other catalogues alone."""
+        con, cur = self.db.connect()
+        cur.execute("INSERT INTO bookCatalogues (catalogueName) VALUES ('Empty')")
+        con.commit()
+        con.close()
+        book = {"title": "Nineteen Eighty-Four", "author": "George Orwell", "isbn": "978-0451524935"}
+        result = self.db.importBooks([dict(book, catalogues=["First", "Old"]),
+            dict(book, title="1984", catalogues=["Second"]),
+            dict(book, isbn="978-0452284234", catalogues=[1])])
+        self.assertEqual((result["added"], result["updated"]), (1, 0))
+        self.assertEqual(result["errors"], [None, None, "Invalid argument."])
+        books = list(self.db.exportBooks())
+        self.assertEqual([(b["title"], b["catalogues"]) for b in books], [("1984", ["Second"])])
+
+        result = self.db.importBooks([dict(book, catalogues=["New"])])
+        self.assertEqual((result["added"], result["updated"]), (0, 1))
+        con, cur = self.db.connect()
+        names = [name for (name,) in cur.execute("SELECT catalogueName FROM bookCatalogues ORDER BY catalogueName")]
+        con.close()
+        self.assertEqual(names, ["Empty", "New"])
+
+    def testGenerateCatalog(self):
+        """Tests the same seed generates the same catalogue and benchmarks leave it as it was."""
+        self.db.hasher.rounds = 4
+        result = generateCatalog(self.db, 300, users=20, batchSize=128)
+        self.assertEqual((result["books"], result["users"]), (300, 20))
+        self.assertEqual(self.db.addUsers(["user0@example.com", "New@example.com"], "Password-generated"), 1)
+        self.assertTrue(self.db.checkUser("new@example.com", "Password-generated")[0])
+
+        books = list(self.db.exportBooks())
+        for book in books:
+            self.assertIsNone(book.pop("fileHash"))
+        self.assertEqual(len({book["isbn"] for book in books}), 300)
+        self.assertEqual(books, list(catalogGenerator(300).books(300)))
+        self.assertNotEqual(books, list(catalogGenerator(300, seed=2).books(300)))
+
+        dataDir = os.path.join(self.tempDataDir, self.randomString())
+        with contextlib.redirect_stdout(io.StringIO()):
+            openDatabase(dataDir, 200).closeConnections()
+            results = runBenchmarks(["searchBooks.word", "getBookMetadata.uncached", "addBooks",
+                "updateBookMetadata", "deleteBook"], dataDir, repeat=5)
+        self.assertEqual(results["settings"]["books"], 200)
+        self.assertEqual(results["benchmarks"]["searchBooks.word"]["calls"], 5)
+        self.assertGreater(results["benchmarks"]["addBooks"]["p50"], 0)
+        con, cur = database(dataDir, "database.db").connect()
+        self.assertEqual(cur.execute("SELECT COUNT(*) FROM books").fetchone()[0], 200)
+        con.close()
+
+    def testAddFileStream(self):
+        """Tests adding a file from a stream and rejecting invalid files."""
+        self.testAddBookMetadata()
+        before = set(os.listdir(self.db.blobs.directory))
+        self.assertRaises(ValueError, self.db.addFile, 1, b"Not an EPUB" * 1024)
+        self.assertEqual(set(os.listdir(self.db.blobs.directory)), before)
+        self.assertIsNone(self.db.getBookMetadata(1)["fileURL"])
+
+        with open(os.path.join(os.path.dirname(__file__), "data/book.epub"), "rb") as file:
+            hash = hashlib.sha256(file.read()).hexdigest()
+            file.seek(0)
+            self.db.addFile(2, file)
+        self.assertEqual(self.db.getBookMetadata(2)["fileURL"], "/books/file/" + hash + ".epub")
+        self.assertFalse([name for name in os.listdir(self.db.blobs.directory) if name.endswith(".part")])
 
 
 if __name__ == "__main__":
@@ -1,21 +1,26 @@
 #!/usr/bin/env python3
 
+import gzip
+import io
 import os
+import PIL.Image
 import re
 import sys
 import unittest
+import zipfile
 
 directory = os.path.dirname(os.path.realpath(__file__))
 if "testing" == directory.split(os.sep)[-1]:
     sys.path.append(os.path.dirname(directory))
 
+from scripts.staticAssets import brotli
 from server import createServer
-from testing.utils import TestUtils, sampleBookMetadata
+from testing.utils import TestUtils, makeEpub, sampleBookMetadata
 
 
 class TestServer(TestUtils):
     def setUp(self):
-        app = createServer(self.tempDataDir, self.randomString() + ".db")
+        app = createServer(self.tempDataDir, self.randomString() + ".db", jobWorkers=0)
         app.config["TESTING"] = True
         self.client = app.test_client()
         self.db = app.db
@@ -45,6 +50,18 @@ class TestServer(TestUtils):
         con.close()
         self.assertEqual(len(users), 1)
 
+    def testLoginBusy(self, email="busy@diya.ink", password="Chungus12345"):
+        """Logins should be turned away while too many passwords are being hashed."""
+        self.testRegister(email, password)
+        self.db.hasher.maxPending = 0
+        login = self.client.post("/account/login", data={
+            "email": email,
+            "password": password
+        })
+        self.assertEqual(login.status_code, 503)
+        self.assertEqual(login.headers["Retry-After"], "1")
+        self.assertEqual(self.db.hasher.stats()["rejected"], 1)
+
     def testLoginCorrect(self, email="sus@diya.ink", password="Chungus12345"):
         """Tests logging in with a correct email and password."""
         self.testRegister(email, password)
@@ -91,6 +108,30 @@ class TestServer(TestUtils):
         details = self.client.get("/account/details")
         self.assertTrue(300 <= details.status_code < 500)
 
+    def testRevokeSessions(self, email="revoke@diya.ink", password="Password1234"):
+        """Changing a user's access level should log them out everywhere."""
+        for sessions in ("memory", "sqlite"):
+            app = createServer(self.tempDataDir, self.randomString() + ".db",
+                jobWorkers=0, sessions=sessions)
+            self.client = app.test_client()
+            self.db = app.db
+            other = app.test_client()
+            self.testLoginCorrect(email, password)
+            other.post("/account/login", data={"email": email, "password": password})
+            sessionCookie = self.client.get_cookie("session").value
+            self.assertRegex(sessionCookie, r"^[A-Za-z0-9_\-]{43}$", sessions)
+            self.assertEqual(other.get("/account/details").status_code, 200, sessions)
+
+            self.assertEqual(self.client.get("/account/toggleAdmin").status_code, 200)
+            for client in (self.client, other):
+                self.assertEqual(client.get("/account/details").status_code, 302, sessions)
+
+    def testSecretKey(self):
+        """Servers using the same data directory should share a secret key."""
+        app = createServer(self.tempDataDir, self.randomString() + ".db", jobWorkers=0)
+        self.assertEqual(len(app.secret_key), 32)
+        self.assertEqual(app.secret_key, self.client.application.secret_key)
+
     def testDetails(self, email="joe@diya.ink", password="CorrectHorseBatteryStaple"):
         """Tests getting user details."""
         self.testLoginCorrect(email, password)
@@ -165,6 +206,9 @@ class TestServer(TestUtils):
         for query, expectedBooks in (
             ("", [1, 2, 3]),
             ("query=learning", [2]),
+            ("query=learn", [2]),
+            ("query=computers&sort=relevance", []),
+            ("catalogue=computers&sort=author", [3, 2]),
             ("query=learning&catalogue=computers", [2]),
             ("query=learning&genre=programming", [2]),
             ("query=learning&catalogue=mung", []),
@@ -184,6 +228,72 @@ class TestServer(TestUtils):
             responseBookIDs = [book["bookID"] for book in search.json]
             self.assertEqual(responseBookIDs, expectedBooks, query)
 
+    def testFacets(self):
+        """Tests counting search results by genre, language and catalogue."""
+        self.testAddBook()
+        facets = self.client.get("/api/books/facets")
+        self.assertEqual(facets.status_code, 200)
+        self.assertEqual(facets.json["catalogue"][0], {"value": "Computers", "count": 2})
+        facets = self.client.get("/api/books/facets?query=bible&limit=1")
+        self.assertEqual(facets.json, {"genre": [], "language": [],
+            "catalogue": [{"value": "Computers", "count": 1}]})
+
+    def testSuggestions(self):
+        """Tests suggesting titles, authors and catalogues as a search is typed."""
+        self.testAddBook()
+        suggestions = self.client.get("/api/books/suggest?prefix=comp")
+        self.assertEqual(suggestions.status_code, 200)
+        self.assertEqual(suggestions.json, [{"text": "Computers", "kind": "catalogue", "count": 2}])
+        self.assertEqual(len(self.client.get("/api/books/suggest?prefix=l&limit=1").json), 1)
+        self.assertEqual(self.client.get("/api/books/suggest").json, [])
+
+    def testSearchPage(self):
+        """Tests the search page's first page and loading more results."""
+        self.testLoginCorrect()
+        self.db.addBooks([{"title": f"Book {i:02d}", "author": "Mungus", "isbn": f"978{i:010d}"}
+            for i in range(30)])
+        page = self.client.get("/books/search?query=mungus&sort=title")
+        self.assertEqual(page.status_code, 200)
+        self.assertTrue(page.is_streamed)
+        html = page.data.decode()
+        self.assertEqual(re.findall(r"<p>(Book \d\d)</p>", html), [f"Book {i:02d}" for i in range(24)])
+        moreResults = re.search(r'data-results="([^"]+)"', html).group(1).replace("&amp;", "&")
+
+        results = self.client.get(moreResults)
+        self.assertEqual(results.status_code, 200)
+        html = results.data.decode()
+        self.assertNotIn("<body>", html)
+        self.assertNotIn("loadMore", html)
+        self.assertEqual(re.findall(r"<p>(Book \d\d)</p>", html), [f"Book {i:02d}" for i in range(24, 30)])
+        self.assertEqual(self.client.get("/books/search?cursor=mungus").status_code, 400)
+
+    def testSearchCursor(self):
+        """Tests paging through search results with cursors."""
+        self.testAddBook()
+        for query, expectedPages in (
+            ("limit=2", [[1, 2], [3]]),
+            ("limit=1&sort=author", [[3], [1], [2]]),
+            ("limit=1&sort=date", [[1], [3], [2]]),
+            ("limit=1&query=computers", []),
+        ):
+            pages, cursor = [], ""
+            while True:
+                search = self.client.get("/api/books/search?" + query + "&cursor=" + cursor)
+                self.assertEqual(search.status_code, 200)
+                if search.json:
+                    pages.append([book["bookID"] for book in search.json])
+                cursor = search.headers.get("X-Next-Cursor")
+                if not cursor:
+                    break
+            self.assertEqual(pages, expectedPages, query)
+
+        search = self.client.get("/api/books/search?limit=1")
+        cursor = search.headers["X-Next-Cursor"]
+        self.assertEqual(self.client.get(
+            "/api/books/search?sort=author&cursor=" + cursor).status_code, 400)
+        self.assertEqual(self.client.get(
+            "/api/books/search?cursor=mungus").status_code, 400)
+
     def testAddFileNew(self):
         """Tests uploading a file to a new book."""
         self.testLoginAdmin()
@@ -224,6 +334,178 @@ class TestServer(TestUtils):
 
         return imageUrl
 
+    def testMetrics(self):
+        """Tests the request metrics only admins can see."""
+        self.assertEqual(self.client.get("/admin/metrics").status_code, 401)
+        imageUrl = self.testAddFileNew()
+        epubUrl = imageUrl.replace("cover", "file").replace(".jpg", ".epub")
+        epubSize = os.path.getsize(os.path.join(os.path.dirname(__file__), "data/book.epub"))
+        # Requests are counted when their response is closed, like servers do
+        for url in (epubUrl, epubUrl, "/missing"):
+            with self.client.get(url) as response:
+                response.get_data()
+
+        metrics = self.client.get("/admin/metrics")
+        self.assertEqual(metrics.status_code, 200)
+        self.assertEqual(metrics.mimetype, "text/plain")
+        text = metrics.data.decode()
+        self.assertIn('diya_http_requests_total{endpoint="diyaBooks.viewBookFile",status="200"} 2', text)
+        self.assertIn('diya_http_requests_total{endpoint="",status="404"} 1', text)
+        self.assertIn(f'diya_http_response_bytes_total{{endpoint="diyaBooks.viewBookFile"}} {epubSize * 2}', text)
+        self.assertIn('diya_http_request_duration_seconds_count{endpoint="diyaBooks.viewBook",method="GET"} 1', text)
+        self.assertIn('diya_http_request_duration_seconds_bucket{endpoint="diyaBooks.viewBook",'
+            'method="GET",le="+Inf"} 1', text)
+        self.assertRegex(text, r'diya_http_database_seconds_sum\{endpoint="diyaBooks.viewBook"\} 0\.0*[1-9]')
+        self.assertRegex(text, r'diya_http_database_queries_sum\{endpoint="diyaBooks.viewBook"\} [1-9]')
+        self.assertRegex(text, r"diya_http_requests_in_flight [1-9]")
+        self.assertIn("diya_password_hashes_total 2", text)
+        self.assertEqual(self.client.get("/admin/stats/queries").status_code, 404)
+
+    def testFileCaching(self):
+        """Tests ETags, conditional requests and byte ranges for book files."""
+        imageUrl = self.testAddFileNew()
+        epubUrl = imageUrl.replace("cover", "file").replace(".jpg", ".epub")
+        hash = epubUrl[12:-5]
+        with open(os.path.join(os.path.dirname(__file__), "data/book.epub"), "rb") as file:
+            fileData = file.read()
+
+        for url, etag in ((epubUrl, hash), (imageUrl, hash + ".jpg"),
+                          (imageUrl + "?w=160&fmt=webp", hash + "-160.webp")):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers["ETag"], '"' + etag + '"')
+            self.assertTrue(response.cache_control.immutable)
+            self.assertEqual(response.cache_control.max_age, 365 * 24 * 60 * 60)
+            notModified = self.client.get(url, headers={"If-None-Match": '"' + etag + '"'})
+            self.assertEqual(notModified.status_code, 304)
+            self.assertEqual(notModified.data, b"")
+        self.assertTrue(self.client.get(epubUrl).cache_control.private)
+
+        part = self.client.get(epubUrl, headers={"Range": "bytes=100-199"})
+        self.assertEqual(part.status_code, 206)
+        self.assertEqual(part.data, fileData[100:200])
+        self.assertEqual(part.headers["Content-Range"], f"bytes 100-199/{len(fileData)}")
+
+        placeholder = self.client.get("/books/cover/" + "0" * 64 + ".jpg")
+        self.assertEqual(placeholder.status_code, 302)
+        self.assertEqual(placeholder.headers["Location"], self.client.application.assets.url("img/cover.jpg"))
+        self.assertNotEqual(placeholder.headers["Location"], "/static/img/cover.jpg")
+        self.assertTrue(placeholder.cache_control.no_cache)
+
+    def testEpubEntries(self):
+        """Tests reading a book file's manifest and single entries."""
+        imageUrl = self.testAddFileNew()
+        hash = imageUrl[len("/books/cover/"):-len(".jpg")]
+        read = self.client.get("/books/read/1")
+        self.assertIn('ePub("/books/epub/' + hash + '/")', read.data.decode())
+
+        manifest = self.client.get("/api/books/epub/" + hash)
+        self.assertEqual(manifest.status_code, 200)
+        self.assertEqual(manifest.json["package"], "OEBPS/content.opf")
+        self.assertEqual(manifest.json["spine"], ["OEBPS/sections/section0001.xhtml"])
+        self.assertEqual(manifest.json["items"]["OEBPS/images/image0001.png"]["mediaType"], "image/png")
+
+        with zipfile.ZipFile(os.path.join(os.path.dirname(__file__), "data/book.epub")) as epubFile:
+            for path, mimetype in (("META-INF/container.xml", "application/xml"),
+                                   ("OEBPS/sections/section0001.xhtml", "application/xhtml+xml"),
+                                   ("OEBPS/images/image0001.png", "image/png")):
+                entry = self.client.get(f"/books/epub/{hash}/{path}")
+                self.assertEqual(entry.status_code, 200)
+                self.assertEqual(entry.mimetype, mimetype)
+                self.assertEqual(entry.data, epubFile.read(path))
+                self.assertTrue(entry.cache_control.immutable)
+                notModified = self.client.get(f"/books/epub/{hash}/{path}",
+                    headers={"If-None-Match": entry.headers["ETag"]})
+                self.assertEqual(notModified.status_code, 304)
+
+        self.assertEqual(self.client.get(f"/books/epub/{hash}/mungus.xhtml").status_code, 404)
+        self.assertEqual(self.client.get("/api/books/epub/" + "0" * 64).status_code, 404)
+        self.client.get("/account/logout")
+        self.assertEqual(self.client.get(f"/books/epub/{hash}/mimetype").status_code, 401)
+
+    def testImportBooks(self):
+        """Tests importing a directory of EPUBs from the admin route."""
+        directory = os.path.join(self.tempDataDir, "import-" + self.randomString())
+        os.makedirs(directory)
+        makeEpub(os.path.join(directory, "a.epub"), "9781118999875", "Linux Bible")
+        self.assertEqual(self.client.post("/admin/books/import",
+            data={"directory": directory}).status_code, 401)
+
+        self.testLoginAdmin()
+        self.assertEqual(self.client.post("/admin/books/import",
+            data={"directory": directory + "mungus"}).status_code, 422)
+        response = self.client.post("/admin/books/import", data={"directory": directory})
+        self.assertEqual(response.status_code, 202)
+        self.assertIsNone(response.json["status"])
+        self.assertTrue(os.path.exists(response.json["report"]))
+        self.assertEqual(self.client.get("/api/books/search?query=linux").json[0]["title"], "Linux Bible")
+
+    def testExportImportCatalog(self):
+        """Tests streaming the catalogue out and back in as JSON Lines."""
+        self.testAddBook()
+        export = self.client.get("/api/books/export")
+        self.assertEqual(export.status_code, 200)
+        self.assertEqual(export.mimetype, "application/x-ndjson")
+        lines = export.data.decode().splitlines()
+        self.assertEqual(len(lines), len(sampleBookMetadata))
+
+        lines[0] = lines[0].replace('"1984"', '"Nineteen Eighty-Four"')
+        result = self.client.post("/api/books/import", data="\n".join(lines),
+            content_type="application/x-ndjson")
+        self.assertEqual(result.json["updated"], len(sampleBookMetadata))
+        self.assertIn("Nineteen Eighty-Four", self.client.get("/books/view/1").data.decode())
+
+        self.client.get("/account/logout")
+        self.assertEqual(self.client.get("/api/books/export").status_code, 401)
+
+    def testResizedCover(self):
+        """Tests getting covers in other sizes and formats."""
+        imageUrl = self.testAddFileNew()
+        page = self.client.get("/books/view/1").data.decode()
+        self.assertIn(imageUrl + "?w=160&amp;fmt=webp 160w", page)
+        for query, width, mimetype in (
+            ("?w=160&fmt=webp", 160, "image/webp"),
+            ("?w=100", 160, "image/jpeg"),
+            ("?w=9999&fmt=jpg", 400, "image/jpeg"),
+            ("?fmt=webp", 400, "image/webp"),
+        ):
+            cover = self.client.get(imageUrl + query)
+            self.assertEqual(cover.status_code, 200)
+            self.assertEqual(cover.mimetype, mimetype)
+            self.assertEqual(PIL.Image.open(io.BytesIO(cover.data)).width, width)
+        self.assertEqual(self.client.get(imageUrl + "?fmt=bmp").status_code, 400)
+
+    def testStaticAssets(self):
+        """Tests fingerprinted URLs and precompressed static files."""
+        page = self.client.get("/").data.decode()
+        url = re.search(r'href="(/static/css/bootstrap\.min\.[0-9a-f]{16}\.css)"', page).group(1)
+        with open(os.path.join(os.path.dirname(os.path.dirname(
+                __file__)), "static/css/bootstrap.min.css"), "rb") as file:
+            original = file.read()
+
+        for acceptEncoding, encoding, decompress in (
+            ("gzip, deflate, br", "br", brotli.decompress if brotli else None),
+            ("gzip", "gzip", gzip.decompress),
+            ("", None, lambda data: data),
+        ):
+            if decompress is None:
+                continue
+            response = self.client.get(url, headers={"Accept-Encoding": acceptEncoding})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, "text/css")
+            self.assertEqual(response.headers.get("Content-Encoding"), encoding)
+            self.assertIn("Accept-Encoding", response.vary)
+            self.assertTrue(response.cache_control.immutable)
+            self.assertEqual(decompress(response.data), original)
+            self.assertEqual(self.client.get(url, headers={
+                "Accept-Encoding": acceptEncoding,
+                "If-None-Match": response.headers["ETag"]}).status_code, 304)
+
+        plain = self.client.get("/static/css/bootstrap.min.css")
+        self.assertEqual(plain.status_code, 200)
+        self.assertFalse(plain.cache_control.immutable)
+        self.assertEqual(self.client.get("/static/css/mungus.css").status_code, 404)
+
     def testFileDelete(self):
         """Tests adding a book with a file, then deleting to verify the file is gone."""
         imageUrl = self.testAddFileNew()
@@ -5,6 +5,7 @@ import os
 import shutil
 import unittest
 import warnings
+import zipfile
 
 
 sampleBookMetadata = [
@@ -35,6 +36,20 @@ sampleBookMetadata = [
 ]
 
 
+def makeEpub(path, isbn, title="Testing", metadata=""):
+    """Write a copy of the test EPUB with a different ISBN, title and
+    extra OPF metadata elements."""
+    with zipfile.ZipFile(os.path.join(os.path.dirname(__file__), "data/book.epub")) as source:
+        with zipfile.ZipFile(path, "w") as epubFile:
+            for item in source.infolist():
+                data = source.read(item)
+                if item.filename == "OEBPS/content.opf":
+                    data = data.decode().replace("218d4d28-4ea7-4536-acce-068fa3577369",
+                        "urn:isbn:" + isbn).replace("<dc:title>Testing</dc:title>",
+                        f"<dc:title>{title}</dc:title>{metadata}").encode()
+                epubFile.writestr(item, data)
+
+
 class TestUtils(unittest.TestCase):
     @classmethod
     def setUpClass(self):